@@ -0,0 +1,210 @@
+# /***********************************************************************
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Note that these code samples being shared are not official Google
+# products and are not formally supported.
+# ************************************************************************/
+
+"""
+Retries and rate limits Google API calls.
+
+Every call goes through call(), which waits for a token from the API's
+token bucket, then retries retryable errors with exponential backoff and
+full jitter. Quota errors (HTTP 429 or a rateLimitExceeded reason) halve
+the bucket's rate, and successful calls raise it back towards the limit,
+so concurrent batch runs settle just below the quota.
+"""
+import asyncio
+import random
+import threading
+import time
+from typing import Dict
+
+from absl import logging
+
+import run_report
+
+# requests per second and burst size per API
+RATE_LIMITS = {
+    'bigquery': (50.0, 100),
+    'storage': (100.0, 200),
+    'transfer': (5.0, 10),
+    'iam': (2.0, 5),
+}
+MAX_ATTEMPTS = 6
+BASE_DELAY = 1.0
+MAX_DELAY = 60.0
+
+QUOTA_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded',
+                 'quotaExceeded'}
+TRANSIENT_STATUS = {500, 502, 503, 504}
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket whose rate adapts to quota errors"""
+
+    def __init__(self, rate: float, burst: int):
+        self.limit = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def reserve(self) -> float:
+        """Takes a token, returning the seconds to wait before using it"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self):
+        """Blocks until a token is available"""
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttle(self):
+        with self._lock:
+            self.rate = max(self.limit / 64, self.rate / 2)
+
+    def recover(self):
+        with self._lock:
+            self.rate = min(self.limit, self.rate + self.limit / 20)
+
+
+_buckets: Dict[str, TokenBucket] = {}
+_buckets_lock = threading.Lock()
+
+
+def bucket(api: str) -> TokenBucket:
+    with _buckets_lock:
+        if api not in _buckets:
+            _buckets[api] = TokenBucket(*RATE_LIMITS[api])
+        return _buckets[api]
+
+
+def status_code(err: Exception):
+    code = getattr(err, 'code', None)
+    if isinstance(code, int):
+        return code
+    # googleapiclient.errors.HttpError
+    resp = getattr(err, 'resp', None)
+    if resp is not None:
+        return int(resp.status)
+    return None
+
+
+def is_quota_error(err: Exception) -> bool:
+    if status_code(err) == 429:
+        return True
+    errors = getattr(err, 'errors', None) or []
+    return any(
+        isinstance(e, dict) and e.get('reason') in QUOTA_REASONS
+        for e in errors
+    )
+
+
+def is_retryable(err: Exception, idempotent: bool = True) -> bool:
+    """
+    Whether err is worth retrying.
+
+    Quota errors mean the request was rejected, so they are always retried.
+    Server errors and dropped connections may have been applied already,
+    so they are only retried for idempotent calls.
+    """
+    if is_quota_error(err):
+        return True
+    if not idempotent:
+        return False
+    if status_code(err) in TRANSIENT_STATUS:
+        return True
+    return isinstance(err, (ConnectionError, TimeoutError)) or (
+        type(err).__name__ in ('ConnectionError', 'Timeout',
+                               'ChunkedEncodingError', 'RetryError')
+    )
+
+
+def backoff(attempt: int) -> float:
+    """Full jitter: uniform between zero and the exponential delay"""
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+
+def retry_delay(api: str, err: Exception, attempt: int, idempotent: bool):
+    """Seconds to wait before retrying, or None to give up"""
+    if attempt == MAX_ATTEMPTS - 1 or not is_retryable(err, idempotent):
+        return None
+    if is_quota_error(err):
+        bucket(api).throttle()
+    run_report.add('api_retries.' + api)
+    delay = backoff(attempt)
+    logging.info('%s call failed (%s), retrying in %.1fs', api, err, delay)
+    return delay
+
+
+def call(api: str, fn: callable, *args, idempotent: bool = True, **kwargs):
+    """
+    Calls fn(*args, **kwargs) under the rate limit and retry policy of api.
+
+    :param api: Key of RATE_LIMITS, e.g. 'bigquery'
+    :param fn: The API call. Lazy iterators (e.g. list_blobs) should be
+        consumed inside fn so that paging is retried too.
+    :param idempotent: False for calls that must not be repeated if they
+        may have been applied, e.g. creating a transfer config
+    :return: The result of fn
+    """
+    limiter = bucket(api)
+    for attempt in range(MAX_ATTEMPTS):
+        limiter.acquire()
+        run_report.add('api_calls.' + api)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as err:
+            delay = retry_delay(api, err, attempt, idempotent)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            continue
+        limiter.recover()
+        return result
+
+
+async def call_async(api: str, fn: callable, idempotent: bool = True):
+    """
+    Like call(), but awaits the coroutine returned by fn() and waits for
+    tokens and backoff without blocking the event loop.
+    """
+    limiter = bucket(api)
+    for attempt in range(MAX_ATTEMPTS):
+        wait = limiter.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        run_report.add('api_calls.' + api)
+        try:
+            result = await fn()
+        except Exception as err:
+            delay = retry_delay(api, err, attempt, idempotent)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+        limiter.recover()
+        return result
@@ -21,16 +21,14 @@ from enum import Enum
 from typing import Dict
 from typing import List
 
-import numpy as np
 from absl import flags
-from dateutil.parser import parse as parse_date
-from google.api_core import exceptions
-from google.cloud import storage
-from prompt_toolkit import prompt
 from termcolor import cprint
 
+import api_calls
+import clients
 from flagmaker import settings
 from flagmaker.exceptions import FlagMakerConfigurationError
+import prefetch
 from utilities import Locale
 
 
@@ -50,6 +48,7 @@ class AppSettings(settings.AbstractSettings):
 
     Add all flags under settings()
     """
+    profile_keys = ['gcp_project_name', 'advertiser_id']
 
     def __init__(self):
         self.hooks = Hooks()
@@ -68,6 +67,114 @@ class AppSettings(settings.AbstractSettings):
                     default=False,
                     include_in_interactive=False
                 ),
+                'materialize_keyword_mapper': settings.SettingOption.create(
+                    self,
+                    'Store the keyword mapper as a clustered table instead '
+                    'of a view. The table is only rebuilt by a run of this '
+                    'script, and only when the SA360 entity tables changed '
+                    'since the last build: keywords added by later daily '
+                    'transfers are missing from ReportView until the script '
+                    'runs again (e.g. from a daily cron job).',
+                    method=flags.DEFINE_bool,
+                    default=False,
+                    include_in_interactive=False
+                ),
+                'agency_views': settings.SettingOption.create(
+                    self,
+                    'Also create agency-level views over all advertisers '
+                    'using wildcard tables, and a combined historical table '
+                    'with an advertiser_id column. Built once per run, after '
+                    'all advertisers.',
+                    method=flags.DEFINE_bool,
+                    default=False,
+                    include_in_interactive=False
+                ),
+                'build_rollups': settings.SettingOption.create(
+                    self,
+                    'Also build weekly and monthly rollup tables of the '
+                    'report at keyword and campaign level. Existing rollups '
+                    'are refreshed over the last rollup_lookback_days.',
+                    method=flags.DEFINE_bool,
+                    default=False,
+                    include_in_interactive=False
+                ),
+                'rollup_lookback_days': settings.SettingOption.create(
+                    self,
+                    'Days of rollups rewritten by a refresh, so that '
+                    'conversions restated by the transfer reach them. Keep '
+                    'it at least as long as the transfer\'s refresh window '
+                    '(at most 30 days).',
+                    method=flags.DEFINE_integer,
+                    default=30,
+                    include_in_interactive=False
+                ),
+                'fresh_run': settings.SettingOption.create(
+                    self,
+                    'Ignore stages completed by previous runs and run '
+                    'every stage again.',
+                    method=flags.DEFINE_bool,
+                    default=False,
+                    include_in_interactive=False
+                ),
+                'max_memory_mb': settings.SettingOption.create(
+                    self,
+                    'Memory (MiB) historical decoding may use. 0 means '
+                    '60% of the system or container memory.',
+                    method=flags.DEFINE_integer,
+                    default=0,
+                    include_in_interactive=False
+                ),
+                'stream_gcs_reads': settings.SettingOption.create(
+                    self,
+                    'Decode historical CSVs in GCS as they are read instead '
+                    'of downloading them first.',
+                    method=flags.DEFINE_bool,
+                    default=False,
+                    include_in_interactive=False
+                ),
+                'upload_part_mb': settings.SettingOption.create(
+                    self,
+                    'Upload historical files larger than this (MiB) in '
+                    'parallel parts. 0 uploads every file in one stream.',
+                    method=flags.DEFINE_integer,
+                    default=128,
+                    include_in_interactive=False
+                ),
+                'upload_concurrency': settings.SettingOption.create(
+                    self,
+                    'Parts of a historical file uploaded at the same time.',
+                    method=flags.DEFINE_integer,
+                    default=8,
+                    include_in_interactive=False
+                ),
+                'direct_load_max_mb': settings.SettingOption.create(
+                    self,
+                    'Load historical files uploaded to Cloud Shell that are '
+                    'no larger than this (MiB) into BigQuery directly, '
+                    'without copying them to GCS. 0 always copies them.',
+                    method=flags.DEFINE_integer,
+                    default=1024,
+                    include_in_interactive=False
+                ),
+                'scratch_dir': settings.SettingOption.create(
+                    self,
+                    'Directory for temporary files (downloads, extracted '
+                    'archives, decoded output). Each advertiser of each run '
+                    'works in its own subdirectory, removed when it '
+                    'finishes. Defaults to the system temporary directory.',
+                    method=flags.DEFINE_string,
+                    default='',
+                    include_in_interactive=False
+                ),
+                'compress_output': settings.SettingOption.create(
+                    self,
+                    'Write, upload and load decoded historical files gzip '
+                    'compressed. BigQuery loads a compressed file of at most '
+                    '4 GB, and more slowly than an uncompressed one.',
+                    method=flags.DEFINE_bool,
+                    default=False,
+                    include_in_interactive=False
+                ),
                 'gcp_project_name': settings.SettingOption.create(
                     self,
                     'GCP Project Name',
@@ -76,12 +183,14 @@ class AppSettings(settings.AbstractSettings):
                 'raw_dataset': settings.SettingOption.create(
                     self,
                     'Dataset where raw data will be stored',
-                    default='raw'
+                    default='raw',
+                    after=self.hooks.prefetch_dataset,
                 ),
                 'view_dataset': settings.SettingOption.create(
                     self,
                     'Dataset where view data will be generated and stored',
-                    default='views'
+                    default='views',
+                    after=self.hooks.prefetch_dataset,
                 ),
                 'location': settings.SettingOption.create(
                     self,
@@ -169,7 +278,7 @@ class AppSettings(settings.AbstractSettings):
                 'Column name for the Account Name',
                 default='account_name',
                 after=self.hooks.map_historical_column,
-                attrs={'dtype': np.object},
+                attrs={'dtype': 'object'},
             ),
             'campaign_column_name': settings.SettingOption.create(
                 self,
@@ -177,14 +286,14 @@ class AppSettings(settings.AbstractSettings):
                 '(only if including historical data)',
                 default='campaign_name',
                 after=self.hooks.map_historical_column,
-                attrs={'dtype': np.object},
+                attrs={'dtype': 'object'},
             ),
             'conversion_count_column': settings.SettingOption.create(
                 self,
                 'Specify the conversion column',
                 default='conversions',
                 after=self.hooks.map_historical_column,
-                attrs={'dtype': np.float64},
+                attrs={'dtype': 'float64'},
                 conditional=lambda s: s['report_level'].value == 'keyword',
             ),
             'revenue_column_name': settings.SettingOption.create(
@@ -196,7 +305,7 @@ class AppSettings(settings.AbstractSettings):
                 required=False,
                 conditional=lambda s: s['has_revenue_column'].value,
                 after=self.hooks.map_historical_column,
-                attrs={'dtype': np.float64},
+                attrs={'dtype': 'float64'},
             ),
             'device_segment_column_name': settings.SettingOption.create(
                 self,
@@ -204,14 +313,14 @@ class AppSettings(settings.AbstractSettings):
                 default='device_segment',
                 conditional=lambda s: s['has_device_segment'].value,
                 after=self.hooks.map_historical_column,
-                attrs={'dtype': np.object},
+                attrs={'dtype': 'object'},
             ),
             'date_column_name': settings.SettingOption.create(
                 self,
                 'Column name for the Date Value',
                 default='date',
                 after=self.hooks.map_historical_column,
-                attrs={'dtype': np.datetime64},
+                attrs={'dtype': 'datetime64'},
             ),
             'adgroup_column_name': settings.SettingOption.create(
                 self,
@@ -219,7 +328,7 @@ class AppSettings(settings.AbstractSettings):
                 default='ad_group',
                 conditional=lambda s: s['report_level'].value != 'campaign',
                 after=self.hooks.map_historical_column,
-                attrs={'dtype': np.object},
+                attrs={'dtype': 'object'},
             ),
             'keyword_match_type': settings.SettingOption.create(
                 self,
@@ -228,7 +337,7 @@ class AppSettings(settings.AbstractSettings):
                 default='match_type',
                 after=self.hooks.map_historical_column,
                 conditional=lambda s: s['report_level'].value != 'campaign',
-                attrs={'dtype': np.object},
+                attrs={'dtype': 'object'},
             ),
             'keyword_column_name': settings.SettingOption.create(
                 self,
@@ -236,7 +345,7 @@ class AppSettings(settings.AbstractSettings):
                 default='keyword',
                 conditional=lambda s: s['report_level'].value != 'campaign',
                 after=self.hooks.map_historical_column,
-                attrs={'dtype': np.object},
+                attrs={'dtype': 'object'},
             )
         }
 
@@ -249,24 +358,54 @@ class Hooks:
 
     def __init__(self):
         self.storage = None
+        self.prefetch = prefetch.Prefetcher()
 
     def set_clients(self, setting: settings.SettingOption):
         s = setting.settings
         if 'storage_client' in s.custom:
             return True
-        s.custom['storage_client'] = self.storage = storage.Client(
-            project=s['gcp_project_name'].value
+        s.custom['storage_client'] = self.storage = (
+            clients.get_registry().storage(s['gcp_project_name'].value)
         )
+        # without prompts there is nothing to overlap the lookups with,
+        # and the bucket list is only shown as a prompt
+        if s.prompting:
+            self.prefetch.submit('buckets', prefetch.list_buckets,
+                                 self.storage)
         return True
 
+    def prefetch_dataset(self, setting: settings.SettingOption):
+        """Looks up the dataset and its tables while prompts continue"""
+        if self.storage is None or not setting.settings.prompting:
+            return
+        project = setting.settings['gcp_project_name'].value
+        dataset_id = '{}.{}'.format(project, setting.value)
+        # the BigQuery client is created in the background thread, so its
+        # import does not delay the next prompt
+        self.prefetch.submit(
+            'dataset:' + dataset_id,
+            lambda: prefetch.get_dataset(
+                clients.get_registry().bigquery(project), dataset_id
+            )
+        )
+        self.prefetch.submit(
+            'tables:' + dataset_id,
+            lambda: prefetch.list_table_ids(
+                clients.get_registry().bigquery(project), dataset_id
+            )
+        )
+
     def create_new_bucket(self, bucket: str, project_name: str) -> None:
-        result = self.storage.create_bucket(
-                bucket,
-                project=project_name
-                )
+        result = api_calls.call(
+            'storage', self.storage.create_bucket, bucket,
+            project=project_name, idempotent=False,
+        )
         return result
 
     def create_bucket(self, setting: settings.SettingOption) -> bool:
+        from google.api_core import exceptions
+        from prompt_toolkit import prompt
+
         class ChooseAnother:
             toggle = False
         s = setting.settings
@@ -290,7 +429,9 @@ class Hooks:
                 break
             ChooseAnother.toggle = False
             try:
-                setting.value = self.storage.get_bucket(setting.value).name
+                setting.value = api_calls.call(
+                    'storage', self.storage.get_bucket, setting.value
+                ).name
                 break
             except exceptions.NotFound as e:
                 r = prompt(
@@ -328,10 +469,18 @@ class Hooks:
     def set_locale(self, setting: settings.SettingOption):
         s = setting.settings
         s.custom['locale'] = Locale.get(setting.value)
+        if self.storage is not None and s.prompting:
+            project = s['gcp_project_name'].value
+            self.prefetch.submit(
+                'transfer_configs:{}/{}'.format(project, setting.value),
+                prefetch.list_transfer_configs, project, setting.value
+            )
 
     def bucket_options(self, setting: settings.SettingOption):
         s = setting.settings
-        buckets = s.custom['buckets'] = list(self.storage.list_buckets())
+        buckets = s.custom['buckets'] = self.prefetch.get(
+            'buckets', prefetch.list_buckets, self.storage
+        )
         bucket_size = len(buckets)
         result = '\n'.join(['{}: {}'.format(b+1, buckets[b])
                             for b in range(bucket_size)])
@@ -348,11 +497,20 @@ class Hooks:
         settings.custom['historical_map'][setting.value] = setting
 
     def convert_to_date(self, setting: settings.SettingOption):
+        from dateutil.parser import parse as parse_date
+        from prompt_toolkit import prompt
+
         try:
             location: str = setting.settings['location'].value
             try:
                 value = datetime.strptime(setting.value, '%Y-%m-%d')
             except ValueError:
+                if not setting.settings.prompting:
+                    # nobody can confirm a guess in a settings file run
+                    raise FlagMakerConfigurationError(
+                        'Date {} is not in yyyy-mm-dd format. Example: '
+                        '1999-12-31'.format(setting.value)
+                    )
                 kwargs = {}
                 kwargs['dayfirst'] = not location.lower().startswith('us')
                 value = parse_date(setting.value, **kwargs)
@@ -0,0 +1,111 @@
+# /***********************************************************************
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Note that these code samples being shared are not official Google
+# products and are not formally supported.
+# ************************************************************************/
+
+"""
+Asyncio execution core for the bootstrap stages.
+
+The Google Cloud SDKs are synchronous, so each request is offloaded to a
+worker thread for just as long as the request takes. Everything that
+waits (rate limits, backoff, polling jobs and transfers) waits on the event
+loop instead, so one process can wait for hundreds of jobs while using
+only a small thread pool.
+"""
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable
+from typing import Iterable
+from typing import List
+
+import api_calls
+import profiling
+import run_report
+
+DEFAULT_WORKERS = 32
+POLL_SECONDS = 0.5
+MAX_POLL_SECONDS = 10.0
+
+
+def run(coroutine: Awaitable, max_workers: int = DEFAULT_WORKERS):
+    """Runs coroutine on a new event loop with a pool of max_workers
+    threads for offloaded calls."""
+    async def main():
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(
+            max_workers, thread_name_prefix='offload'
+        ))
+        return await coroutine
+    return asyncio.run(main())
+
+
+async def offload(fn: callable, *args, **kwargs):
+    """Runs the blocking fn(*args, **kwargs) in a worker thread, in a copy
+    of the current context (e.g. the current run report span)"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        None, functools.partial(
+            context.run, profiling.profiled, fn, *args, **kwargs
+        )
+    )
+
+
+async def call(api: str, fn: callable, *args, idempotent: bool = True,
+               **kwargs):
+    """api_calls.call for the event loop. Only the request itself holds a
+    worker thread."""
+    return await api_calls.call_async(
+        api, lambda: offload(fn, *args, **kwargs), idempotent=idempotent
+    )
+
+
+async def poll(check: callable, interval: float = POLL_SECONDS,
+               max_interval: float = MAX_POLL_SECONDS):
+    """Awaits check() until it returns True, backing off between checks"""
+    while not await check():
+        await asyncio.sleep(interval)
+        interval = min(max_interval, interval * 2)
+
+
+async def run_job(create: callable):
+    """
+    Creates a BigQuery job with create() and waits for it to finish.
+
+    The job is polled from the event loop rather than blocking a thread in
+    job.result(). A job that fails with a retryable error is created
+    again, so create() must be safe to repeat.
+
+    :return: The job's result()
+    """
+    async def attempt():
+        job = await offload(create)
+        await poll(lambda: call('bigquery', job.done))
+        result = await offload(job.result)
+        run_report.record_job(job)
+        return result
+    return await api_calls.call_async('bigquery', attempt)
+
+
+async def gather(coroutines: Iterable[Awaitable], limit: int) -> List:
+    """Awaits the coroutines, at most limit at a time"""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def bounded(coroutine):
+        async with semaphore:
+            return await coroutine
+    return await asyncio.gather(*(bounded(c) for c in coroutines))
@@ -16,55 +16,155 @@
 # Note that these code samples being shared are not official Google
 # products and are not formally supported.
 # ************************************************************************/
+"""
+Creates the datasets, transfers, historical tables and views for an
+advertiser.
+
+The Google Cloud client libraries, pandas and prompt_toolkit take seconds
+to import, so they are imported in the stages that use them rather than
+at module level. This keeps --help and the first prompt fast.
+"""
+import asyncio
+import copy
+import functools
+import importlib.util
+import io
 import os
 import shutil
 import sys
-import time
+import tempfile
 import traceback
+from collections import namedtuple
 from datetime import datetime
 from typing import Dict
+from typing import List
+from typing import TYPE_CHECKING
+from typing import Union
 
-import numpy as np
 from absl import app
+from absl import flags
 from absl import logging
-from google.api_core.exceptions import BadRequest
-from google.api_core.exceptions import Conflict
-from google.api_core.exceptions import NotFound
-from google.cloud import bigquery
-from google.cloud import bigquery_datatransfer
-from google.cloud.bigquery_datatransfer_v1 import types
-from google.cloud import storage
-from google.cloud.bigquery.dataset import Dataset
-from google.cloud.storage import Blob
-from google.cloud.storage import Bucket
-from google.protobuf.struct_pb2 import Struct
-from googleapiclient import discovery
-from googleapiclient.errors import HttpError
 from termcolor import cprint, colored
-from typing import Dict
 
+import api_calls
 import app_settings
-from csv_decoder import Decoder
+import async_runner
+import clients
+from checkpoint import CHECKPOINT_DIR
+from checkpoint import Checkpoints
+from exceptions import BootstrapperError
+from memory import MemoryBudget
+import prefetch
+import profiling
+import run_report
+import uploads
 from flagmaker.settings import Config
 from flagmaker.settings import SettingOption
-from prompt_toolkit import prompt
 from utilities import *
-from views import CreateViews
-from views import DataSets
+
+if TYPE_CHECKING:
+    from google.cloud import bigquery
+    from google.cloud import storage
+    from google.cloud.storage import Blob
+    from google.cloud.storage import Bucket
+
+LAZY_MODULES = (
+    'dateutil',
+    'google.api_core',
+    'google.cloud.bigquery',
+    'google.cloud.bigquery_datatransfer',
+    'google.cloud.storage',
+    'google.protobuf',
+    'google_crc32c',
+    'googleapiclient',
+    'pandas',
+    'prompt_toolkit',
+    'xlrd',
+)
+
+
+def check_dependencies():
+    """Raises ImportError for modules that are only imported when needed.
+
+    Lets run.py install missing packages up front without importing them.
+    """
+    importlib.invalidate_caches()
+    for module in LAZY_MODULES:
+        if importlib.util.find_spec(module) is None:
+            raise ImportError('No module named ' + module, name=module)
+
+
+MAX_CONCURRENT_ADVERTISERS = 8
+TRANSFER_POLL_SECONDS = 10
+# read size of streamed GCS blobs
+STREAM_CHUNK_BYTES = 8 * 2 ** 20
+
+# a setting merged across advertisers, read like a SettingOption
+SettingValue = namedtuple('SettingValue', ['value'])
+
+
+class CountingReader(io.BufferedIOBase):
+    """A binary stream that adds the bytes read from it to a run report
+    counter when it is closed"""
+
+    def __init__(self, stream, counter: str):
+        super().__init__()
+        self.stream = stream
+        self.counter = counter
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def read1(self, size=-1):
+        data = getattr(self.stream, 'read1', self.stream.read)(size)
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seekable(self):
+        return self.stream.seekable()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.stream.seek(offset, whence)
+
+    def tell(self):
+        return self.stream.tell()
+
+    def close(self):
+        if not self.closed:
+            run_report.add(self.counter, self.bytes_read)
+            self.stream.close()
+        super().close()
 
 
 class Bootstrap:
     settings: app_settings.AppSettings = None
     config: Config = None
-    storage_cli: storage.Client
-    bucket: Bucket
+    storage_cli: 'storage.Client'
+    bucket: 'Bucket'
+    checkpoints: Checkpoints = None
+    checkpoint_dir: str = CHECKPOINT_DIR
+    historical: dict = None
+    # the advertiser's temporary files, removed when its run finishes
+    scratch: str = None
+    # serializes decoding, which is CPU and memory bound
+    decode_lock: asyncio.Lock = None
 
     def __init__(self):
         self.config: Config[app_settings.AppSettings] = Config(
             app_settings.AppSettings
         )
         self.s = None
-        self.path = '/tmp/in-upload/'
 
     def run(self):
         app.run(self.exec)
@@ -72,38 +172,238 @@ class Bootstrap:
     def get_storage_cli(self):
         return self.settings.custom['storage_client']
 
-    def get_bucket(self) -> Bucket:
+    async def get_bucket(self) -> 'Bucket':
+        from google.api_core.exceptions import NotFound
+
         bucket_name = self.s.unwrap('storage_bucket')
         try:
-            return self.storage_cli.get_bucket(bucket_name)
+            return await async_runner.call(
+                'storage', self.storage_cli.get_bucket, bucket_name
+            )
         except NotFound:
-            if self.settings.hooks.create_new_bucket(bucket_name, self.s.unwrap('gcp_project_name')) is None:
+            bucket = await async_runner.offload(
+                self.settings.hooks.create_new_bucket,
+                bucket_name, self.s.unwrap('gcp_project_name')
+            )
+            if bucket is not None:
+                return bucket
+            else:
                 cprint('Could not find bucket named ' + bucket_name, 'red',
                        attrs=['bold'])
                 cprint('Please double-check existence, or remove the '
                        'storage_bucket flag so we can help you create the storage '
                        'bucket interactively.', 'red')
-                exit(1)
+                raise BootstrapperError(
+                    'Could not find bucket named ' + bucket_name
+                )
 
     def exec(self, args):
+        report = run_report.reset()
+        try:
+            with profiling.session('exec', 'exec'):
+                failed = async_runner.run(
+                    self.run_all(self.config.get_all())
+                )
+        finally:
+            path = report.write(flags.FLAGS.run_report,
+                                flags.FLAGS.otlp_trace_file)
+            report.print_summary()
+            cprint('Run report written to {}'.format(path), 'blue')
+        if failed:
+            cprint('Failed advertisers: {}'.format(', '.join(failed)), 'red',
+                   attrs=['bold'])
+            sys.exit(1)
+
+    async def run_all(
+            self, all_settings: List[app_settings.AppSettings]) -> List[str]:
+        """Bootstraps every advertiser concurrently on the event loop.
+
+        Interactive runs may prompt, so they run one at a time. An
+        advertiser that fails does not stop the others.
+
+        The agency layer (--agency_views) is built once all advertisers
+        are done.
+
+        :return: The IDs of the advertisers (and agencies) that failed
+        """
+        self.decode_lock = asyncio.Lock()
+        interactive = any(s['interactive'].value for s in all_settings)
+        # each advertiser gets its own copy of the per-run state
+        bootstraps = [copy.copy(self) for _ in all_settings]
+        succeeded = await async_runner.gather(
+            (b.run_settings(s) for b, s in zip(bootstraps, all_settings)),
+            1 if interactive else MAX_CONCURRENT_ADVERTISERS,
+        )
+        failed = [
+            str(s['advertiser_id'].value)
+            for s, ok in zip(all_settings, succeeded) if not ok
+        ]
+        return failed + await self.run_agencies(
+            [b for b, ok in zip(bootstraps, succeeded) if ok]
+        )
+
+    async def run_agencies(self, bootstraps: List['Bootstrap']) -> List[str]:
+        """Builds the agency layer of every agency with agency_views from
+        its advertisers that succeeded, one agency at a time.
+
+        :return: 'agency <ID>' for every agency that failed
+        """
+        agencies = {}
+        for b in bootstraps:
+            if b.s.unwrap('agency_views'):
+                key = tuple(str(b.s.unwrap(k)) for k in (
+                    'gcp_project_name', 'agency_id', 'raw_dataset',
+                    'view_dataset'
+                ))
+                agencies.setdefault(key, []).append(b)
+        failed = []
+        for (project, agency, _, _), members in sorted(agencies.items()):
+            try:
+                with run_report.span('agency', project=project,
+                                     agency=agency):
+                    await members[0].build_agency(project, agency, members)
+            except Exception as err:
+                cprint('Agency {} failed: {}'.format(agency, err), 'red',
+                       attrs=['bold'])
+                logging.debug(traceback.format_exc())
+                failed.append('agency ' + agency)
+        return failed
+
+    async def build_agency(self, project: str, agency: str,
+                           members: List['Bootstrap']):
+        """
+        Merges the members' historical tables into the agency historical
+        table, then creates the agency views.
+
+        The agency table has a fixed schema: every historical column, so
+        advertisers with different columns can share it. The views are
+        built from settings merged across the agency: it has historical
+        data (or a device segment) if any of its advertisers has, in this
+        run or a previous one.
+
+        :param members: The agency's advertisers from this run
+        """
+        from google.api_core.exceptions import NotFound
+        from views import CreateViews
+
+        client = clients.get_registry().bigquery(project)
+        historical = [m for m in members if m.s.unwrap('has_historical_data')]
+        table_ref = self.datasets.raw.table(
+            get_view_name(ViewTypes.AGENCY_HISTORICAL, agency)
+        )
+        if historical:
+            await self.agency_historical_table(
+                client, table_ref, device_segment=any(
+                    m.s.unwrap('has_device_segment') for m in historical
+                )
+            )
+        for member in historical:
+            advertiser = str(member.s.unwrap('advertiser_id'))
+            # merged again whenever the historical table was reloaded
+            inputs = {
+                'agency': agency,
+                # merges without computed fingerprints are redone
+                'fingerprint': True,
+                'historical_table':
+                    member.checkpoints.stages['historical_table']['completed'],
+            }
+            if member.checkpoints.matches('agency_historical_table', inputs):
+                continue
+            await member.load_agency_historical_table(
+                client, project, advertiser
+            )
+            member.checkpoints.complete('agency_historical_table', inputs)
         try:
-            self.settings: app_settings.AppSettings = self.config.get()
+            table = await async_runner.call('bigquery', client.get_table,
+                                            table_ref)
+        except NotFound:
+            table = None
+        merged = dict(self.settings.flattened_args)
+        for k, v in (
+            ('has_historical_data', table is not None),
+            ('has_device_segment', table is not None
+             and table.labels.get('has_device_segment') == 'true'),
+            ('device_segment_column_name', 'device_segment'),
+        ):
+            merged[k] = SettingValue(v)
+        await CreateViews(
+            merged, client, project, agency, self.datasets
+        ).agency_views()
+
+    async def run_settings(self, settings: app_settings.AppSettings) -> bool:
+        """Runs every bootstrap stage for one advertiser's settings, timed
+        as one span of the run report.
+
+        :return: False if a stage failed. The error is recorded in the
+            span, so the other advertisers carry on.
+        """
+        advertiser = str(settings['advertiser_id'].value)
+        try:
+            with run_report.span(
+                'bootstrap',
+                project=str(settings['gcp_project_name'].value),
+                advertiser=advertiser,
+            ):
+                await self.run_stages(settings)
+        except Exception as err:
+            cprint('Advertiser {} failed: {}'.format(advertiser, err), 'red',
+                   attrs=['bold'])
+            logging.debug(traceback.format_exc())
+            return False
+        return True
+
+    async def run_stages(self, settings: app_settings.AppSettings):
+        from google.api_core.exceptions import BadRequest
+        from views import CreateViews
+        from views import DataSets
+
+        try:
+            self.settings = settings
             self.s = SettingUtil(self.settings)
+            self.datasets = DataSets()
             self.storage_cli = self.get_storage_cli()
-            self.bucket = self.get_bucket()
+            self.bucket = await self.get_bucket()
             project = str(self.s.unwrap('gcp_project_name'))
-            client = bigquery.Client(
-                project=project, location='US'
-            )  # type : bigquery.Client
-            self.load_datasets(client, project)
             advertiser = str(self.s.unwrap('advertiser_id'))
+            agency = str(self.s.unwrap('agency_id'))
+            self.scratch = tempfile.mkdtemp(
+                prefix='sa360-bq-{}-'.format(advertiser),
+                dir=self.s.unwrap('scratch_dir') or None,
+            )
+            self.checkpoints = Checkpoints(
+                project, advertiser, self.checkpoint_dir,
+                fresh=self.s.unwrap('fresh_run'),
+            )
+            client = clients.get_registry().bigquery(project)
+            datasets = {
+                'raw': self.s.unwrap('raw_dataset'),
+                'views': self.s.unwrap('view_dataset'),
+                'location': self.s.unwrap('location'),
+            }
+            if not await self.stage('datasets', datasets,
+                                    self.load_datasets, client, project):
+                self.use_datasets(project)
             cprint('Advertiser ID: {}'.format(advertiser),
                    'blue', attrs=['bold', 'underline'])
-            self.load_service(project)
-            self.load_transfers(client, project, advertiser)
+            await self.stage('service_account', {'project': project},
+                             self.load_service, project)
+            await self.stage(
+                'transfer', dict(datasets, agency=agency),
+                self.load_transfers, client, project, advertiser
+            )
             if (self.s.unwrap('has_historical_data')):
-                self.load_historical_tables(client, project, advertiser)
-            CreateViews(self.settings, client, project, advertiser).run()
+                self.historical = await self.historical_inputs()
+                await self.stage(
+                    'historical_table', self.historical,
+                    self.load_historical_tables, client, project, advertiser,
+                    force=self.s.unwrap('overwrite_storage_csv'),
+                )
+            views = CreateViews(
+                self.settings, client, project, advertiser, self.datasets
+            )
+            if not await self.stage('views', self.view_inputs(), views.run):
+                # materialized tables and rollups still need refreshing
+                await views.run(deploy_views=False)
         except BadRequest as err:
             cprint(
                 'Error. Please ensure you have enabled all requested '
@@ -113,27 +413,117 @@ class Bootstrap:
             )
             cprint(str(err), 'red')
             logging.debug('%s\n%s', err.errors, traceback.format_exc())
+            raise
+        finally:
+            self.settings.hooks.prefetch.shutdown()
+            if self.scratch is not None:
+                shutil.rmtree(self.scratch, ignore_errors=True)
+
+    async def stage(self, name: str, inputs, fn: callable, *args,
+                    force: bool = False) -> bool:
+        """
+        Runs one bootstrap stage unless a previous run completed it.
+
+        :param name: Name of the stage in the checkpoint store
+        :param inputs: JSON-serializable inputs; changing them reruns it
+        :param fn: The stage coroutine function, awaited as fn(*args)
+        :param force: Run the stage even if it was completed
+        :return: True if the stage ran
+        """
+        if not force and self.checkpoints.done(name, inputs):
+            cprint('= {} completed in a previous run. Skipping'.format(
+                name.replace('_', ' ').capitalize()
+            ), 'cyan')
+            with run_report.span(name, skipped=True):
+                return False
+        self.checkpoints.resuming = False
+        with run_report.span(name, function=fn.__qualname__):
+            await fn(*args)
+        self.checkpoints.complete(name, inputs)
+        return True
+
+    async def historical_inputs(self) -> dict:
+        """Settings and source files the historical table is built from"""
+        s = self.settings
+        return {
+            'file_location': s['file_location'].value,
+            'file_path': s['file_path'].value,
+            'bucket': self.s.unwrap('storage_bucket'),
+            'locale': s.custom['locale'],
+            'columns': {
+                k: v.default for k, v in s.custom['historical_map'].items()
+            },
+            'files': await self.historical_files(),
+        }
+
+    async def historical_files(self) -> list:
+        """Names with generations (GCS) or sizes and mtimes (local files)"""
+        file_path = self.settings['file_path'].value
+        if self.settings['file_location'].value == 'GCS Bucket':
+            return await async_runner.call('storage', lambda: sorted(
+                (b.name, b.generation)
+                for b in self.bucket.list_blobs(prefix=file_path)
+            ))
+        if os.path.isfile(file_path):
+            paths = [file_path]
+        else:
+            paths = [
+                os.path.join(root, name)
+                for root, _, names in os.walk(file_path) for name in names
+            ]
+        files = []
+        for path in sorted(paths):
+            stat = os.stat(path)
+            files.append((path, stat.st_size, stat.st_mtime_ns))
+        return files
+
+    def view_inputs(self) -> dict:
+        """Settings the views are generated from, and the view code"""
+        import views
+
+        ignored = {'interactive', 'fresh_run', 'overwrite_storage_csv',
+                   'settings_file', 'max_memory_mb', 'stream_gcs_reads',
+                   'upload_part_mb', 'upload_concurrency',
+                   'direct_load_max_mb', 'compress_output', 'scratch_dir',
+                   'rollup_lookback_days'}
+        with open(views.__file__, 'rb') as fh:
+            source = fh.read()
+        return {
+            'settings': {
+                k: s.value for k, s in self.settings.flattened_args.items()
+                if k not in ignored
+            },
+            'views': Checkpoints.fingerprint(source.decode('utf-8')),
+        }
+
+    async def load_service(self, project):
+        from googleapiclient.errors import HttpError
+
+        async def create_service_account(project_id, name, display_name):
+            service = clients.get_registry().iam()
 
-    def load_service(self, project):
-        def create_service_account(project_id, name, display_name):
-            service = discovery.build('iam', 'v1')
-
-            my_service_account = service.projects().serviceAccounts().create(
-                name='projects/' + project_id,
-                body={
-                    'accountId': name,
-                    'serviceAccount': {
-                        'displayName': display_name
-                    }
-                }).execute()
-            key = service.projects().serviceAccounts().keys().create(
-                name='projects/-/serviceAccounts/' + my_service_account['email'], body={}
-            ).execute()
+            my_service_account = await async_runner.call(
+                'iam', service.projects().serviceAccounts().create(
+                    name='projects/' + project_id,
+                    body={
+                        'accountId': name,
+                        'serviceAccount': {
+                            'displayName': display_name
+                        }
+                    }).execute,
+                idempotent=False,
+            )
+            key = await async_runner.call(
+                'iam', service.projects().serviceAccounts().keys().create(
+                    name='projects/-/serviceAccounts/' + my_service_account['email'], body={}
+                ).execute,
+                idempotent=False,
+            )
             cprint('Created service account: ' + my_service_account['email'])
             return my_service_account
 
         try:
-            create_service_account(
+            await create_service_account(
                 project, 
                 'bq-bootstrapper', 
                 'BigQuery Bootstrapper Service Account'
@@ -141,42 +531,61 @@ class Bootstrap:
         except HttpError:
             return
 
-    def load_datasets(self, client, project):
+    async def load_datasets(self, client, project):
+        from google.cloud.bigquery.dataset import Dataset
+
         for k, v in (('raw', 'raw_dataset'), ('views', 'view_dataset')):
-            dataset = self.settings[v].value
-            dataset = Dataset.from_string('{0}.{1}'.format(project, dataset))
-            try:
-                setattr(DataSets, k, client.get_dataset(dataset))
-                cprint('Already have dataset {}'.format(dataset), 'green')
-            except NotFound:
-                setattr(DataSets, k, client.create_dataset(dataset))
-                cprint('Created dataset {}'.format(dataset), 'green')
+            dataset_id = '{0}.{1}'.format(project, self.settings[v].value)
+            dataset = await async_runner.offload(
+                self.settings.hooks.prefetch.get,
+                'dataset:' + dataset_id,
+                prefetch.get_dataset, client, dataset_id,
+                missing=lambda d: d is None,
+            )
+            if dataset is not None:
+                setattr(self.datasets, k, dataset)
+                cprint('Already have dataset {}'.format(dataset_id), 'green')
+            else:
+                setattr(self.datasets, k, await async_runner.call(
+                    'bigquery', client.create_dataset,
+                    Dataset.from_string(dataset_id), exists_ok=True
+                ))
+                cprint('Created dataset {}'.format(dataset_id), 'green')
+
+    def use_datasets(self, project):
+        """Points the datasets at the ones created in a previous run"""
+        from google.cloud.bigquery.dataset import Dataset
+
+        for k, v in (('raw', 'raw_dataset'), ('views', 'view_dataset')):
+            setattr(self.datasets, k, Dataset.from_string(
+                '{0}.{1}'.format(project, self.settings[v].value)
+            ))
 
-    def wait_for_transfer(self, client, config, wait_for_all=False):
+    async def wait_for_transfer(self, client, config, wait_for_all=False):
         sys.stdout.write(colored('Waiting for transfers to succeed. This might take a while.', 'red'))
         sys.stdout.flush()
-        success = bigquery_datatransfer.enums.TransferState.SUCCEEDED
-        while True:
-            ts = [t for t in client.list_transfer_runs(config.name)]
-            transfers_complete = wait_for_all
-            for t in ts:
-                if not wait_for_all and t.state == success.value:
-                    transfers_complete = True
-                    return
+        success = clients.transfer_states().SUCCEEDED
+        with run_report.span('wait_for_transfer', config=config.name):
+            await self.poll_transfer(client, config, success, wait_for_all)
 
-                if t.state != success.value:
-                    transfers_complete = False
-                else:
-                    continue
-                if not transfers_complete:
-                    sys.stdout.write('.')
-                    sys.stdout.flush()
-                    time.sleep(10)
-            if transfers_complete: 
+    async def poll_transfer(self, client, config, success, wait_for_all):
+        while True:
+            ts = await async_runner.call(
+                'transfer', lambda: list(client.list_transfer_runs(config.name))
+            )
+            states = [t.state == success.value for t in ts]
+            if not wait_for_all and any(states):
+                return
+            if wait_for_all and all(states):
                 cprint('\nDone', 'green')
                 return
+            sys.stdout.write('.')
+            sys.stdout.flush()
+            # waits on the event loop, so other advertisers keep running
+            await asyncio.sleep(TRANSFER_POLL_SECONDS)
 
-    def load_transfers(self, cli: bigquery.Client, project: str, advertiser):
+    async def load_transfers(self, cli: 'bigquery.Client', project: str,
+                             advertiser):
         """
         Bootstrap step to create BigQuery data transfers.
 
@@ -185,7 +594,9 @@ class Bootstrap:
         :param advertiser: Numeric value of an SA360 advertiser
         :return: The result of the client transfer configuration.
         """
-        client = bigquery_datatransfer.DataTransferServiceClient()
+        from google.protobuf.struct_pb2 import Struct
+
+        client = clients.get_registry().transfer()
         location = self.s.unwrap('location')
         project = self.s.unwrap('gcp_project_name')
         data_source = 'doubleclick_search'
@@ -193,21 +604,29 @@ class Bootstrap:
         parent = client.location_path(project, location)
         params = Struct()
         display_name= 'SA360 Transfer {}'.format(advertiser)
-        config = Bootstrap.config_exists(client, parent, display_name)
+        configs = await async_runner.offload(
+            self.settings.hooks.prefetch.get,
+            'transfer_configs:{}/{}'.format(project, location),
+            prefetch.list_transfer_configs, project, location,
+            missing=lambda c: Bootstrap.config_exists(
+                c, display_name
+            ) is None,
+        )
+        config = Bootstrap.config_exists(configs, display_name)
         if config is not None:
             print('start transfer')
             cprint(
                 'Schedule already exists for {}. Skipping'.format(advertiser),
                 'cyan'
             )
-            self.wait_for_transfer(client, config)
+            await self.wait_for_transfer(client, config)
             return config
         params['agency_id'] = str(self.s.unwrap('agency_id'))
         params['advertiser_id'] = str(advertiser)
         params['include_removed_entities'] = False
         config = {
             'display_name': display_name,
-            'destination_dataset_id': DataSets.raw.dataset_id,
+            'destination_dataset_id': self.datasets.raw.dataset_id,
             'data_source_id': SystemSettings.SERVICE_NAME,
             'schedule': 'every day {}'.format(
                 datetime.strftime(datetime.now(), '%H:%M')
@@ -216,16 +635,19 @@ class Bootstrap:
             'disabled': False,
         }
 
-        result = client.create_transfer_config(parent, config)
+        result = await async_runner.call(
+            'transfer', client.create_transfer_config, parent, config,
+            idempotent=False,
+        )
         cprint(
             'Created schedule for {}'.format(advertiser),
             'cyan',
             attrs=['bold']
         )
-        self.wait_for_transfer(client, result)
+        await self.wait_for_transfer(client, result)
         return result
 
-    def combine_folder(self, delete=False) -> Blob:
+    def combine_folder(self) -> Union['Blob', str]:
         """
         Prepares and creates a GCS blob from a folder with multiple files.
 
@@ -233,9 +655,19 @@ class Bootstrap:
         - Converts Excel
         - Reads CSV, TSV, and Pipe Delimited file
 
-        :param delete: boolean - If set to True, removes original files
-        :return: A GCS blob to upload
+        Files uploaded to Cloud Shell that are no larger than
+        direct_load_max_mb are not uploaded to GCS; BigQuery loads them
+        straight from the local file.
+
+        Downloads and decoded output are stored under the advertiser's
+        scratch directory.
+
+        :return: The uploaded GCS blob, or the path of the local file to
+            load directly. The caller removes the local file.
         """
+        from csv_decoder import Decoder
+        from csv_decoder import Source
+
         file_path = self.settings['file_path']
         dest_filename = file_path.value
         setting: SettingOption[app_settings.AppSettings] = file_path
@@ -244,26 +676,51 @@ class Bootstrap:
         file_location = s['file_location'].value
         bucket = self.bucket
         dict_map = {v: k for v, k in s.custom['historical_map'].items()}
+
+        def download(blob, fh):
+            # a retry starts over with an empty file
+            fh.seek(0)
+            fh.truncate()
+            blob.download_to_file(fh, storage_cli)
+            run_report.add('gcs.bytes_down', fh.tell())
+
+        downloads = None
+
+        def open_blob(blob):
+            return CountingReader(api_calls.call(
+                'storage', blob.open, 'rb', chunk_size=STREAM_CHUNK_BYTES
+            ), 'gcs.bytes_down')
+
         if file_location == 'GCS Bucket':
             file = bucket.blob(dest_filename)
-            path = dirname = self.path
-            if os.path.exists(path) and delete:
-                shutil.rmtree(path)
-            if not os.path.exists(path):
-                os.mkdir(path)
-            if not file.exists():
-                files = list(bucket.list_blobs(prefix=dest_filename))
+            if not api_calls.call('storage', file.exists):
+                files = api_calls.call(
+                    'storage',
+                    lambda: list(bucket.list_blobs(prefix=dest_filename))
+                )
             else:
                 files = [file]
-            for file in files:
-                file_parts = file.name.split('/')
-                if file_parts[-1] == '':
-                    continue
-                with open(dirname + file_parts[-1], 'w+b') as fh:
-                    file.download_to_file(fh, storage_cli)
+            # skip folder placeholders
+            files = [f for f in files if not f.name.endswith('/')]
+            if s['stream_gcs_reads'].value:
+                # CSVs are decoded as they are read, other formats are
+                # spooled to disk by the decoder
+                path = [
+                    Source(f.name, functools.partial(open_blob, f))
+                    for f in files
+                ]
+                run_report.add('gcs.files_streamed', len(files))
+            else:
+                path = downloads = tempfile.mkdtemp(prefix='in-upload-',
+                                                    dir=self.scratch)
+                for file in files:
+                    with open(os.path.join(path, file.name.split('/')[-1]),
+                              'w+b') as fh:
+                        api_calls.call('storage', download, file, fh)
         else:
             path = dest_filename
-        dest_filename = 'sa360-bq-{}.csv'.format(s['advertiser_id'].value)
+        dest_filename = self.output_name(s['advertiser_id'].value)
+        budget = MemoryBudget(s['max_memory_mb'].value)
         with Decoder(
             desired_encoding='utf-8',
             locale=s.custom['locale'],
@@ -271,31 +728,99 @@ class Bootstrap:
             path=path,
             out_type=Decoder.SINGLE_FILE,
             dict_map=dict_map,
+            budget=budget,
+            compress=s['compress_output'].value,
+            scratch=self.scratch,
         ) as decoder:
             result_dir = decoder.run()
-            dest_blob = bucket.blob(dest_filename)
-            dest_blob.upload_from_filename(result_dir)
+            if downloads is not None:
+                shutil.rmtree(downloads)
+            run_report.annotate(
+                memory_high_water_mb=budget.high_water // 2 ** 20,
+                memory_limit_mb=budget.limit // 2 ** 20,
+            )
+            run_report.add('rows_decoded', decoder.rows_opened)
+            direct_load_bytes = s['direct_load_max_mb'].value * 2 ** 20
+            if (file_location
+                    == app_settings.FileLocationOptions.CLOUD_SHELL.value
+                    and os.path.getsize(result_dir) <= direct_load_bytes):
+                # keep the file past the decoder, which removes its output
+                local = os.path.join(self.scratch, dest_filename)
+                os.replace(result_dir, local)
+                return local
+            dest_blob = uploads.upload(
+                bucket, dest_filename, result_dir,
+                s['upload_part_mb'].value * 2 ** 20,
+                s['upload_concurrency'].value,
+            )
+            run_report.add('gcs.bytes_up', os.path.getsize(result_dir))
             return dest_blob
 
-    def schema(self):
+    def output_name(self, advertiser) -> str:
+        """Name of the decoded historical file, on disk and in GCS"""
+        name = 'sa360-bq-{}.csv'.format(advertiser)
+        return name + '.gz' if self.s.unwrap('compress_output') else name
+
+    def decode_historical(self, advertiser) -> Union['Blob', str]:
+        """combine_folder, profiled when run with --profile=decode"""
+        with profiling.session('decode', 'decode-{}'.format(advertiser)):
+            return self.combine_folder()
+
+    async def uploaded(self, blob: 'Blob') -> bool:
+        """
+        Whether blob holds the upload of the current historical files.
+
+        Blobs uploaded before checkpoints were recorded are reused as is.
+        """
+        from google.api_core.exceptions import NotFound
+
+        try:
+            await async_runner.call('storage', blob.reload)
+        except NotFound:
+            return False
+        if 'upload' not in self.checkpoints.stages:
+            return True
+        return (
+            self.checkpoints.matches('upload', self.historical)
+            and blob.generation
+            == self.checkpoints.outputs('upload').get('generation')
+        )
+
+    def schema(self, columns: List[SettingOption] = None):
+        """
+        :param columns: The historical column settings. Defaults to the
+            columns mapped for this advertiser.
+        """
+        from google.cloud import bigquery
+
         schemas = []
         type_map = {
-            np.object: 'STRING',
-            np.datetime64: 'DATE',
-            np.int64: 'INT64',
-            np.float64: 'FLOAT64',
+            'object': 'STRING',
+            'datetime64': 'DATE',
+            'int64': 'INT64',
+            'float64': 'FLOAT64',
         }
-        historical_map: Dict[str, SettingOption] = self.settings.custom['historical_map']
-        for setting in historical_map.values():
+        if columns is None:
+            historical_map: Dict[str, SettingOption] = self.settings.custom['historical_map']
+            columns = list(historical_map.values())
+        for setting in columns:
             schemas.append(bigquery.SchemaField(
                 setting.default,
                 type_map.get(setting.attrs['dtype'])
             ))
+        if has_fingerprint([s.default for s in columns]):
+            schemas.append(bigquery.SchemaField(FINGERPRINT_COLUMN, 'INT64'))
         return schemas
 
-    def load_historical_tables(self, client, project, advertiser):
+    async def load_historical_tables(self, client, project, advertiser):
+        from google.api_core.exceptions import BadRequest
+        from google.api_core.exceptions import Conflict
+        from google.api_core.exceptions import NotFound
+        from google.cloud import bigquery
+        from prompt_toolkit import prompt
+
         s = self.settings
-        dataset_ref: bigquery.dataset.Dataset = DataSets.raw
+        dataset_ref: bigquery.dataset.Dataset = self.datasets.raw
         dataset: str = dataset_ref.dataset_id
         table_name = get_view_name(ViewTypes.HISTORICAL, advertiser)
         full_table_name = '{}.{}.{}'.format(
@@ -305,8 +830,10 @@ class Bootstrap:
         )
         job_config = bigquery.LoadJobConfig()
         job_config.field_delimiter = ','
-        job_config.quote = '""'
+        job_config.quote_character = '"'
         job_config.skip_leading_rows = 1
+        # replacing the table makes a retried load safe
+        job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
         delete_table = False
         job_config.schema = self.schema()
         overwrite_storage_csv: bool = self.s.unwrap('overwrite_storage_csv')
@@ -314,11 +841,21 @@ class Bootstrap:
         try:
             # if the table exists - then skip this part.
             if not self.s.unwrap('overwrite_storage_csv'):
-                client.get_table(full_table_name)
+                dataset_id = '{}.{}'.format(project, dataset)
+                table_ids = await async_runner.offload(
+                    self.settings.hooks.prefetch.get,
+                    'tables:' + dataset_id,
+                    prefetch.list_table_ids, client, dataset_id,
+                    missing=lambda ids: table_name not in ids,
+                )
+                if table_name not in table_ids:
+                    raise NotFound(full_table_name)
                 if self.s.unwrap('interactive'):
                     while True:
-                        res = prompt('Table {} exists. '.format(full_table_name)
-                                     + 'Replace with new data? [y/N] ')
+                        res = await async_runner.offload(
+                            prompt, 'Table {} exists. '.format(full_table_name)
+                            + 'Replace with new data? [y/N] '
+                        )
                         if res.lower() == 'y' or res == '1':
                             delete_table = True
                             overwrite_storage_csv = True
@@ -340,20 +877,44 @@ class Bootstrap:
         try:
             if not delete_table:
                 table = dataset_ref.table(table_name)
-                blob = self.bucket.blob('sa360-bq-{}.csv'.format(advertiser))
-            if delete_table or not blob.exists():
-                blob = self.combine_folder(delete=delete_table)
-            uri = 'gs://{}/{}'.format(
-                self.s.unwrap('storage_bucket'),
-                blob.name
-            )
+                blob = self.bucket.blob(self.output_name(advertiser))
+            local = None
+            if delete_table or not await self.uploaded(blob):
+                async with self.decode_lock:
+                    with run_report.span('combine_folder'):
+                        blob = await async_runner.offload(
+                            self.decode_historical, advertiser
+                        )
+                if isinstance(blob, str):
+                    local = blob
+                else:
+                    self.checkpoints.complete(
+                        'upload', self.historical,
+                        {'generation': blob.generation}
+                    )
             if delete_table:
-                client.delete_table(full_table_name, not_found_ok=True)
+                await async_runner.call('bigquery', client.delete_table,
+                                        full_table_name, not_found_ok=True)
                 table = dataset_ref.table(table_name)
-            load_job = client.load_table_from_uri(
-                uri, table, job_config=job_config
-            )
-            result = load_job.result()
+            if local is not None:
+                try:
+                    result = await async_runner.run_job(
+                        lambda: self.load_local_file(
+                            client, local, table, job_config
+                        )
+                    )
+                finally:
+                    os.remove(local)
+            else:
+                uri = 'gs://{}/{}'.format(
+                    self.s.unwrap('storage_bucket'),
+                    blob.name
+                )
+                result = await async_runner.run_job(
+                    lambda: client.load_table_from_uri(
+                        uri, table, job_config=job_config
+                    )
+                )
             logging.info("Job result: %s", result)
             cprint(
                 'Created table {}'.format(full_table_name),
@@ -375,13 +936,136 @@ class Bootstrap:
             else:
                 cprint(str(err), 'red', attrs=['bold'])
             logging.info(traceback.format_exc())
-            exit(1)
+            raise BootstrapperError(
+                'Could not load {}'.format(full_table_name)
+            ) from err
+
+    @staticmethod
+    def load_local_file(client, path: str, table, job_config):
+        """Starts a load job that streams the local file to BigQuery in a
+        resumable upload. A retry uploads the file again."""
+        size = os.path.getsize(path)
+        with open(path, 'rb') as fh:
+            job = client.load_table_from_file(
+                fh, table, job_config=job_config, size=size
+            )
+        run_report.add('bigquery.bytes_uploaded', size)
+        return job
+
+    async def agency_historical_table(self, client, table_ref,
+                                      device_segment: bool):
+        """
+        Creates the agency historical table, or adds the columns it lacks.
+
+        The table has every historical column, whichever columns each
+        advertiser maps, plus advertiser_id and the advertiser's
+        first_date_conversions. It is partitioned by date and clustered by
+        advertiser_id. The has_device_segment label records that an
+        advertiser of the agency has a device segment.
+        """
+        from google.cloud import bigquery
+
+        schema = self.schema(list(self.settings.columns.values())) + [
+            bigquery.SchemaField('advertiser_id', 'STRING'),
+            bigquery.SchemaField('first_date_conversions', 'DATE'),
+        ]
+        table = bigquery.Table(table_ref, schema=schema)
+        table.time_partitioning = bigquery.TimePartitioning(field='date')
+        table.clustering_fields = ['advertiser_id']
+        if device_segment:
+            table.labels = {'has_device_segment': 'true'}
+        table = await async_runner.call('bigquery', client.create_table,
+                                        table, exists_ok=True)
+        names = {field.name for field in table.schema}
+        missing = [field for field in schema if field.name not in names]
+        fields = ['schema'] if missing else []
+        if missing:
+            table.schema = list(table.schema) + missing
+        if device_segment and 'has_device_segment' not in table.labels:
+            table.labels = {'has_device_segment': 'true'}
+            fields.append('labels')
+        if fields:
+            await async_runner.call('bigquery', client.update_table, table,
+                                    fields)
+        return table
+
+    async def load_agency_historical_table(self, client, project,
+                                           advertiser):
+        """
+        Copies the advertiser's historical table into the agency-wide table
+        created by agency_historical_table.
+
+        Rows for the advertiser are replaced, so re-running does not
+        duplicate data. Tables loaded before the fingerprint column existed
+        get their fingerprints computed, as the agency views only join on
+        the fingerprint.
+
+        :param client: BigQuery client instance
+        :param project: Name of the project
+        :param advertiser: Numeric value of an SA360 advertiser
+        """
+        from google.cloud import bigquery
+        from views import iso_date
+
+        dataset_ref: bigquery.dataset.Dataset = self.datasets.raw
+        agency = str(self.s.unwrap('agency_id'))
+        table_name = get_view_name(ViewTypes.AGENCY_HISTORICAL, agency)
+        source = await async_runner.call(
+            'bigquery', client.get_table,
+            dataset_ref.table(get_view_name(ViewTypes.HISTORICAL, advertiser))
+        )
+        names = [field.name for field in source.schema]
+        values = names
+        if FINGERPRINT_COLUMN not in names:
+            if not has_fingerprint(names):
+                raise BootstrapperError(
+                    'Cannot add {} to the agency views: it has no keyword '
+                    'fingerprints and lacks the columns to compute them. '
+                    'Reload it with --overwrite_storage_csv.'.format(
+                        source.table_id
+                    )
+                )
+            names = names + [FINGERPRINT_COLUMN]
+            values = values + [join_fingerprint_sql(
+                *FINGERPRINT_SOURCE_COLUMNS
+            )]
+        full_table_name = '{}.{}.{}'.format(
+            project, dataset_ref.dataset_id, table_name
+        )
+        first_date = self.s.unwrap('first_date_conversions')
+        job_config = bigquery.QueryJobConfig()
+        job_config.query_parameters = [
+            bigquery.ScalarQueryParameter('advertiser_id', 'STRING', advertiser),
+            bigquery.ScalarQueryParameter(
+                'first_date', 'DATE', iso_date(first_date) if first_date
+                else None
+            ),
+        ]
+        script = '''DELETE FROM `{table}` WHERE advertiser_id = @advertiser_id;
+            INSERT INTO `{table}` ({columns}, advertiser_id,
+                first_date_conversions)
+            SELECT {values}, @advertiser_id, @first_date
+            FROM `{project}.{dataset}.{source}`'''.format(
+            table=full_table_name,
+            columns=', '.join(names),
+            values=', '.join(values),
+            project=project,
+            dataset=dataset_ref.dataset_id,
+            source=source.table_id,
+        )
+        # deleting first makes the script safe to retry
+        await async_runner.run_job(
+            lambda: client.query(script, job_config=job_config)
+        )
+        cprint('= merged {} into {}'.format(
+            source.table_id, full_table_name
+        ), 'green')
 
     @staticmethod
-    def config_exists(client, parent, display_name):
+    def config_exists(configs, display_name):
         configs = {
             l.display_name: l
-            for l in client.list_transfer_configs(parent)
+            for l in configs
             if l.data_source_id == SystemSettings.SERVICE_NAME
         }
         if display_name in configs:
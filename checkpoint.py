@@ -0,0 +1,103 @@
+# /***********************************************************************
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Note that these code samples being shared are not official Google
+# products and are not formally supported.
+# ************************************************************************/
+
+"""
+Records completed bootstrap stages so a rerun resumes where the last one
+stopped.
+
+Each stage is stored with a fingerprint of its inputs. A stage is skipped
+only if it and every stage before it completed with the same inputs, so a
+rerun jumps straight to the first incomplete or invalidated stage.
+"""
+import hashlib
+import json
+import os
+import time
+
+from flagmaker.cache import atomic_write
+
+CHECKPOINT_DIR = '{}/.sa360bq-checkpoints'.format(os.environ['HOME'])
+
+
+class Checkpoints(object):
+    VERSION = 1
+
+    def __init__(self, project: str, advertiser: str,
+                 directory: str = CHECKPOINT_DIR, fresh: bool = False):
+        self.path = os.path.join(
+            directory, '{}.{}.json'.format(project, advertiser)
+        )
+        self.stages = {}
+        # cleared by the first stage that has to run
+        self.resuming = not fresh
+        if not fresh:
+            self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as fh:
+                data = json.load(fh)
+        except ValueError:
+            return
+        if isinstance(data, dict) and data.get('version') == self.VERSION:
+            self.stages = data.get('stages') or {}
+
+    @staticmethod
+    def fingerprint(inputs) -> str:
+        return hashlib.sha256(
+            json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')
+        ).hexdigest()
+
+    def matches(self, stage: str, inputs) -> bool:
+        """Whether stage last completed with the same inputs"""
+        record = self.stages.get(stage)
+        return (
+            record is not None
+            and record['fingerprint'] == self.fingerprint(inputs)
+        )
+
+    def done(self, stage: str, inputs) -> bool:
+        """Whether stage can be skipped.
+
+        Once a stage has to run, every later stage runs as well.
+        """
+        self.resuming = self.resuming and self.matches(stage, inputs)
+        return self.resuming
+
+    def outputs(self, stage: str) -> dict:
+        record = self.stages.get(stage)
+        return record['outputs'] if record is not None else {}
+
+    def complete(self, stage: str, inputs, outputs: dict = None):
+        self.stages[stage] = {
+            'fingerprint': self.fingerprint(inputs),
+            'completed': time.time(),
+            'outputs': outputs or {},
+        }
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        atomic_write(self.path, json.dumps(
+            {'version': self.VERSION, 'stages': self.stages},
+            default=str,
+            separators=(',', ':'),
+        ))
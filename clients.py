@@ -0,0 +1,152 @@
+# /***********************************************************************
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Note that these code samples being shared are not official Google
+# products and are not formally supported.
+# ************************************************************************/
+
+"""
+Shared Google Cloud clients.
+
+Each client is created once and reused, so authentication, TLS handshakes
+and discovery document fetches are not repeated for every advertiser.
+BigQuery and Storage share one HTTP session whose connection pool is sized
+for concurrent use.
+"""
+import threading
+from typing import Dict
+
+DEFAULT_POOL_SIZE = 32
+SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+
+
+class DiscoveryCache(object):
+    """In-process cache for discovery documents (googleapiclient's
+    discovery_cache interface)."""
+    _documents: Dict[str, str] = {}
+
+    def get(self, url):
+        return self._documents.get(url)
+
+    def set(self, url, content):
+        self._documents[url] = content
+
+
+class ClientRegistry(object):
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE):
+        self.pool_size = pool_size
+        self._clients = {}
+        self._lock = threading.RLock()
+
+    def _get(self, key: tuple, factory: callable):
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = factory()
+            return self._clients[key]
+
+    def credentials(self):
+        def create():
+            import google.auth
+
+            credentials, _ = google.auth.default(scopes=SCOPES)
+            return credentials
+        return self._get(('credentials',), create)
+
+    def http(self):
+        """An authorized requests session with a pool of pool_size
+        connections per host."""
+        def create():
+            from google.auth.transport.requests import AuthorizedSession
+            from requests.adapters import HTTPAdapter
+
+            session = AuthorizedSession(self.credentials())
+            adapter = HTTPAdapter(
+                pool_connections=self.pool_size,
+                pool_maxsize=self.pool_size,
+            )
+            session.mount('https://', adapter)
+            return session
+        return self._get(('http',), create)
+
+    def bigquery(self, project: str, location: str = 'US'):
+        def create():
+            from google.cloud import bigquery
+
+            return bigquery.Client(
+                project=project,
+                location=location,
+                credentials=self.credentials(),
+                _http=self.http(),
+            )
+        return self._get(('bigquery', project, location), create)
+
+    def storage(self, project: str):
+        def create():
+            from google.cloud import storage
+
+            return storage.Client(
+                project=project,
+                credentials=self.credentials(),
+                _http=self.http(),
+            )
+        return self._get(('storage', project), create)
+
+    def transfer(self):
+        """Data Transfer Service client. It uses gRPC, which multiplexes
+        calls over a single channel."""
+        def create():
+            from google.cloud import bigquery_datatransfer
+
+            return bigquery_datatransfer.DataTransferServiceClient(
+                credentials=self.credentials()
+            )
+        return self._get(('transfer',), create)
+
+    def iam(self):
+        def create():
+            from googleapiclient import discovery
+
+            return discovery.build(
+                'iam', 'v1',
+                credentials=self.credentials(),
+                cache=DiscoveryCache(),
+            )
+        return self._get(('iam',), create)
+
+
+def transfer_states():
+    """TransferState of the installed Data Transfer Service library"""
+    from google.cloud import bigquery_datatransfer
+
+    # the enums module was folded into the package in 2.0
+    return getattr(
+        bigquery_datatransfer, 'enums', bigquery_datatransfer
+    ).TransferState
+
+
+_registry: ClientRegistry = None
+
+
+def get_registry() -> ClientRegistry:
+    global _registry
+    if _registry is None:
+        _registry = ClientRegistry()
+    return _registry
+
+
+def set_registry(registry: ClientRegistry):
+    """Replaces the shared registry, e.g. with a different pool size"""
+    global _registry
+    _registry = registry
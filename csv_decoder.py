@@ -24,11 +24,18 @@ Handles ZIP files.
 """
 from typing import Union
 
-import numpy as np
+import bz2
+import functools
+import gzip
+import io
+import lzma
 import os
 import shutil
+import struct
 import tarfile
+import tempfile
 import zipfile
+import zlib
 
 from termcolor import cprint
 from datetime import datetime
@@ -39,7 +46,151 @@ from xlrd import XLRDError
 
 from exceptions import ReadError
 from flagmaker.settings import SettingOption
+from memory import EXCEL_EXPANSION
+from memory import MIN_CHUNK_ROWS
+from memory import MemoryBudget
+from utilities import FINGERPRINT_COLUMN
+from utilities import FINGERPRINT_SOURCE_COLUMNS
 from utilities import Locale
+from utilities import has_fingerprint
+from utilities import join_fingerprint
+
+
+# magic bytes, module and file extensions of single-file compressions
+COMPRESSIONS = (
+    (b'\x1f\x8b', gzip, ('.gz', '.gzip')),
+    (b'BZh', bz2, ('.bz2',)),
+    (b'\xfd7zXZ\x00', lzma, ('.xz',)),
+)
+MAGIC_BYTES = 6
+# zlib's default: most of the size reduction of level 9, several times faster
+OUTPUT_COMPRESS_LEVEL = 6
+# text collected before it is compressed
+OUTPUT_BUFFER_BYTES = 2 ** 20
+# pandas' error for files that are not spreadsheets
+EXCEL_FORMAT_UNKNOWN = 'Excel file format cannot be determined'
+
+
+def detect_compression(fh):
+    """The COMPRESSIONS entry matching the start of fh, or None"""
+    head = fh.read(MAGIC_BYTES)
+    for compression in COMPRESSIONS:
+        if head.startswith(compression[0]):
+            return compression
+    return None
+
+
+class Decompressed(io.BufferedIOBase):
+    """Decompresses a stream as it is read, and closes it when closed"""
+
+    def __init__(self, module, stream):
+        super().__init__()
+        self.stream = stream
+        self.decompressed = module.open(stream, 'rb')
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self.decompressed.read(size)
+
+    def read1(self, size=-1):
+        return self.decompressed.read1(size)
+
+    def readinto(self, b):
+        return self.decompressed.readinto(b)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.decompressed.close()
+        finally:
+            self.stream.close()
+            super().close()
+
+
+class GzipOutput(object):
+    """A text file written as a single gzip member across many writes.
+
+    Not every gzip reader reads past the first member of a file, so the
+    output is one deflate stream. checkpoint() flushes the stream to a byte
+    boundary that rollback() can return to, dropping what was written in
+    between.
+    """
+
+    def __init__(self, path: str, level: int = OUTPUT_COMPRESS_LEVEL):
+        self.level = level
+        self.fh = open(path, 'wb')
+        # magic, deflate, no flags, no mtime, no extra flags, unknown OS
+        self.fh.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+        self.crc = 0
+        self.size = 0
+        self.buffer = []
+        self.buffered = 0
+        self.compressor = self.new_compressor()
+        # the state of an empty file, for rollback()
+        self.start = (self.fh.tell(), 0, 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def new_compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+
+    def write(self, text: str):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= OUTPUT_BUFFER_BYTES:
+            self.compress()
+
+    def compress(self):
+        data = ''.join(self.buffer).encode('utf-8')
+        self.buffer = []
+        self.buffered = 0
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        self.fh.write(self.compressor.compress(data))
+
+    def checkpoint(self) -> tuple:
+        self.compress()
+        self.fh.write(self.compressor.flush(zlib.Z_FULL_FLUSH))
+        return self.fh.tell(), self.crc, self.size
+
+    def rollback(self, state: tuple):
+        offset, self.crc, self.size = state
+        self.buffer = []
+        self.buffered = 0
+        self.fh.seek(offset)
+        self.fh.truncate()
+        # nothing after a full flush refers back to earlier data
+        self.compressor = self.new_compressor()
+
+    def close(self):
+        if self.fh.closed:
+            return
+        self.compress()
+        self.fh.write(self.compressor.flush())
+        self.fh.write(struct.pack('<II', self.crc, self.size & 0xffffffff))
+        self.fh.close()
+
+
+class Source(object):
+    """A file that is read as a stream, e.g. a GCS blob"""
+
+    def __init__(self, name: str, open: callable):
+        """
+        :param name: The file name, used to recognize the format
+        :param open: Returns a new binary stream of the file
+        """
+        self.name = name
+        self.open = open
+
+    def __str__(self):
+        return self.name
 
 
 class Decoder(object):
@@ -48,7 +199,9 @@ class Decoder(object):
 
     def __init__(self, desired_encoding, path, locale: Locale,
                  dict_map: Dict[str, SettingOption], thousands=',',
-                 out_type=SINGLE_FILE, dest='out.csv', callback=None):
+                 out_type=SINGLE_FILE, dest='out.csv', callback=None,
+                 budget: MemoryBudget = None, compress: bool = False,
+                 scratch: str = None):
         self.locale = locale
         self.possible_delimiters: list = [',', '\t', '|',]
         self.first = True  # ignore headers when False
@@ -61,12 +214,13 @@ class Decoder(object):
             k = k.lower()
             self.columns.append(v.value.lower())
             self.map[k] = v.default
-            if v.attrs['dtype'] == np.datetime64:
+            if v.attrs['dtype'] == 'datetime64':
                 self.parse_dates.append(v.default)
-                self.dtypes[v.default] = np.object
+                self.dtypes[v.default] = 'object'
             else:
                 self.dtypes[v.default] = v.attrs['dtype']
 
+        self.fingerprint = has_fingerprint(self.map.values())
         self.out_type = out_type
         self.desired_encoding = desired_encoding
         self.thousands = thousands
@@ -76,6 +230,11 @@ class Decoder(object):
         self.dir = None
         self.rows_opened: int = 0
         self.callback = callback
+        self.budget = budget or MemoryBudget()
+        self.compress = compress
+        self.scratch = scratch
+        # the compressed single output file, open while decoding
+        self.output: GzipOutput = None
 
     def reorder_delimiters(self, new_start):
         self.possible_delimiters = [
@@ -90,20 +249,20 @@ class Decoder(object):
         return self._file_count
 
     def run(self):
-        self.dir = '/tmp/sa-bq-updir'
-        file = self.dir + '/' + self.dest
-        if os.path.exists(file):
-            os.remove(file)
-        if not os.path.exists(self.dir):
-            os.mkdir(self.dir)
-        Decoder.ChooseyDecoder(self, self.path).run()
+        self.dir = self.scratch_directory('sa-bq-updir-')
+        try:
+            Decoder.ChooseyDecoder(self, self.path).run()
+        finally:
+            self.close_output()
 
         if len(self.errors_found) > 0:
             cprint('The following formatting errors were found:', 'red')
             for error in self.errors_found:
                 cprint('- {}'.format(error), 'red')
             cprint('Please correct these errors and re-run.', 'red')
-            exit(1)
+            raise ReadError('{} formatting errors in {}'.format(
+                len(self.errors_found), self.path
+            ))
         return (
             self.dir
             if self.out_type != Decoder.SINGLE_FILE
@@ -116,13 +275,24 @@ class Decoder(object):
         return self
 
     def __exit__(self, type, value, traceback):
-        if os.path.exists(self.dir + '/' + self.dest):
-            os.remove(self.dir + '/' + self.dest)
-        pass
+        self.close_output()
+        if self.dir is not None:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+    def close_output(self):
+        """Completes the compressed output file"""
+        if self.output is not None:
+            self.output.close()
+            self.output = None
 
     @property
     def time(self) -> str:
-        return str(datetime.now().strftime('%Y%m%d%H%m%S%f'))
+        return str(datetime.now().strftime('%Y%m%d%H%M%S%f'))
+
+    def scratch_directory(self, prefix: str) -> str:
+        """A new directory under scratch (or the system's temporary
+        directory) that no other decoder or process uses"""
+        return tempfile.mkdtemp(prefix=prefix, dir=self.scratch)
 
     class AbstractDecoder(object):
         def __init__(self, parent: 'Decoder', path: str):
@@ -131,6 +301,12 @@ class Decoder(object):
 
     class ChooseyDecoder(AbstractDecoder):
         def run(self):
+            if isinstance(self.path, list):
+                for source in self.path:
+                    Decoder.ChooseyDecoder(self.parent, source).run()
+                return
+            if isinstance(self.path, Source):
+                return Decoder.StreamDecoder(self.parent, self.path).run()
             if os.path.isdir(self.path):
                 cprint('Decoding directory')
                 return Decoder.DirectoryDecoder(self.parent, self.path).run()
@@ -143,8 +319,70 @@ class Decoder(object):
             elif zipfile.is_zipfile(self.path):
                 cprint('Unzipping zip file')
                 return Decoder.ZipfileDecoder(self.parent, self.path).run()
-            else:
-                logging.info('Skipping ' + self.path)
+            with open(self.path, 'rb') as fh:
+                compression = detect_compression(fh)
+            if compression is not None:
+                return Decoder.CompressedDecoder(
+                    self.parent,
+                    Source(self.path, functools.partial(open, self.path, 'rb')),
+                    compression,
+                ).run()
+            logging.info('Skipping ' + self.path)
+
+    class StreamDecoder(AbstractDecoder):
+        """
+        Decodes a CSV Source as it is read. Spreadsheets and archives need
+        random access, so they are spooled to a local file first.
+        """
+        def run(self):
+            if self.path.name.endswith('.csv'):
+                cprint('Streaming {}...'.format(self.path), 'grey')
+                return Decoder.FileDecoder(self.parent, self.path).decode_csv()
+            with self.path.open() as fh:
+                compression = detect_compression(fh)
+            if compression is not None:
+                return Decoder.CompressedDecoder(
+                    self.parent, self.path, compression
+                ).run()
+            self.spool(self.path)
+
+        def spool(self, source: Source):
+            spool_directory = self.parent.scratch_directory('sa-bq-spool-')
+            try:
+                local = os.path.join(
+                    spool_directory, os.path.basename(source.name)
+                )
+                with source.open() as stream, open(local, 'wb') as fh:
+                    shutil.copyfileobj(stream, fh)
+                Decoder.ChooseyDecoder(self.parent, local).run()
+            finally:
+                shutil.rmtree(spool_directory)
+
+    class CompressedDecoder(StreamDecoder):
+        """
+        Decodes a gzip, bzip2 or xz compressed Source. Compressed CSVs are
+        decompressed as they are read, so no uncompressed copy is stored.
+        Spreadsheets and archives are decompressed to a temporary file.
+        """
+        RANDOM_ACCESS = ('.tar', '.zip', '.xls', '.xlsx')
+
+        def __init__(self, parent: 'Decoder', path: Source, compression):
+            super().__init__(parent, path)
+            self.module = compression[1]
+            self.name = path.name
+            for extension in compression[2]:
+                if self.name.endswith(extension):
+                    self.name = self.name[:-len(extension)]
+                    break
+
+        def run(self):
+            source = Source(self.name, lambda: Decompressed(
+                self.module, self.path.open()
+            ))
+            if self.name.endswith(self.RANDOM_ACCESS):
+                return self.spool(source)
+            cprint('Decompressing {}...'.format(self.path), 'grey')
+            return Decoder.FileDecoder(self.parent, source).decode_csv()
 
     class DirectoryDecoder(AbstractDecoder):
         def run(self):
@@ -158,15 +396,22 @@ class Decoder(object):
         def run(self):
             try:
                 self.decode_excel()
-            except XLRDError as err:
+            except XLRDError:
+                self.decode_csv()
+            except ValueError as err:
+                # newer pandas raises ValueError for files that are not
+                # spreadsheets; anything else is a broken spreadsheet
+                if EXCEL_FORMAT_UNKNOWN not in str(err):
+                    raise
                 self.decode_csv()
-                return
 
         def read(
             self,
             method: Union[pd.read_csv, pd.read_excel],
             path, dtype, **kwargs
         ) -> pd.DataFrame:
+            if method is not pd.read_csv:
+                return self._read(method, path, dtype, **kwargs)
             i = 0
             for i in range(len(self.parent.possible_delimiters)):
                 sep = self.parent.possible_delimiters[i]
@@ -206,7 +451,11 @@ class Decoder(object):
                 return rn
             nrows = kwargs.get('nrows', 0)
             kwargs['nrows'] = 0
-            hdf: pd.DataFrame = method(path, **kwargs)
+            if isinstance(path, Source):
+                with path.open() as fh:
+                    hdf: pd.DataFrame = method(fh, **kwargs)
+            else:
+                hdf: pd.DataFrame = method(path, **kwargs)
             logging.debug('Checking path %s', path)
             logging.debug('Headers: %s', list(hdf))
             try:
@@ -224,17 +473,84 @@ class Decoder(object):
                 if nrows > 0:
                     kwargs['nrows'] = nrows
                 if len(self.parent.errors_found) == 0:
+                    if method is pd.read_csv:
+                        return self.read_chunks(path, dtype, headers, kwargs)
                     df = method(path, dtype=dtype, names=headers, **kwargs)
-                    arguments = {
-                        'dayfirst': self.parent.locale != Locale.US,
-                    }
-                    df['date'] = pd.to_datetime(df['date'], **arguments)
-                    return df
+                    return self.convert_dates(df)
                 return pd.DataFrame()
             except KeyError as err:
                 raise ReadError(err)
 
+        def convert_dates(self, df: pd.DataFrame) -> pd.DataFrame:
+            arguments = {
+                'dayfirst': self.parent.locale != Locale.US,
+            }
+            df['date'] = pd.to_datetime(df['date'], **arguments)
+            return df
+
+        def read_chunks(self, path, dtype, headers, kwargs):
+            """
+            Reads a CSV in chunks sized to fit the memory budget.
+
+            The first chunk is read right away, so column and delimiter
+            errors are raised here. Every later chunk is sized from the
+            memory the first one took and the remaining headroom, and is
+            halved whenever memory runs short.
+            """
+            budget = self.parent.budget
+            stream = path.open() if isinstance(path, Source) else None
+            try:
+                reader = pd.read_csv(
+                    stream or path, dtype=dtype, names=headers,
+                    iterator=True, **kwargs
+                )
+            except BaseException:
+                if stream is not None:
+                    stream.close()
+                raise
+
+            def close():
+                reader.close()
+                if stream is not None:
+                    stream.close()
+            try:
+                first = self.convert_dates(reader.get_chunk(MIN_CHUNK_ROWS))
+            except BaseException:
+                close()
+                raise
+            row_bytes = (
+                first.memory_usage(deep=True).sum() / max(1, len(first.index))
+            )
+
+            def chunks():
+                try:
+                    yield first
+                    while True:
+                        budget.relieve()
+                        try:
+                            chunk = reader.get_chunk(budget.rows_for(row_bytes))
+                        except StopIteration:
+                            return
+                        yield self.convert_dates(chunk)
+                finally:
+                    close()
+            return chunks()
+
         def decode_excel(self):
+            if self.path.endswith(('.xls', '.xlsx')) and not (
+                self.parent.budget.fits(
+                    os.path.getsize(self.path) * EXCEL_EXPANSION
+                )
+            ):
+                # spreadsheets are read at once; fail cleanly instead of
+                # being killed for running out of memory
+                self.parent.errors_found.append(
+                    '{} is too large to decode within {} MiB. Save it as '
+                    'CSV, or raise --max_memory_mb.'.format(
+                        self.path, self.parent.budget.limit // 2 ** 20
+                    )
+                )
+                return pd.DataFrame()
             df: pd.DataFrame = self.read(
                 pd.read_excel,
                 self.path,
@@ -247,8 +563,9 @@ class Decoder(object):
 
         def decode_csv(self):
             for encoding in ['utf-8', 'utf-16', 'latin-1']:
+                written = self.output_state()
                 try:
-                    df = self.read(
+                    chunks = self.read(
                         pd.read_csv,
                         self.path,
                         encoding=encoding,
@@ -256,11 +573,15 @@ class Decoder(object):
                         thousands=self.parent.thousands,
                     )
                     if len(self.parent.errors_found) == 0:
-                        self.write(df)
+                        for i, df in enumerate(chunks):
+                            self.write(df, announce=i == 0)
                         logging.info('Decoded %s from %s',
-                                     self.path.replace('//', '/'), encoding)
+                                     str(self.path).replace('//', '/'),
+                                     encoding)
                     break
                 except (UnicodeDecodeError, UnicodeError):
+                    # a later chunk may fail after earlier ones were written
+                    self.restore_output(written)
                     if encoding == 'latin-1':
                         raise
                     logging.info(
@@ -269,7 +590,29 @@ class Decoder(object):
                         encoding
                     )
 
-        def write(self, df: pd.DataFrame):
+        def output_state(self) -> tuple:
+            out = '{}/{}'.format(self.parent.dir, self.parent.dest)
+            if self.parent.output is not None:
+                position = self.parent.output.checkpoint()
+            else:
+                position = os.path.getsize(out) if os.path.exists(out) else 0
+            return position, self.parent.first, self.parent.rows_opened
+
+        def restore_output(self, state: tuple):
+            """Drops rows written since output_state() (single file only)"""
+            if self.parent.out_type != Decoder.SINGLE_FILE:
+                return
+            position, self.parent.first, self.parent.rows_opened = state
+            out = '{}/{}'.format(self.parent.dir, self.parent.dest)
+            if isinstance(position, tuple):
+                self.parent.output.rollback(position)
+            elif self.parent.output is not None:
+                # the output was opened after the state was taken
+                self.parent.output.rollback(self.parent.output.start)
+            elif os.path.exists(out):
+                os.truncate(out, position)
+
+        def write(self, df: pd.DataFrame, announce: bool = True):
             doing_single_file = self.parent.out_type == Decoder.SINGLE_FILE
             if doing_single_file:
                 write_method = 'a'
@@ -280,18 +623,37 @@ class Decoder(object):
                 include_headers = True
                 write_method = 'w'
             self.parent.rows_opened += len(df.index)
-            cprint(
-                '+ Stored a file {}'.format(self.parent.filename), 
-                'green'
-            )
-            df.to_csv(
-                '{}/{}'.format(self.parent.dir, self.parent.filename),
+            columns = list(self.parent.map.values())
+            if self.parent.fingerprint:
+                df[FINGERPRINT_COLUMN] = pd.array([
+                    join_fingerprint(*values)
+                    for values in zip(
+                        *(df[c] for c in FINGERPRINT_SOURCE_COLUMNS)
+                    )
+                ], dtype='Int64')
+                columns.append(FINGERPRINT_COLUMN)
+            if announce:
+                cprint(
+                    '+ Stored a file {}'.format(self.parent.filename),
+                    'green'
+                )
+            path = '{}/{}'.format(self.parent.dir, self.parent.filename)
+            kwargs = dict(
                 index=False,
                 header=include_headers,
-                mode=write_method,
-                columns=self.parent.map.values(),
+                columns=columns,
                 date_format='%Y-%m-%d'
             )
+            if not self.parent.compress:
+                df.to_csv(path, mode=write_method, **kwargs)
+                return
+            if not doing_single_file:
+                with GzipOutput(path) as fh:
+                    df.to_csv(fh, **kwargs)
+                return
+            if self.parent.output is None:
+                self.parent.output = GzipOutput(path)
+            df.to_csv(self.parent.output, **kwargs)
 
         def decode_file(self, encoding: str, file: bytes):
             return file.decode(encoding).encode(self.parent.desired_encoding)
@@ -299,7 +661,9 @@ class Decoder(object):
     class TarfileDecoder(AbstractDecoder):
         def run(self):
             with tarfile.open(self.path) as th:
-                extraction_directory = '/tmp/tar-output-' + self.parent.time
+                extraction_directory = self.parent.scratch_directory(
+                    'tar-output-'
+                )
                 def is_within_directory(directory, target):
                     
                     abs_directory = os.path.abspath(directory)
@@ -319,16 +683,24 @@ class Decoder(object):
                     tar.extractall(path, members, numeric_owner=numeric_owner) 
                     
                 
-                safe_extract(th, extraction_directory)
-                Decoder.DirectoryDecoder(self.parent, extraction_directory).run()
-                shutil.rmtree(extraction_directory)
+                try:
+                    safe_extract(th, extraction_directory)
+                    Decoder.DirectoryDecoder(
+                        self.parent, extraction_directory
+                    ).run()
+                finally:
+                    shutil.rmtree(extraction_directory)
 
     class ZipfileDecoder(AbstractDecoder):
         def run(self):
             with zipfile.ZipFile(self.path, 'r') as zh:
-                extraction_directory = '/tmp/zip-output-' + self.parent.time
-                zh.extractall(extraction_directory)
-                Decoder.DirectoryDecoder(
-                    self.parent, extraction_directory
-                ).run()
-                shutil.rmtree(extraction_directory)
+                extraction_directory = self.parent.scratch_directory(
+                    'zip-output-'
+                )
+                try:
+                    zh.extractall(extraction_directory)
+                    Decoder.DirectoryDecoder(
+                        self.parent, extraction_directory
+                    ).run()
+                finally:
+                    shutil.rmtree(extraction_directory)
@@ -0,0 +1,632 @@
+# /***********************************************************************
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Note that these code samples being shared are not official Google
+# products and are not formally supported.
+# ************************************************************************/
+
+"""
+In-process stand-ins for Cloud Storage, BigQuery, the Data Transfer
+Service and IAM, so the whole bootstrapper can run without a project.
+
+- FakeStorageClient keeps buckets as directories under a root directory.
+- FakeBigQueryClient keeps datasets and tables in memory, and records
+  every job (loads and queries, including view and function DDL).
+- FakeTransferClient reports transfer runs as succeeded once
+  transfer_latency seconds have passed since the config was created.
+
+Every call sleeps api_latency seconds to stand in for the network, which
+makes the fakes useful to benchmark concurrency and orchestration.
+
+Install them with clients.set_registry(FakeRegistry(root)), or run the
+bootstrapper against them:
+
+    python fakes.py --fake_root=/tmp/fake-gcp --settings_file=entries.yaml
+"""
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime
+from datetime import timezone
+from typing import Dict
+from typing import List
+
+from absl import flags
+
+from clients import ClientRegistry
+from clients import transfer_states
+
+flags.DEFINE_string(
+    'fake_root', None,
+    'Run against local stand-ins for Google Cloud, keeping buckets under '
+    'this directory.'
+)
+flags.DEFINE_float(
+    'fake_api_latency', 0.0,
+    'Seconds every call to the local stand-ins takes.'
+)
+flags.DEFINE_float(
+    'fake_transfer_latency', 0.0,
+    'Seconds until a new transfer config reports a successful run.'
+)
+
+
+class FakeService(object):
+    """Counts calls and simulates their latency"""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = threading.RLock()
+
+    def _call(self, name: str):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+
+class FakeBlob(object):
+    def __init__(self, bucket: 'FakeBucket', name: str):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+        self.size = None
+        self.crc32c = None
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.bucket.path, self.name)
+
+    def _stat(self):
+        from uploads import crc32c
+
+        stat = os.stat(self.path)
+        self.generation = stat.st_mtime_ns
+        self.size = stat.st_size
+        self.crc32c = crc32c(self.path)
+
+    def exists(self, client=None) -> bool:
+        self.bucket.client._call('blob.exists')
+        return os.path.isfile(self.path)
+
+    def reload(self, client=None):
+        from google.api_core.exceptions import NotFound
+
+        self.bucket.client._call('blob.reload')
+        if not os.path.isfile(self.path):
+            raise NotFound('gs://{}/{}'.format(self.bucket.name, self.name))
+        self._stat()
+
+    def open(self, mode: str = 'r', chunk_size: int = None, **kwargs):
+        self.reload()
+        return open(self.path, mode)
+
+    def download_to_file(self, fh, client=None):
+        self.reload()
+        with open(self.path, 'rb') as source:
+            shutil.copyfileobj(source, fh)
+
+    def download_to_filename(self, filename: str, client=None):
+        with open(filename, 'wb') as fh:
+            self.download_to_file(fh)
+
+    def upload_from_file(self, fh, size: int = None, client=None,
+                         **kwargs):
+        self.bucket.client._call('blob.upload')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'wb') as dest:
+            if size is None:
+                shutil.copyfileobj(fh, dest)
+            else:
+                dest.write(fh.read(size))
+        self._stat()
+
+    def compose(self, sources: List['FakeBlob'], client=None, **kwargs):
+        self.bucket.client._call('blob.compose')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'wb') as dest:
+            for source in sources:
+                with open(source.path, 'rb') as fh:
+                    shutil.copyfileobj(fh, dest)
+        self._stat()
+
+    def upload_from_filename(self, filename: str, client=None, **kwargs):
+        with open(filename, 'rb') as fh:
+            self.upload_from_file(fh)
+
+    def delete(self, client=None):
+        from google.api_core.exceptions import NotFound
+
+        self.bucket.client._call('blob.delete')
+        if not os.path.isfile(self.path):
+            raise NotFound('gs://{}/{}'.format(self.bucket.name, self.name))
+        os.remove(self.path)
+
+
+class FakeBucket(object):
+    def __init__(self, client: 'FakeStorageClient', name: str):
+        self.client = client
+        self.name = name
+        self.path = os.path.join(client.root, name)
+
+    def blob(self, name: str) -> FakeBlob:
+        return FakeBlob(self, name)
+
+    def get_blob(self, name: str):
+        self.client._call('bucket.get_blob')
+        blob = self.blob(name)
+        if not os.path.isfile(blob.path):
+            return None
+        blob._stat()
+        return blob
+
+    def list_blobs(self, prefix: str = None) -> List[FakeBlob]:
+        self.client._call('bucket.list_blobs')
+        blobs = []
+        for root, _, names in os.walk(self.path):
+            for file_name in names:
+                name = os.path.relpath(
+                    os.path.join(root, file_name), self.path
+                ).replace(os.sep, '/')
+                if prefix and not name.startswith(prefix):
+                    continue
+                blob = self.blob(name)
+                blob._stat()
+                blobs.append(blob)
+        return sorted(blobs, key=lambda b: b.name)
+
+    def __str__(self):
+        return self.name
+
+
+class FakeStorageClient(FakeService):
+    def __init__(self, root: str, project: str = None,
+                 latency: float = 0.0):
+        super().__init__(latency)
+        self.root = root
+        self.project = project
+        os.makedirs(root, exist_ok=True)
+
+    def bucket(self, name: str) -> FakeBucket:
+        return FakeBucket(self, name)
+
+    def get_bucket(self, name: str) -> FakeBucket:
+        from google.api_core.exceptions import NotFound
+
+        self._call('get_bucket')
+        bucket = self.bucket(name)
+        if not os.path.isdir(bucket.path):
+            raise NotFound('Bucket {} not found'.format(name))
+        return bucket
+
+    def create_bucket(self, name: str, project: str = None) -> FakeBucket:
+        from google.api_core.exceptions import Conflict
+
+        self._call('create_bucket')
+        bucket = self.bucket(name)
+        if os.path.isdir(bucket.path):
+            raise Conflict('Bucket {} already exists'.format(name))
+        os.makedirs(bucket.path)
+        return bucket
+
+    def list_buckets(self) -> List[FakeBucket]:
+        self._call('list_buckets')
+        return [self.bucket(name) for name in sorted(os.listdir(self.root))
+                if os.path.isdir(os.path.join(self.root, name))]
+
+    def blob_path(self, uri: str) -> str:
+        """The local file of a gs:// URI"""
+        bucket, _, name = uri[len('gs://'):].partition('/')
+        return os.path.join(self.root, bucket, name)
+
+
+class FakeJob(object):
+    """A BigQuery job that is done latency seconds after it was created"""
+
+    def __init__(self, job_type: str, latency: float = 0.0, query=None,
+                 destination=None, output_rows: int = None):
+        self.job_type = job_type
+        self.query = query
+        self.destination = destination
+        self.output_rows = output_rows
+        self.total_bytes_processed = 0 if job_type == 'query' else None
+        self.total_bytes_billed = 0 if job_type == 'query' else None
+        self.ready = time.monotonic() + latency
+
+    def done(self, *args, **kwargs) -> bool:
+        return time.monotonic() >= self.ready
+
+    def result(self, *args, **kwargs) -> 'FakeJob':
+        wait = self.ready - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        return self
+
+
+class FakeBigQueryClient(FakeService):
+    def __init__(self, project: str, storage: FakeStorageClient = None,
+                 latency: float = 0.0, job_latency: float = 0.0):
+        super().__init__(latency)
+        self.project = project
+        self.storage = storage
+        self.job_latency = job_latency
+        self.datasets = {}
+        self.tables = {}
+        self.jobs: List[FakeJob] = []
+
+    @property
+    def queries(self) -> List[str]:
+        return [j.query for j in self.jobs if j.job_type == 'query']
+
+    def _dataset_id(self, dataset) -> str:
+        from google.cloud.bigquery import DatasetReference
+
+        if isinstance(dataset, str):
+            dataset = DatasetReference.from_string(
+                dataset, default_project=self.project
+            )
+        return '{}.{}'.format(dataset.project, dataset.dataset_id)
+
+    def _table_id(self, table) -> str:
+        from google.cloud.bigquery import TableReference
+
+        if isinstance(table, str):
+            table = TableReference.from_string(
+                table, default_project=self.project
+            )
+        return '{}.{}.{}'.format(
+            table.project, table.dataset_id, table.table_id
+        )
+
+    def _store(self, table, table_type: str = None):
+        from google.cloud import bigquery
+
+        if not isinstance(table, bigquery.Table):
+            table = bigquery.Table(table)
+        table._properties['type'] = table_type or (
+            'VIEW' if table.view_query else 'TABLE'
+        )
+        table._properties['lastModifiedTime'] = str(
+            int(datetime.now(timezone.utc).timestamp() * 1000)
+        )
+        with self._lock:
+            self.tables[self._table_id(table)] = table
+        return table
+
+    def get_dataset(self, dataset):
+        from google.api_core.exceptions import NotFound
+
+        self._call('get_dataset')
+        dataset_id = self._dataset_id(dataset)
+        if dataset_id not in self.datasets:
+            raise NotFound('Dataset {} not found'.format(dataset_id))
+        return self.datasets[dataset_id]
+
+    def create_dataset(self, dataset, exists_ok: bool = False):
+        from google.api_core.exceptions import Conflict
+        from google.cloud.bigquery import Dataset
+
+        self._call('create_dataset')
+        if isinstance(dataset, str):
+            dataset = Dataset.from_string(dataset)
+        dataset_id = self._dataset_id(dataset.reference)
+        with self._lock:
+            if dataset_id in self.datasets:
+                if not exists_ok:
+                    raise Conflict('Dataset {} exists'.format(dataset_id))
+                return self.datasets[dataset_id]
+            self.datasets[dataset_id] = dataset
+        return dataset
+
+    def list_tables(self, dataset):
+        self.get_dataset(dataset)
+        prefix = self._dataset_id(dataset) + '.'
+        return [t for k, t in sorted(self.tables.items())
+                if k.startswith(prefix)]
+
+    def get_table(self, table):
+        from google.api_core.exceptions import NotFound
+
+        self._call('get_table')
+        table_id = self._table_id(table)
+        if table_id not in self.tables:
+            raise NotFound('Table {} not found'.format(table_id))
+        return self.tables[table_id]
+
+    def create_table(self, table, exists_ok: bool = False):
+        from google.api_core.exceptions import Conflict
+
+        self._call('create_table')
+        table_id = self._table_id(table)
+        if table_id in self.tables:
+            if not exists_ok:
+                raise Conflict('Table {} exists'.format(table_id))
+            return self.tables[table_id]
+        return self._store(table)
+
+    def update_table(self, table, fields: List[str]):
+        self._call('update_table')
+        self.get_table(table)
+        return self._store(table)
+
+    def delete_table(self, table, not_found_ok: bool = False):
+        from google.api_core.exceptions import NotFound
+
+        self._call('delete_table')
+        with self._lock:
+            if self.tables.pop(self._table_id(table), None) is None and (
+                not not_found_ok
+            ):
+                raise NotFound('Table {} not found'.format(table))
+
+    def _job(self, job: FakeJob) -> FakeJob:
+        with self._lock:
+            self.jobs.append(job)
+        return job
+
+    def load_table_from_uri(self, uri: str, destination, job_config=None):
+        """Loads a CSV from the fake storage. Only the row count and schema
+        of the table are kept."""
+        self._call('load_table_from_uri')
+        with open(self.storage.blob_path(uri), 'rb') as fh:
+            return self._load(fh, destination, job_config)
+
+    def load_table_from_file(self, fh, destination, job_config=None,
+                             size: int = None, rewind: bool = False,
+                             **kwargs):
+        self._call('load_table_from_file')
+        if rewind:
+            fh.seek(0)
+        return self._load(fh, destination, job_config)
+
+    def _load(self, fh, destination, job_config) -> FakeJob:
+        from google.cloud import bigquery
+
+        # reads gzip compressed CSVs, but only their first member, so
+        # output written as several members loses rows here
+        magic = fh.read(2)
+        fh.seek(-len(magic), os.SEEK_CUR)
+        if magic == b'\x1f\x8b':
+            fh = io.BytesIO(
+                zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(fh.read())
+            )
+        rows = sum(1 for _ in fh)
+        if job_config is not None:
+            rows -= job_config.skip_leading_rows or 0
+        table = bigquery.Table(destination, schema=(
+            job_config.schema if job_config is not None else None
+        ))
+        table._properties['numRows'] = str(rows)
+        self._store(table, 'TABLE')
+        return self._job(FakeJob(
+            'load', self.job_latency, destination=destination,
+            output_rows=rows,
+        ))
+
+    def query(self, query: str, job_config=None):
+        """Records the query. A destination table is created empty."""
+        self._call('query')
+        destination = getattr(job_config, 'destination', None)
+        if destination is not None:
+            self._store(destination, 'TABLE')
+        return self._job(FakeJob(
+            'query', self.job_latency, query=query, destination=destination
+        ))
+
+
+class FakeTransferConfig(object):
+    def __init__(self, name: str, config: dict):
+        self.name = name
+        self.display_name = config.get('display_name')
+        self.data_source_id = config.get('data_source_id')
+        self.destination_dataset_id = config.get('destination_dataset_id')
+        self.schedule = config.get('schedule')
+        self.params = config.get('params')
+        self.disabled = config.get('disabled', False)
+
+
+class FakeTransferRun(object):
+    def __init__(self, state):
+        self.state = state
+
+
+class FakeTransferClient(FakeService):
+    def __init__(self, latency: float = 0.0, transfer_latency: float = 0.0):
+        super().__init__(latency)
+        self.transfer_latency = transfer_latency
+        self.configs: Dict[str, FakeTransferConfig] = {}
+        self._created: Dict[str, float] = {}
+
+    @staticmethod
+    def location_path(project: str, location: str) -> str:
+        return 'projects/{}/locations/{}'.format(project, location)
+
+    @staticmethod
+    def location_data_source_path(project: str, location: str,
+                                  data_source: str) -> str:
+        return 'projects/{}/locations/{}/dataSources/{}'.format(
+            project, location, data_source
+        )
+
+    def list_transfer_configs(self, parent: str):
+        self._call('list_transfer_configs')
+        return [c for k, c in sorted(self.configs.items())
+                if k.startswith(parent + '/')]
+
+    def create_transfer_config(self, parent: str, config: dict):
+        self._call('create_transfer_config')
+        with self._lock:
+            name = '{}/transferConfigs/{}'.format(parent, len(self.configs))
+            self.configs[name] = FakeTransferConfig(name, config)
+            self._created[name] = time.monotonic()
+        return self.configs[name]
+
+    def list_transfer_runs(self, parent: str):
+        self._call('list_transfer_runs')
+        states = transfer_states()
+        elapsed = time.monotonic() - self._created.get(parent, 0.0)
+        return [FakeTransferRun(
+            states.SUCCEEDED if elapsed >= self.transfer_latency
+            else states.RUNNING
+        )]
+
+
+class FakeRequest(object):
+    def __init__(self, fn: callable):
+        self.fn = fn
+
+    def execute(self):
+        return self.fn()
+
+
+class FakeIam(FakeService):
+    """The projects.serviceAccounts(.keys) resources of the IAM API"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__(latency)
+        self.accounts = {}
+        self.keys_created = Counter()
+
+    def projects(self):
+        return self
+
+    def serviceAccounts(self):
+        return self
+
+    def keys(self):
+        return FakeIam.Keys(self)
+
+    def create(self, name: str, body: dict) -> FakeRequest:
+        def create():
+            from googleapiclient.errors import HttpError
+            from httplib2 import Response
+
+            self._call('serviceAccounts.create')
+            project = name.split('/')[-1]
+            email = '{}@{}.iam.gserviceaccount.com'.format(
+                body['accountId'], project
+            )
+            with self._lock:
+                if email in self.accounts:
+                    raise HttpError(Response({'status': 409}),
+                                    b'Service account exists')
+                self.accounts[email] = dict(
+                    body['serviceAccount'], email=email
+                )
+            return self.accounts[email]
+        return FakeRequest(create)
+
+    class Keys(object):
+        def __init__(self, iam: 'FakeIam'):
+            self.iam = iam
+
+        def create(self, name: str, body: dict) -> FakeRequest:
+            def create():
+                self.iam._call('keys.create')
+                self.iam.keys_created[name.split('/')[-1]] += 1
+                return {'name': name + '/keys/fake'}
+            return FakeRequest(create)
+
+
+class FakeRegistry(ClientRegistry):
+    """A ClientRegistry of stand-ins. Clients are shared as usual, so every
+    advertiser of a run sees the same fake project state."""
+
+    def __init__(self, root: str, api_latency: float = 0.0,
+                 job_latency: float = 0.0, transfer_latency: float = 0.0):
+        super().__init__()
+        self.root = root
+        self.api_latency = api_latency
+        self.job_latency = job_latency
+        self.transfer_latency = transfer_latency
+
+    def credentials(self):
+        return None
+
+    def http(self):
+        return None
+
+    def bigquery(self, project: str, location: str = 'US'):
+        # locations share one client, like datasets share one project
+        return self._get(('bigquery', project), lambda: FakeBigQueryClient(
+            project, self.storage(project), self.api_latency,
+            self.job_latency,
+        ))
+
+    def storage(self, project: str):
+        # buckets are global, so every project shares one root
+        return self._get(('storage',), lambda: FakeStorageClient(
+            self.root, project, self.api_latency
+        ))
+
+    def transfer(self):
+        return self._get(('transfer',), lambda: FakeTransferClient(
+            self.api_latency, self.transfer_latency
+        ))
+
+    def iam(self):
+        return self._get(('iam',), lambda: FakeIam(self.api_latency))
+
+    def calls(self) -> Counter:
+        """Calls made to every stand-in, keyed by service and method"""
+        with self._lock:
+            clients = dict(self._clients)
+        calls = Counter()
+        for key, client in clients.items():
+            for method, count in client.calls.items():
+                calls['{}.{}'.format(key[0], method)] += count
+        return calls
+
+
+def main():
+    import bootstrapper
+    import clients
+    import flagmaker.settings as settings
+    import profiling
+    import run_report
+
+    bootstrap = bootstrapper.Bootstrap()
+    flags.adopt_module_key_flags(settings)
+    flags.adopt_module_key_flags(run_report)
+    flags.adopt_module_key_flags(profiling)
+    flags.mark_flag_as_required('fake_root')
+
+    def run(args):
+        clients.set_registry(FakeRegistry(
+            flags.FLAGS.fake_root,
+            api_latency=flags.FLAGS.fake_api_latency,
+            job_latency=flags.FLAGS.fake_api_latency,
+            transfer_latency=flags.FLAGS.fake_transfer_latency,
+        ))
+        # the fake BigQuery state only lives as long as the process, so
+        # stages completed by earlier runs must not be skipped
+        with tempfile.TemporaryDirectory(
+            prefix='fake-checkpoints-'
+        ) as checkpoint_dir:
+            bootstrap.checkpoint_dir = checkpoint_dir
+            bootstrap.exec(args)
+
+    from absl import app
+    app.run(run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+# /***********************************************************************
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Note that these code samples being shared are not official Google
+# products and are not formally supported.
+# ************************************************************************/
+import json
+import os
+import tempfile
+import time
+from datetime import date
+from datetime import datetime
+from typing import Dict
+from typing import List
+
+
+def atomic_write(path: str, content: str):
+    """Writes content to a temporary file and renames it over path.
+
+    Readers see either the old or the new file, never a partial one.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix='.' + os.path.basename(path) + '.'
+    )
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(content)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def to_json(value) -> str:
+    """Dates as entered at the prompts (yyyy-mm-dd), anything else as str"""
+    if isinstance(value, datetime) and value.time() == datetime.min.time():
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+class SettingsCache(object):
+    """Remembered setting values, stored as one profile per key combination.
+
+    Profiles are keyed by the values of the settings' profile keys (e.g.
+    project and advertiser). The file is versioned JSON, written atomically
+    and bounded: profiles unused for max_age_days are dropped, and only the
+    max_profiles most recently used ones are kept.
+    """
+    VERSION = 1
+
+    def __init__(self, path: str, max_profiles: int = 20,
+                 max_age_days: int = 180):
+        self.path = path
+        self.max_profiles = max_profiles
+        self.max_age_days = max_age_days
+        self.profiles: Dict[str, dict] = {}
+        self.load()
+
+    def load(self):
+        self.profiles = {}
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r') as fh:
+            content = fh.read()
+        try:
+            data = json.loads(content)
+        except ValueError:
+            data = self.load_legacy(content)
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            return
+        self.profiles = data.get('profiles') or {}
+
+    def load_legacy(self, content: str) -> dict:
+        """Imports the old append-only YAML cache as a single profile"""
+        import yaml
+
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        try:
+            values = yaml.load(content, Loader=loader)
+        except yaml.YAMLError:
+            return {}
+        if not isinstance(values, dict):
+            return {}
+        return {
+            'version': self.VERSION,
+            'profiles': {
+                '': {'keys': {}, 'last_used': time.time(), 'values': values}
+            },
+        }
+
+    @staticmethod
+    def profile_key(keys: Dict[str, str]) -> str:
+        return '/'.join(
+            '{}={}'.format(k, keys[k]) for k in sorted(keys)
+        )
+
+    def get(self, known: Dict[str, str]) -> dict:
+        """Values of the most recently used profile matching known keys"""
+        candidates = [
+            p for p in self.profiles.values()
+            if all(p['keys'].get(k) in (None, v) for k, v in known.items())
+        ]
+        if not candidates:
+            return {}
+        return max(candidates, key=lambda p: p['last_used'])['values']
+
+    def update(self, keys: Dict[str, str], values: dict):
+        key = self.profile_key(keys)
+        profile = self.profiles.get(key, {'keys': keys, 'values': {}})
+        profile['values'].update(values)
+        profile['last_used'] = time.time()
+        self.profiles[key] = profile
+        self.evict()
+
+    def evict(self):
+        oldest = time.time() - self.max_age_days * 86400
+        profiles: List[tuple] = sorted(
+            (p for p in self.profiles.items() if p[1]['last_used'] >= oldest),
+            key=lambda p: p[1]['last_used'],
+            reverse=True,
+        )
+        self.profiles = dict(profiles[:self.max_profiles])
+
+    def save(self):
+        atomic_write(self.path, json.dumps(
+            {'version': self.VERSION, 'profiles': self.profiles},
+            default=to_json,
+            separators=(',', ':'),
+        ))
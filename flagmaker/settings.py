@@ -19,10 +19,6 @@
 import os
 from typing import Union
 
-import yaml
-
-from yaml.parser import ParserError
-
 from collections.abc import Iterable
 from enum import EnumMeta
 from typing import ClassVar
@@ -32,16 +28,13 @@ from typing import List
 from typing import TypeVar
 
 from absl import flags
-from prompt_toolkit import ANSI
-from prompt_toolkit import prompt
-from prompt_toolkit.shortcuts import CompleteStyle
 from termcolor import colored
 from termcolor import cprint
 
 from flagmaker.building_blocks import list_to_string_list
 from flagmaker.exceptions import FlagMakerPromptInterruption
-from flagmaker.validators import ChoiceValidator
 from .building_blocks import SettingOptionInterface
+from .cache import SettingsCache
 from .building_blocks import SettingsInterface
 from .building_blocks import Value
 from .exceptions import FlagMakerConfigurationError
@@ -57,6 +50,7 @@ T = TypeVar('T', bound=SettingsInterface)
 class SettingConfig(object):
     cache_file: str = '{}/.sa360bq'.format(os.environ['HOME'])
     cache_dict: dict = {}
+    max_cached_profiles: int = 20
 
 
 class SettingOption(SettingOptionInterface, Generic[T]):
@@ -217,6 +211,12 @@ class SettingOption(SettingOptionInterface, Generic[T]):
                     # we intentionally set ask to None. A conditional prompt
                     # doesn't want this to continue
                     return
+                # prompt_toolkit is slow to import and only needed here
+                from prompt_toolkit import ANSI
+                from prompt_toolkit import prompt
+                from prompt_toolkit.shortcuts import CompleteStyle
+                from flagmaker.validators import ChoiceValidator
+
                 kwargs = {
                     'bottom_toolbar': ANSI(self.help)
                 }
@@ -308,6 +308,11 @@ class AbstractSettings(SettingsInterface):
     """
     args: List[SettingBlock] = None
     flattened_args: dict = {}
+    # settings whose values select the cached profile, e.g. project
+    profile_keys: List[str] = []
+    cache: SettingsCache = None
+    # whether values are being prompted for, rather than loaded from a file
+    prompting: bool = False
 
     def start(self):
         """Bootstraps the settings loading process
@@ -320,25 +325,27 @@ class AbstractSettings(SettingsInterface):
                 self.flattened_args[k] = s
 
     def load_settings(self):
+        self.prompting = True
         self.start()
         first = True
         interactive_mode = self.args[0].settings.pop('interactive')
-        cache: dict = {}
-        if os.path.exists(SettingConfig.cache_file):
-            try:
-                with open(SettingConfig.cache_file, 'r') as fh:
-                    cache = yaml.load(
-                        fh.read(), Loader=yaml.Loader
-                    ) or {}
-            except ParserError:
-                cache = {}
-                os.remove(SettingConfig.cache_file)
+        self.cache = SettingsCache(
+            SettingConfig.cache_file,
+            max_profiles=SettingConfig.max_cached_profiles,
+        )
+        profile = self.profile()
+        cache: dict = self.cache.get(profile)
 
         for block in self.args:
             header_shown = False
             if block.conditional is not None and not block.conditional(self):
                 continue
             for k, setting in block.settings.items():
+                if self.profile() != profile:
+                    # a profile key was just answered: later prompts default
+                    # to the values cached for that project/advertiser
+                    profile = self.profile()
+                    cache = self.cache.get(profile)
                 setting.cache = cache[k] if k in cache else None
 
                 if setting.maybe_needs_input():
@@ -360,12 +367,17 @@ class AbstractSettings(SettingsInterface):
                             setting.set_value(k, ask=setting.get_prompt(k))
                         except FlagMakerPromptInterruption as err:
                             setting.set_value(k, value=err.value)
-        with open(SettingConfig.cache_file, 'w+') as fh:
-            fh.write(yaml.dump(
-                SettingConfig.cache_dict, Dumper=yaml.Dumper
-            ))
         return self
 
+    def profile(self) -> dict:
+        """The known values of the profile keys"""
+        return {
+            k: str(self.flattened_args[k].value)
+            for k in self.profile_keys
+            if k in self.flattened_args
+            and self.flattened_args[k].value_explicitly_set()
+        }
+
     def assign_flags(self) -> flags:
         for block in self.args:
             for k, setting in block.settings.items():
@@ -393,14 +405,76 @@ class AbstractSettings(SettingsInterface):
                 include_in_interactive=False,
                 method=flags.DEFINE_bool,
             ),
+            'settings_file': SettingOption.create(
+                self,
+                'YAML or JSON file with a list of entries to run without '
+                'prompts. Each entry holds setting values; values under '
+                '"defaults" apply to every entry.',
+                required=False,
+                include_in_interactive=False,
+            ),
         })]
         settings += self.settings()
         return settings
 
-    def install(self):
+    def build(self):
+        """Creates the setting options without defining flags"""
+        self.custom = {}
+        self.flattened_args = {}
         self.args = self.get_settings()
+        for block in self.args:
+            self.flattened_args.update(block.settings)
+
+    def install(self):
+        self.build()
         self.assign_flags()
 
+    def load_values(self, values: dict) -> List[str]:
+        """Applies values without prompting.
+
+        Missing values fall back to flags and then to defaults. Block and
+        setting conditionals are respected and after hooks run as usual.
+
+        :param values: Setting values keyed by setting name
+        :return: A list of errors. Empty if all settings are valid.
+        """
+        errors = [
+            'Unknown setting {}'.format(k)
+            for k in values if k not in self.flattened_args
+        ]
+        for block in self.args:
+            if block.conditional is not None and not block.conditional(self):
+                continue
+            for k, setting in block.settings.items():
+                if (setting.conditional is not None
+                        and not setting.conditional(self)):
+                    continue
+                value = values.get(k)
+                if value is None and k in FLAGS:
+                    value = FLAGS[k].value
+                if value is None:
+                    value = setting.default
+                if value is None:
+                    if setting.required:
+                        errors.append('{} is required'.format(k))
+                    continue
+                if (setting.method in (flags.DEFINE_string, flags.DEFINE_enum)
+                        and not isinstance(value, str)):
+                    value = str(value)
+                try:
+                    setting._set_value(value)
+                except FlagMakerConfigurationError as err:
+                    errors.append('{}: {}'.format(k, err))
+                    continue
+                if (setting.get_method() == flags.DEFINE_boolean
+                        and setting.validation is None):
+                    setting.validation = Validator.check_bool
+                if setting.validation is not None:
+                    setting_errors = []
+                    setting.validation(setting, setting_errors)
+                    errors += ['{}: {}'.format(k, e) for e in setting_errors]
+        return errors
+
     def __repr__(self):
         return str(self.args)
 
@@ -408,10 +482,10 @@ class AbstractSettings(SettingsInterface):
         return self
 
     def __exit__(self, err, value, traceback):
-        with open(SettingConfig.cache_file, 'a+') as fh:
-            fh.write(yaml.dump(
-                SettingConfig.cache_dict, Dumper=yaml.Dumper
-            ))
+        if self.cache is None:
+            return
+        self.cache.update(self.profile(), SettingConfig.cache_dict)
+        self.cache.save()
 
 
 AbstractSettingsClass = ClassVar[T]
@@ -439,3 +513,64 @@ class Config(Generic[T]):
         with self.instance as instance:  
             instance.load_settings()
         return self.instance
+
+    def get_all(self) -> List[T]:
+        """All settings to run with.
+
+        Without --settings_file this is the interactive result of get().
+        With it, one settings instance per entry in the file. Every entry
+        is validated before any is returned, so a batch either starts
+        completely or not at all.
+        """
+        path = FLAGS.get_flag_value('settings_file', None)
+        if not path:
+            return [self.get()]
+        instances = []
+        errors = []
+        for i, values in enumerate(load_settings_file(path), start=1):
+            instance = self.s()
+            instance.build()
+            for error in instance.load_values(values):
+                errors.append('Entry #{}: {}'.format(i, error))
+            instances.append(instance)
+        if errors:
+            raise FlagMakerConfigurationError(
+                'Invalid settings file {}:\n{}'.format(
+                    path, '\n'.join(errors)
+                )
+            )
+        return instances
+
+
+def load_settings_file(path: str) -> List[dict]:
+    """Reads the entries of a settings file.
+
+    The file is either a list of entries, or a mapping with an "entries"
+    list and optional "defaults" shared by all entries:
+
+        defaults:
+          gcp_project_name: my-project
+          agency_id: 123
+        entries:
+          - advertiser_id: 456
+          - advertiser_id: 789
+            account_column_name: Account
+    """
+    with open(path, 'r') as fh:
+        content = fh.read()
+    if path.endswith('.json'):
+        import json
+        data = json.loads(content)
+    else:
+        import yaml
+        data = yaml.load(
+            content, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        )
+    if isinstance(data, list):
+        data = {'entries': data}
+    if not isinstance(data, dict) or not isinstance(data.get('entries'), list):
+        raise FlagMakerConfigurationError(
+            '{} needs a list of entries'.format(path)
+        )
+    defaults = data.get('defaults') or {}
+    return [dict(defaults, **entry) for entry in data['entries']]
@@ -17,10 +17,16 @@
 # products and are not formally supported.
 # ************************************************************************/
 from absl import flags
+import json
+import os
+import tempfile
 import unittest
 
+from .cache import SettingsCache
 from .settings import AbstractSettings
+from .settings import SettingBlock
 from .settings import SettingOption
+from .settings import load_settings_file
 
 
 class TestSettings(AbstractSettings):
@@ -28,6 +34,23 @@ class TestSettings(AbstractSettings):
         return {}
 
 
+class BatchSettings(AbstractSettings):
+    def settings(self):
+        return [SettingBlock('Batch', {
+            'name': SettingOption.create(self, 'Name'),
+            'count': SettingOption.create(
+                self, 'Count', method=flags.DEFINE_integer, default=1,
+            ),
+            'enabled': SettingOption.create(
+                self, 'Enabled', method=flags.DEFINE_bool, default=False,
+            ),
+            'only_if_enabled': SettingOption.create(
+                self, 'Only if enabled',
+                conditional=lambda s: s['enabled'].value,
+            ),
+        })]
+
+
 class AppFlagsTest(unittest.TestCase):
     def setUp(self) -> None:
         self.settings = TestSettings()
@@ -69,3 +92,129 @@ class AppFlagsTest(unittest.TestCase):
         self.assertEqual(type(string.value), str)
 
 
+class SettingsCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'cache')
+
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+
+    def test_profiles(self):
+        cache = SettingsCache(self.path)
+        cache.update({'project': 'a'}, {'bucket': 'bucket-a'})
+        cache.update({'project': 'b'}, {'bucket': 'bucket-b'})
+        cache.save()
+
+        cache = SettingsCache(self.path)
+        self.assertEqual(cache.get({'project': 'a'})['bucket'], 'bucket-a')
+        # unknown keys fall back to the most recently used profile
+        self.assertEqual(cache.get({})['bucket'], 'bucket-b')
+        self.assertEqual(cache.get({'project': 'c'}), {})
+
+    def test_bounded(self):
+        cache = SettingsCache(self.path, max_profiles=2)
+        for project in ('a', 'b', 'c'):
+            cache.update({'project': project}, {'value': project})
+        cache.save()
+        cache = SettingsCache(self.path, max_profiles=2)
+        self.assertEqual(len(cache.profiles), 2)
+        self.assertEqual(cache.get({'project': 'a'}), {})
+
+    def test_dates(self):
+        from datetime import datetime
+
+        cache = SettingsCache(self.path)
+        cache.update({'project': 'a'}, {
+            'first_date_conversions': datetime(2019, 1, 2),
+        })
+        cache.save()
+        value = SettingsCache(self.path).get({'project': 'a'})[
+            'first_date_conversions'
+        ]
+        self.assertEqual(value, '2019-01-02')
+        self.assertEqual(datetime.strptime(value, '%Y-%m-%d'),
+                         datetime(2019, 1, 2))
+
+    def test_legacy(self):
+        with open(self.path, 'w') as fh:
+            fh.write('bucket: old\nproject: x\n')
+        cache = SettingsCache(self.path)
+        self.assertEqual(cache.get({'project': 'x'})['bucket'], 'old')
+        cache.save()
+        with open(self.path) as fh:
+            self.assertEqual(json.load(fh)['version'], SettingsCache.VERSION)
+
+
+class ProfileSettings(AbstractSettings):
+    profile_keys = ['project']
+
+    def settings(self):
+        return [SettingBlock('Profile', {
+            'project': SettingOption.create(self, 'Project'),
+            'bucket': SettingOption.create(self, 'Bucket'),
+        })]
+
+
+class ProfileSelectionTest(unittest.TestCase):
+    def test_profile_selected_after_its_keys(self):
+        from unittest import mock
+        from .settings import SettingConfig
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cache')
+            cache = SettingsCache(path)
+            cache.update({'project': 'a'}, {'bucket': 'bucket-a'})
+            cache.update({'project': 'b'}, {'bucket': 'bucket-b'})
+            cache.save()
+            settings = ProfileSettings()
+            settings.build()
+            # answer the project, accept the cached bucket
+            answers = iter(['a', ''])
+            with mock.patch.object(SettingConfig, 'cache_file', path), \
+                    mock.patch('prompt_toolkit.prompt',
+                               lambda *args, **kwargs: next(answers)), \
+                    mock.patch.dict(SettingConfig.cache_dict, clear=True), \
+                    mock.patch('flagmaker.settings.FLAGS') as flag_values:
+                flag_values.get_flag_value.return_value = None
+                settings.load_settings()
+            self.assertEqual(settings['project'].value, 'a')
+            self.assertEqual(settings['bucket'].value, 'bucket-a')
+
+
+class SettingsFileTest(unittest.TestCase):
+    def load(self, content):
+        with tempfile.NamedTemporaryFile('w', suffix='.yaml') as fh:
+            fh.write(content)
+            fh.flush()
+            return load_settings_file(fh.name)
+
+    def test_entries(self):
+        entries = self.load(
+            'defaults:\n'
+            '  count: 2\n'
+            'entries:\n'
+            '  - name: a\n'
+            '  - name: b\n'
+            '    count: 3\n'
+        )
+        self.assertEqual(entries, [
+            {'name': 'a', 'count': 2},
+            {'name': 'b', 'count': 3},
+        ])
+
+    def test_load_values(self):
+        settings = BatchSettings()
+        settings.build()
+        self.assertEqual(settings.load_values({'name': 123}), [])
+        self.assertEqual(settings['name'].value, '123')
+        self.assertEqual(settings['count'].value, 1)
+        self.assertFalse(settings['only_if_enabled'].value_explicitly_set())
+
+    def test_load_values_errors(self):
+        settings = BatchSettings()
+        settings.build()
+        errors = settings.load_values({'enabled': True, 'unknown': 1})
+        self.assertIn('Unknown setting unknown', errors)
+        self.assertIn('name is required', errors)
+        self.assertIn('only_if_enabled is required', errors)
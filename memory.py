@@ -0,0 +1,140 @@
+# /***********************************************************************
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Note that these code samples being shared are not official Google
+# products and are not formally supported.
+# ************************************************************************/
+
+"""
+Keeps decoding within a memory budget.
+
+The budget is measured against the resident set size (RSS) of the
+process. Files are read in chunks sized from the remaining headroom; each
+chunk is written to disk before the next one is read, and chunks shrink
+when RSS comes close to the limit.
+"""
+import gc
+import os
+import resource
+
+from absl import logging
+
+# share of the system (or container) memory used when no limit is set
+AUTO_FRACTION = 0.6
+# share of the headroom a single chunk may use
+CHUNK_FRACTION = 0.25
+# RSS above this share of the limit counts as memory pressure
+PRESSURE_FRACTION = 0.85
+MIN_CHUNK_ROWS = 1000
+MAX_CHUNK_ROWS = 1000000
+# writing a chunk makes temporary copies (fingerprints, CSV formatting)
+ROW_OVERHEAD = 2
+# an XLSX sheet is read at once and takes many times its (zipped) size
+EXCEL_EXPANSION = 20
+# memory limit files of cgroup v2 and v1
+CGROUP_LIMITS = (
+    '/sys/fs/cgroup/memory.max',
+    '/sys/fs/cgroup/memory/memory.limit_in_bytes',
+)
+
+
+def rss_bytes() -> int:
+    """Current resident set size"""
+    try:
+        with open('/proc/self/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return peak_rss_bytes()
+
+
+def peak_rss_bytes() -> int:
+    """High-water mark of the resident set size of the process"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def available_bytes() -> int:
+    """The container's memory limit, or else the system's memory"""
+    system = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    for path in CGROUP_LIMITS:
+        try:
+            with open(path) as fh:
+                limit = fh.read().strip()
+        except OSError:
+            continue
+        try:
+            limit = int(limit)
+        except ValueError:
+            # 'max' is cgroup v2 for no limit
+            continue
+        # cgroup v1 reports no limit as a huge number
+        if limit < system:
+            return limit
+    return system
+
+
+class MemoryBudget(object):
+    def __init__(self, max_memory_mb: int = None):
+        """
+        :param max_memory_mb: The limit for the process' RSS. If not set,
+            AUTO_FRACTION of the available memory.
+        """
+        self.limit = (
+            max_memory_mb * 2 ** 20 if max_memory_mb
+            else int(available_bytes() * AUTO_FRACTION)
+        )
+        self.high_water = 0
+        self.chunk_rows = MAX_CHUNK_ROWS
+        self.sample()
+
+    def sample(self) -> int:
+        rss = rss_bytes()
+        self.high_water = max(self.high_water, rss)
+        return rss
+
+    def headroom(self) -> int:
+        return max(0, self.limit - self.sample())
+
+    def fits(self, size: int) -> bool:
+        """Whether size bytes can be held in memory at once"""
+        return size <= self.headroom()
+
+    def rows_for(self, row_bytes: float) -> int:
+        """Rows per chunk for rows taking row_bytes bytes in memory"""
+        rows = int(
+            self.headroom() * CHUNK_FRACTION
+            / max(1.0, row_bytes * ROW_OVERHEAD)
+        )
+        self.chunk_rows = max(MIN_CHUNK_ROWS, min(self.chunk_rows, rows))
+        return self.chunk_rows
+
+    def under_pressure(self) -> bool:
+        return self.sample() > self.limit * PRESSURE_FRACTION
+
+    def relieve(self) -> bool:
+        """
+        Frees memory and halves the chunk size if under pressure.
+
+        :return: True if there was pressure
+        """
+        if not self.under_pressure():
+            return False
+        gc.collect()
+        self.chunk_rows = max(MIN_CHUNK_ROWS, self.chunk_rows // 2)
+        logging.info('Memory pressure (%d MiB of %d MiB), chunks now %d rows',
+                     self.sample() // 2 ** 20, self.limit // 2 ** 20,
+                     self.chunk_rows)
+        return True
@@ -0,0 +1,217 @@
+# /***********************************************************************
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Note that these code samples being shared are not official Google
+# products and are not formally supported.
+# ************************************************************************/
+
+"""
+Performance regression tests.
+
+Each test measures one metric and compares it with the baseline in
+testdata/perf_baselines.json. A metric regresses if it is worse than its
+baseline by more than the baseline's tolerance (a fraction of the
+baseline). All results are printed as a table at the end.
+
+    python perf_tests.py                     # run and compare
+    python perf_tests.py --update_baselines  # store the measured values
+
+Timings depend on the machine, so baselines should be updated on the
+machine that runs the suite, and only when a change is expected.
+
+API call and job counts against the local stand-ins are exact and do not
+depend on the machine, so their tolerance is 0 on purpose: any extra call
+is reported, and a change that is meant to add one updates the baseline.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest
+from collections import namedtuple
+
+import pandas as pd
+
+from csv_decoder import Decoder
+from tests import import_times
+from tests import offline_run
+from utilities import Locale
+
+BASELINES = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    'testdata', 'perf_baselines.json'
+)
+DECODE_ROWS = 100000
+ADVERTISERS = 2
+
+Column = namedtuple('Column', ['value', 'default', 'attrs'])
+
+HISTORICAL_COLUMNS = {
+    'date': 'datetime64',
+    'keyword': 'object',
+    'campaign_name': 'object',
+    'account_name': 'object',
+    'ad_group': 'object',
+    'match_type': 'object',
+    'conversions': 'float64',
+    'revenue': 'float64',
+}
+
+
+def historical_frame(rows: int) -> pd.DataFrame:
+    return pd.DataFrame({
+        'date': pd.date_range('2019-01-01', periods=rows, freq='min')
+                  .strftime('%Y-%m-%d'),
+        'keyword': ['keyword {}'.format(i % 5000) for i in range(rows)],
+        'campaign_name': ['campaign {}'.format(i % 50) for i in range(rows)],
+        'account_name': ['account {}'.format(i % 5) for i in range(rows)],
+        'ad_group': ['ad group {}'.format(i % 500) for i in range(rows)],
+        'match_type': ['exact'] * rows,
+        'conversions': [float(i % 7) for i in range(rows)],
+        'revenue': [i % 100 * 1.5 for i in range(rows)],
+    })
+
+
+def decode(path: str, directory: str):
+    decoder = Decoder('utf-8', path, Locale.US, {
+        k: Column(k, k, {'dtype': v}) for k, v in HISTORICAL_COLUMNS.items()
+    })
+    decoder.dir = directory
+    Decoder.FileDecoder(decoder, path).decode_csv()
+    return decoder
+
+
+class Result(object):
+    def __init__(self, name: str, value: float, baseline: dict):
+        self.name = name
+        self.value = value
+        self.baseline = baseline
+
+    @property
+    def change(self):
+        if not self.baseline or not self.baseline['value']:
+            return None
+        return self.value / self.baseline['value'] - 1
+
+    @property
+    def regressed(self) -> bool:
+        change = self.change
+        if change is None:
+            return False
+        if self.baseline['better'] == 'higher':
+            change = -change
+        return change > self.baseline['tolerance']
+
+    def row(self) -> str:
+        if self.change is None:
+            return '{:<32} {:>12} {:>12.4g} {:>8}  no baseline'.format(
+                self.name, '-', self.value, '-'
+            )
+        return '{:<32} {:>12.4g} {:>12.4g} {:>+7.1f}%  {} ({} is better, ' \
+               'tolerance {:.0%})'.format(
+                   self.name, self.baseline['value'], self.value,
+                   self.change * 100,
+                   'REGRESSED' if self.regressed else 'ok',
+                   self.baseline['better'], self.baseline['tolerance'],
+               )
+
+
+class PerfTest(unittest.TestCase):
+    update_baselines = False
+    baselines = {}
+    results = []
+
+    @classmethod
+    def setUpClass(cls):
+        if os.path.exists(BASELINES):
+            with open(BASELINES) as fh:
+                cls.baselines = json.load(fh)
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.historical = os.path.join(cls.tmp.name, 'historical.csv')
+        historical_frame(DECODE_ROWS).to_csv(cls.historical, index=False)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+        print('\n{:<32} {:>12} {:>12} {:>8}'.format(
+            'metric', 'baseline', 'measured', 'change'
+        ), file=sys.stderr)
+        for result in cls.results:
+            print(result.row(), file=sys.stderr)
+        if cls.update_baselines:
+            for result in cls.results:
+                cls.baselines[result.name]['value'] = round(result.value, 4)
+            with open(BASELINES, 'w') as fh:
+                json.dump(cls.baselines, fh, indent=2, sort_keys=True)
+                fh.write('\n')
+            print('Baselines written to {}'.format(BASELINES),
+                  file=sys.stderr)
+
+    def check(self, name: str, value: float):
+        result = Result(name, value, self.baselines.get(name))
+        PerfTest.results.append(result)
+        if self.update_baselines:
+            self.assertIn(name, self.baselines,
+                          'Add {} to {} first'.format(name, BASELINES))
+            return
+        self.assertFalse(result.regressed, result.row())
+
+    def test_decode_throughput(self):
+        with tempfile.TemporaryDirectory() as out:
+            start = time.perf_counter()
+            decoder = decode(self.historical, out)
+            seconds = time.perf_counter() - start
+        self.assertEqual(decoder.rows_opened, DECODE_ROWS)
+        self.check('decode_rows_per_second', DECODE_ROWS / seconds)
+
+    def test_decode_memory(self):
+        """Peak memory allocated while decoding, traced by tracemalloc"""
+        with tempfile.TemporaryDirectory() as out:
+            tracemalloc.start()
+            try:
+                decode(self.historical, out)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+        self.check('decode_peak_memory_mb', peak / 2 ** 20)
+
+    def test_import_time(self):
+        # the best of a few runs, to leave out cold file caches
+        seconds = min(
+            import_times('bootstrapper')['bootstrapper'] / 1e6
+            for _ in range(3)
+        )
+        self.check('import_seconds', seconds)
+
+    def test_api_calls_per_advertiser(self):
+        """API calls and BigQuery jobs of a complete run against the
+        local stand-ins (fakes.py)"""
+        with tempfile.TemporaryDirectory() as tmp:
+            totals = offline_run(tmp, historical_frame(100), [
+                str(10 + i) for i in range(ADVERTISERS)
+            ])['totals']
+        calls = sum(v for k, v in totals.items() if k.startswith('api_calls.'))
+        self.check('api_calls_per_advertiser', calls / ADVERTISERS)
+        self.check('bigquery_jobs_per_advertiser',
+                   totals.get('bigquery_jobs', 0) / ADVERTISERS)
+
+
+if __name__ == '__main__':
+    if '--update_baselines' in sys.argv:
+        sys.argv.remove('--update_baselines')
+        PerfTest.update_baselines = True
+    unittest.main()
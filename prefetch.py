@@ -0,0 +1,120 @@
+# /***********************************************************************
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Note that these code samples being shared are not official Google
+# products and are not formally supported.
+# ************************************************************************/
+
+"""
+Fetches cloud metadata in background threads while the user is still
+answering prompts, so later prompts and stages read cached results.
+"""
+import threading
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+from absl import logging
+
+import api_calls
+
+
+class Prefetcher(object):
+    def __init__(self, max_workers: int = 4):
+        self.max_workers = max_workers
+        self._executor: ThreadPoolExecutor = None
+        self._futures: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key: str, fn: callable, *args):
+        """Starts fn(*args) in the background unless key is already queued"""
+        with self._lock:
+            if key in self._futures:
+                return
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix='prefetch'
+                )
+            logging.debug('Prefetching %s', key)
+            self._futures[key] = self._executor.submit(fn, *args)
+
+    def get(self, key: str, fn: callable, *args, missing: callable = None):
+        """Returns the prefetched result for key.
+
+        Falls back to calling fn(*args) directly if nothing was prefetched
+        or the prefetch failed. A result is only handed out once, so a
+        second call (e.g. after creating a resource) fetches fresh data.
+
+        :param missing: Called with the prefetched result. If it returns
+            True the result is not trusted and fn(*args) is called, as the
+            resource may have been created after the prefetch started.
+        """
+        with self._lock:
+            future = self._futures.pop(key, None)
+        if future is not None:
+            try:
+                result = future.result()
+            except Exception as err:
+                logging.debug('Prefetch of %s failed: %s', key, err)
+            else:
+                if missing is None or not missing(result):
+                    return result
+                logging.debug('Prefetched %s is missing a resource', key)
+        return fn(*args)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            self._futures = {}
+
+
+def list_buckets(storage_client) -> list:
+    return api_calls.call(
+        'storage', lambda: list(storage_client.list_buckets())
+    )
+
+
+def get_dataset(bigquery_client, dataset_id: str):
+    """The dataset, or None if it does not exist yet"""
+    from google.api_core.exceptions import NotFound
+
+    try:
+        return api_calls.call(
+            'bigquery', bigquery_client.get_dataset, dataset_id
+        )
+    except NotFound:
+        return None
+
+
+def list_table_ids(bigquery_client, dataset_id: str) -> set:
+    from google.api_core.exceptions import NotFound
+
+    try:
+        return api_calls.call('bigquery', lambda: {
+            t.table_id for t in bigquery_client.list_tables(dataset_id)
+        })
+    except NotFound:
+        return set()
+
+
+def list_transfer_configs(project: str, location: str) -> list:
+    import clients
+
+    client = clients.get_registry().transfer()
+    return api_calls.call('transfer', lambda: list(
+        client.list_transfer_configs(client.location_path(project, location))
+    ))
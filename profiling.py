@@ -0,0 +1,256 @@
+# /***********************************************************************
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Note that these code samples being shared are not official Google
+# products and are not formally supported.
+# ************************************************************************/
+
+"""
+CPU and allocation profiling of a whole run (--profile=exec) or of the
+historical file decoding only (--profile=decode).
+
+Each profiled section writes to its own directory:
+
+- profile.pstats: cProfile statistics, readable with pstats or snakeviz
+- profile.txt: the top functions by cumulative time
+- allocations.txt: the top allocation sites from tracemalloc
+- stacks.collapsed: sampled stacks in the collapsed format read by
+  flamegraph.pl and speedscope. Stacks inside a Decoder are rooted at the
+  Decoder subclass, e.g. [FileDecoder].
+"""
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List
+
+from absl import flags
+from termcolor import cprint
+
+flags.DEFINE_enum(
+    'profile', None, ['exec', 'decode'],
+    'Profile CPU time and allocations of the whole run (exec) or of '
+    'decoding historical files only (decode).'
+)
+flags.DEFINE_string(
+    'profile_dir', None,
+    'Where to write profiles. Defaults to ~/.sa360bq-profiles.'
+)
+flags.DEFINE_integer(
+    'profile_top', 30,
+    'Number of functions and allocation sites listed in the reports.'
+)
+
+PROFILE_DIR = '{}/.sa360bq-profiles'.format(os.environ['HOME'])
+SAMPLE_SECONDS = 0.005
+TRACEBACK_FRAMES = 25
+# the Decoder subclasses that read data (ChooseyDecoder only dispatches);
+# listed by name so profiling does not import pandas
+DECODER_TAGS = ('FileDecoder', 'StreamDecoder', 'CompressedDecoder',
+                'ZipfileDecoder', 'TarfileDecoder', 'DirectoryDecoder')
+
+
+def frame_name(frame) -> str:
+    code = frame.f_code
+    name = getattr(code, 'co_qualname', code.co_name)
+    module = frame.f_globals.get('__name__', '?')
+    return '{}:{}'.format(module, name)
+
+
+def decoder_tag(names: List[str]):
+    """The innermost Decoder subclass on a stack of qualified names"""
+    for name in reversed(names):
+        for tag in DECODER_TAGS:
+            if '.{}.'.format(tag) in name:
+                return tag
+    return None
+
+
+def collapse(frame) -> str:
+    """A stack as a collapsed line, outermost frame first"""
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    names.reverse()
+    tag = decoder_tag(names)
+    if tag is not None:
+        names.insert(0, '[{}]'.format(tag))
+    return ';'.join(names)
+
+
+class Sampler(threading.Thread):
+    """Samples the stacks of other threads at a fixed interval"""
+
+    def __init__(self, thread_ids: set = None,
+                 interval: float = SAMPLE_SECONDS):
+        super().__init__(name='profile-sampler', daemon=True)
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                if self.thread_ids is not None and (
+                    thread_id not in self.thread_ids
+                ):
+                    continue
+                self.stacks[collapse(frame)] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write(self, path: str):
+        with open(path, 'w') as fh:
+            for stack, count in self.stacks.most_common():
+                fh.write('{} {}\n'.format(stack, count))
+
+
+class Session(object):
+    def __init__(self, directory: str, all_threads: bool, top: int):
+        self.directory = directory
+        self.top = top
+        self.profiles: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+        self.sampler = Sampler(
+            None if all_threads else {threading.get_ident()}
+        )
+        self.started_tracemalloc = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEBACK_FRAMES)
+            self.started_tracemalloc = True
+        self.sampler.start()
+
+    @contextmanager
+    def profiled(self):
+        """Profiles the enclosed block in the current thread"""
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ profiles every thread with the first profile
+            yield
+            return
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self._lock:
+                self.profiles.append(profile)
+
+    def stop(self):
+        self.sampler.stop()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if self.started_tracemalloc:
+            tracemalloc.stop()
+        os.makedirs(self.directory, exist_ok=True)
+        self.write_stats()
+        self.write_allocations(snapshot, peak)
+        self.sampler.write(os.path.join(self.directory, 'stacks.collapsed'))
+        cprint('Profile written to {}'.format(self.directory), 'blue')
+
+    def write_stats(self):
+        if not self.profiles:
+            return
+        stats = pstats.Stats(self.profiles[0])
+        for profile in self.profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(os.path.join(self.directory, 'profile.pstats'))
+        text = io.StringIO()
+        stats.stream = text
+        stats.sort_stats('cumulative').print_stats(self.top)
+        with open(os.path.join(self.directory, 'profile.txt'), 'w') as fh:
+            fh.write(text.getvalue())
+
+    def write_allocations(self, snapshot, peak: int):
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+        ))
+        with open(os.path.join(self.directory, 'allocations.txt'), 'w') as fh:
+            fh.write('Peak traced memory: {:.1f} MiB\n\n'.format(
+                peak / 2 ** 20
+            ))
+            for i, stat in enumerate(
+                snapshot.statistics('traceback')[:self.top], start=1
+            ):
+                fh.write('#{}: {:.1f} KiB in {} blocks\n'.format(
+                    i, stat.size / 1024, stat.count
+                ))
+                for line in stat.traceback.format(limit=TRACEBACK_FRAMES,
+                                                  most_recent_first=True):
+                    fh.write(line + '\n')
+                fh.write('\n')
+
+
+_session: Session = None
+
+
+def current() -> Session:
+    return _session
+
+
+@contextmanager
+def session(mode: str, label: str):
+    """
+    Profiles the enclosed block if --profile is set to mode.
+
+    :param mode: exec profiles every thread, decode only the current one
+    :param label: Names the output directory
+    """
+    global _session
+    if not flags.FLAGS.is_parsed() or flags.FLAGS.profile != mode or (
+        _session is not None
+    ):
+        yield
+        return
+    directory = os.path.join(
+        flags.FLAGS.profile_dir or PROFILE_DIR,
+        '{}-{}'.format(label, datetime.now().strftime('%Y%m%d-%H%M%S%f')),
+    )
+    _session = Session(directory, mode == 'exec', flags.FLAGS.profile_top)
+    _session.start()
+    try:
+        with _session.profiled():
+            yield
+    finally:
+        s, _session = _session, None
+        s.stop()
+
+
+def profiled(fn: callable, *args, **kwargs):
+    """Calls fn, profiling it in the current thread if a whole-run
+    session is active"""
+    s = _session
+    if s is None or s.sampler.thread_ids is not None:
+        return fn(*args, **kwargs)
+    with s.profiled():
+        return fn(*args, **kwargs)
@@ -24,6 +24,7 @@ last_package = None
 while True:
     try:
         import bootstrapper
+        bootstrapper.check_dependencies()
         break
     except ImportError as err:
         if counter == -1:
@@ -45,8 +46,12 @@ while True:
 
 from absl import flags
 import flagmaker.settings as settings
+import profiling
+import run_report
 
 if __name__ == '__main__':
     bootstrap = bootstrapper.Bootstrap()
     flags.adopt_module_key_flags(settings)
+    flags.adopt_module_key_flags(run_report)
+    flags.adopt_module_key_flags(profiling)
     bootstrap.run()
@@ -0,0 +1,316 @@
+# /***********************************************************************
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Note that these code samples being shared are not official Google
+# products and are not formally supported.
+# ************************************************************************/
+
+"""
+Timed spans and counters for a structured report of each run.
+
+Stages open spans with span(); API calls, bytes moved and BigQuery job
+statistics are counted on the innermost open span. The current span is a
+context variable, so it follows coroutines and offloaded calls. At the end
+of a run the report is written as JSON, and optionally as an OpenTelemetry
+(OTLP/JSON) trace file.
+"""
+import contextvars
+import functools
+import json
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict
+from typing import List
+
+from absl import flags
+from termcolor import cprint
+
+import memory
+from flagmaker.cache import atomic_write
+
+flags.DEFINE_string(
+    'run_report', None,
+    'Where to write the JSON run report. Defaults to a timestamped file in '
+    '~/.sa360bq-reports.'
+)
+flags.DEFINE_string(
+    'otlp_trace_file', None,
+    'Also write the spans of the run as an OpenTelemetry (OTLP/JSON) trace '
+    'to this file.'
+)
+
+REPORT_DIR = '{}/.sa360bq-reports'.format(os.environ['HOME'])
+SERVICE_NAME = 'sa360-bigquery-bootstrapper'
+
+# BigQuery job properties recorded by record_job
+JOB_STATISTICS = (
+    'total_bytes_billed',
+    'total_bytes_processed',
+    'slot_millis',
+    'input_file_bytes',
+    'output_bytes',
+    'output_rows',
+)
+
+
+class Span(object):
+    def __init__(self, name: str, parent: 'Span' = None, **attributes):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.counters: Dict[str, int] = {}
+        self.children: List[Span] = []
+        self.span_id = secrets.token_hex(8)
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.start = time.time()
+        self.end = None
+        self.error = None
+        self._lock = threading.Lock()
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.time()) - self.start
+
+    def add(self, counter: str, value: int = 1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def totals(self) -> Dict[str, int]:
+        """Counters of this span and all of its descendants"""
+        totals = dict(self.counters)
+        for child in self.children:
+            for k, v in child.totals().items():
+                totals[k] = totals.get(k, 0) + v
+        return totals
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def to_dict(self) -> dict:
+        result = {
+            'name': self.name,
+            'attributes': self.attributes,
+            'start': datetime.fromtimestamp(self.start).isoformat(),
+            'duration_seconds': round(self.duration, 3),
+            'counters': self.counters,
+            'totals': self.totals(),
+        }
+        if self.error is not None:
+            result['error'] = self.error
+        if self.children:
+            result['children'] = [c.to_dict() for c in self.children]
+        return result
+
+
+class Report(object):
+    def __init__(self):
+        self.spans: List[Span] = []
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def add_root(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def totals(self) -> Dict[str, int]:
+        totals = {}
+        for span in self.spans:
+            for k, v in span.totals().items():
+                totals[k] = totals.get(k, 0) + v
+        return totals
+
+    def to_dict(self) -> dict:
+        return {
+            'started': datetime.fromtimestamp(self.start).isoformat(),
+            'duration_seconds': round(time.time() - self.start, 3),
+            'peak_rss_mb': memory.peak_rss_bytes() // 2 ** 20,
+            'totals': self.totals(),
+            'spans': [s.to_dict() for s in self.spans],
+        }
+
+    def to_otlp(self) -> dict:
+        def value(v):
+            if isinstance(v, bool):
+                return {'boolValue': v}
+            if isinstance(v, int):
+                return {'intValue': str(v)}
+            if isinstance(v, float):
+                return {'doubleValue': v}
+            return {'stringValue': str(v)}
+
+        def attributes(d: dict):
+            return [{'key': k, 'value': value(v)} for k, v in d.items()]
+
+        spans = []
+        for root in self.spans:
+            for span in root.walk():
+                otlp_span = {
+                    'traceId': span.trace_id,
+                    'spanId': span.span_id,
+                    'name': span.name,
+                    'kind': 1,
+                    'startTimeUnixNano': str(int(span.start * 1e9)),
+                    'endTimeUnixNano': str(
+                        int((span.end or time.time()) * 1e9)
+                    ),
+                    'attributes': attributes(
+                        dict(span.attributes, **span.counters)
+                    ),
+                    'status': (
+                        {'code': 2, 'message': span.error}
+                        if span.error is not None else {'code': 1}
+                    ),
+                }
+                if span.parent is not None:
+                    otlp_span['parentSpanId'] = span.parent.span_id
+                spans.append(otlp_span)
+        return {'resourceSpans': [{
+            'resource': {
+                'attributes': attributes({'service.name': SERVICE_NAME}),
+            },
+            'scopeSpans': [{'scope': {'name': 'bootstrapper'},
+                            'spans': spans}],
+        }]}
+
+    def write(self, path: str = None, otlp_path: str = None) -> str:
+        """Writes the JSON report, and the OTLP trace if otlp_path is set.
+
+        :return: The path of the JSON report
+        """
+        if path is None:
+            os.makedirs(REPORT_DIR, exist_ok=True)
+            path = os.path.join(REPORT_DIR, 'run-{}.json'.format(
+                datetime.fromtimestamp(self.start).strftime('%Y%m%d-%H%M%S')
+            ))
+        atomic_write(path, json.dumps(self.to_dict(), indent=2, default=str))
+        if otlp_path is not None:
+            atomic_write(otlp_path, json.dumps(self.to_otlp()))
+        return path
+
+    def print_summary(self):
+        cprint('Run summary', attrs=['bold'])
+        for root in self.spans:
+            for span in root.walk():
+                depth = 0
+                parent = span.parent
+                while parent is not None:
+                    depth += 1
+                    parent = parent.parent
+                totals = span.totals()
+                calls = sum(v for k, v in totals.items()
+                            if k.startswith('api_calls.'))
+                cprint('{}{:<{}} {:>8.1f}s {:>5} calls{}'.format(
+                    '  ' * depth, span.name, 40 - 2 * depth, span.duration,
+                    calls,
+                    ' [failed]' if span.error is not None else ''
+                ), 'red' if span.error is not None else None)
+                if 'memory_high_water_mb' in span.attributes:
+                    cprint('{}memory high-water mark {} MiB of {} MiB'.format(
+                        '  ' * (depth + 1),
+                        span.attributes['memory_high_water_mb'],
+                        span.attributes.get('memory_limit_mb', '?'),
+                    ))
+        cprint('Peak memory {} MiB'.format(
+            memory.peak_rss_bytes() // 2 ** 20
+        ))
+
+
+_report = Report()
+_current: contextvars.ContextVar = contextvars.ContextVar(
+    'run_report_span', default=None
+)
+
+
+def get_report() -> Report:
+    return _report
+
+
+def reset() -> Report:
+    global _report
+    _report = Report()
+    return _report
+
+
+def current() -> Span:
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Times the enclosed block as a child of the current span"""
+    parent = _current.get()
+    s = Span(name, parent, **attributes)
+    if parent is None:
+        _report.add_root(s)
+    else:
+        with parent._lock:
+            parent.children.append(s)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as err:
+        s.error = '{}: {}'.format(type(err).__name__, err)
+        raise
+    finally:
+        s.end = time.time()
+        _current.reset(token)
+
+
+def timed(name: str, attribute: str = None):
+    """Decorates a coroutine method to run in a span.
+
+    :param name: Name of the span
+    :param attribute: If set, the first argument after self is recorded
+        under this attribute name (its value, for enums)
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(self, *args, **kwargs):
+            attributes = {}
+            if attribute is not None:
+                attributes[attribute] = getattr(args[0], 'value', args[0])
+            with span(name, **attributes):
+                return await fn(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add(counter: str, value: int = 1):
+    """Adds value to a counter of the current span, if there is one"""
+    s = _current.get()
+    if s is not None:
+        s.add(counter, value)
+
+
+def annotate(**attributes):
+    """Sets attributes of the current span, if there is one"""
+    s = _current.get()
+    if s is not None:
+        s.attributes.update(attributes)
+
+
+def record_job(job):
+    """Adds the statistics of a finished BigQuery job to the current span"""
+    add('bigquery_jobs')
+    for statistic in JOB_STATISTICS:
+        value = getattr(job, statistic, None)
+        if isinstance(value, int):
+            add('bigquery.' + statistic, value)
@@ -16,15 +16,171 @@
 # Note that these code samples being shared are not official Google
 # products and are not formally supported.
 # ************************************************************************/
+import asyncio
+import io
+import json
 import os
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+from datetime import datetime
+from unittest import mock
 
 import pandas as pd
 
+import api_calls
 import app_settings
+import async_runner
+import clients
+import profiling
+import run_report
+import uploads
+from checkpoint import Checkpoints
+from fakes import FakeRegistry
+from fakes import FakeTransferClient
+from memory import MIN_CHUNK_ROWS
+from memory import MemoryBudget
+from clients import ClientRegistry
 from csv_decoder import Decoder
+from csv_decoder import Source
+from prefetch import Prefetcher
+from utilities import FINGERPRINT_COLUMN
+from utilities import FINGERPRINT_SOURCE_COLUMNS
+from utilities import Locale
+from utilities import SettingUtil
 from utilities import ViewTypes
 from utilities import get_view_name
+from utilities import join_fingerprint
+from utilities import join_fingerprint_sql
+
+
+def import_times(module: str) -> dict:
+    """Cumulative import time in microseconds of every module loaded by
+    importing module in a fresh interpreter (python -X importtime)."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        raise ImportError(result.stderr)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def column(name: str, dtype: str) -> mock.Mock:
+    """A historical column setting as the Decoder reads it"""
+    return mock.Mock(value=name, default=name, attrs={'dtype': dtype})
+
+
+def single_gzip_member(path: str) -> bytes:
+    """The content of a gzip file as read by a reader that stops after the
+    first member. Fails if the file has more than one."""
+    import zlib
+
+    with open(path, 'rb') as fh:
+        compressed = fh.read()
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    content = decompressor.decompress(compressed)
+    if not decompressor.eof or decompressor.unused_data:
+        raise AssertionError('{} is not a single gzip member'.format(path))
+    return content
+
+
+def fake_views(tmp: str, settings: dict) -> 'CreateViews':
+    """CreateViews for advertiser settings against a fake BigQuery client
+    (views.client) with empty raw and views datasets"""
+    from google.cloud import bigquery
+    from views import CreateViews
+    from views import DataSets
+
+    client = FakeRegistry(tmp).bigquery('project')
+    views = CreateViews.__new__(CreateViews)
+    views.client = client
+    views.project = 'project'
+    views.datasets = DataSets()
+    for dataset in ('raw', 'views'):
+        client.create_dataset('project.' + dataset)
+        setattr(views.datasets, dataset,
+                bigquery.Dataset('project.' + dataset))
+    views.s = SettingUtil({
+        k: mock.Mock(value=v) for k, v in settings.items()
+    })
+    return views
+
+
+def offline_run(tmp: str, historical: pd.DataFrame, advertisers: list,
+                *args) -> dict:
+    """Runs every advertiser against the local stand-ins (fakes.py) with
+    historical as their Cloud Shell upload, and returns the run report.
+
+    :param tmp: A directory for the inputs, fake GCP state and report
+    :param args: Extra command line flags
+    """
+    path = os.path.join(tmp, 'historical.csv')
+    historical.to_csv(path, index=False)
+    os.makedirs(os.path.join(tmp, 'gcp', 'bucket'))
+    settings_file = os.path.join(tmp, 'settings.json')
+    with open(settings_file, 'w') as fh:
+        json.dump({
+            'defaults': {
+                'gcp_project_name': 'project',
+                'agency_id': '1',
+                'has_historical_data': True,
+                'storage_bucket': 'bucket',
+                'file_location': 'Cloud Shell Upload',
+                'file_path': path,
+                'first_date_conversions': '2019-01-01',
+            },
+            'entries': [{'advertiser_id': a} for a in advertisers],
+        }, fh)
+    report_file = os.path.join(tmp, 'report.json')
+    result = subprocess.run(
+        [sys.executable, 'fakes.py',
+         '--fake_root=' + os.path.join(tmp, 'gcp'),
+         '--settings_file=' + settings_file,
+         '--run_report=' + report_file] + list(args),
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        raise AssertionError(result.stderr)
+    with open(report_file) as fh:
+        return json.load(fh)
+
+
+class StartupTest(unittest.TestCase):
+    MAX_IMPORT_SECONDS = 1.0
+    HEAVY_MODULES = (
+        'numpy',
+        'pandas',
+        'google.cloud.bigquery',
+        'google.cloud.bigquery_datatransfer',
+        'google.cloud.storage',
+        'googleapiclient.discovery',
+        'prompt_toolkit',
+    )
+
+    def test_import_time(self):
+        times = import_times('bootstrapper')
+        for module in self.HEAVY_MODULES:
+            self.assertNotIn(module, times,
+                             '{} is imported at startup'.format(module))
+        self.assertLess(
+            times['bootstrapper'] / 1e6, self.MAX_IMPORT_SECONDS,
+            'Importing bootstrapper took {:.2f}s'.format(
+                times['bootstrapper'] / 1e6
+            )
+        )
 
 
 class AppSettingsTest(unittest.TestCase):
@@ -38,6 +194,60 @@ class AppSettingsTest(unittest.TestCase):
         dict_map = {val.value:val.default for val in s.columns.values()}
         self.assertIn('Account', dict_map)
 
+    def test_settings_file_date_is_not_prompted(self):
+        from flagmaker.settings import load_settings_file
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'settings.yaml')
+            with open(path, 'w') as fh:
+                fh.write(
+                    'defaults:\n'
+                    '  gcp_project_name: project\n'
+                    '  has_historical_data: true\n'
+                    'entries:\n'
+                    '  - advertiser_id: 10\n'
+                    '    first_date_conversions: 02/01/2019\n'
+                )
+            [values] = load_settings_file(path)
+            previous = clients.get_registry()
+            clients.set_registry(FakeRegistry(tmp))
+            try:
+                s = app_settings.AppSettings()
+                s.build()
+                with mock.patch('prompt_toolkit.prompt',
+                                side_effect=AssertionError('prompted')):
+                    errors = s.load_values(values)
+            finally:
+                clients.set_registry(previous)
+        self.assertIn(
+            'first_date_conversions: Date 02/01/2019 is not in yyyy-mm-dd '
+            'format. Example: 1999-12-31', errors
+        )
+
+
+class BatchPrefetchTest(unittest.TestCase):
+    def test_loaded_values_do_not_prefetch(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            registry = FakeRegistry(tmp)
+            previous = clients.get_registry()
+            clients.set_registry(registry)
+            try:
+                s = app_settings.AppSettings()
+                s.build()
+                s.load_values({
+                    'gcp_project_name': 'project',
+                    'location': 'US',
+                    'raw_dataset': 'raw',
+                    'view_dataset': 'views',
+                })
+                self.assertIn('storage_client', s.custom)
+                self.assertEqual(s.hooks.prefetch._futures, {})
+                self.assertEqual(
+                    sum(registry.storage('project').calls.values()), 0
+                )
+            finally:
+                clients.set_registry(previous)
+
 
 class UtilitiesTest(unittest.TestCase):
     def test_types(self):
@@ -46,6 +256,35 @@ class UtilitiesTest(unittest.TestCase):
             'KeywordMapper_123'
         )
 
+    def test_join_fingerprint(self):
+        fingerprint = join_fingerprint(
+            'keyword', 'campaign', 'account', 'ad group', 'Exact'
+        )
+        self.assertEqual(fingerprint, join_fingerprint(
+            'keyword', 'campaign', 'account', 'ad group', 'exact'
+        ))
+        self.assertNotEqual(fingerprint, join_fingerprint(
+            'keyword', 'campaign', 'account', 'Ad Group', 'exact'
+        ))
+        self.assertLess(fingerprint, 2 ** 63)
+        self.assertIsNone(join_fingerprint(
+            'keyword', float('nan'), 'account', 'ad group', 'exact'
+        ))
+
+    def test_join_fingerprint_numeric(self):
+        # pandas reads numeric names as numbers, BigQuery casts to STRING
+        fingerprint = join_fingerprint(
+            '2024', '123', 'account', 'ad group', 'exact'
+        )
+        self.assertEqual(fingerprint, join_fingerprint(
+            2024, 123.0, 'account', 'ad group', 'exact'
+        ))
+        self.assertIn(
+            'CAST(c.campaign AS STRING)',
+            join_fingerprint_sql('k.keyword', 'c.campaign', 'a.account',
+                                 'g.adGroup', 'k.matchType')
+        )
+
 
 class CSVDecoderTest(unittest.TestCase):
     def test_size(self):
@@ -59,6 +298,956 @@ class CSVDecoderTest(unittest.TestCase):
         desired_list = ['I','a','c','e','g','k','m']
         self.assertListEqual(sorted(df['only_column'].values), desired_list)
 
+    def test_only_non_spreadsheets_are_read_as_csv(self):
+        from csv_decoder import EXCEL_FORMAT_UNKNOWN
+
+        file_decoder = Decoder.FileDecoder(mock.Mock(), 'historical')
+        for error, as_csv in (
+            (ValueError(EXCEL_FORMAT_UNKNOWN + ', specify an engine'), True),
+            (ValueError('Unable to parse string "x"'), False),
+        ):
+            with mock.patch.object(
+                file_decoder, 'decode_excel', side_effect=error
+            ), mock.patch.object(file_decoder, 'decode_csv') as decode_csv:
+                if as_csv:
+                    file_decoder.run()
+                else:
+                    self.assertRaises(ValueError, file_decoder.run)
+                self.assertEqual(decode_csv.called, as_csv)
+
+
+class PrefetchTest(unittest.TestCase):
+    def test_get(self):
+        prefetcher = Prefetcher()
+        prefetcher.submit('key', lambda: 'prefetched')
+        self.assertEqual(prefetcher.get('key', lambda: 'live'), 'prefetched')
+        # results are only handed out once
+        self.assertEqual(prefetcher.get('key', lambda: 'live'), 'live')
+        prefetcher.shutdown()
+
+    def test_missing_resource_is_fetched_live(self):
+        prefetcher = Prefetcher()
+        prefetcher.submit('tables', lambda: set())
+        # the table was created after the prefetch was taken
+        self.assertEqual(prefetcher.get(
+            'tables', lambda: {'Historical_10'},
+            missing=lambda ids: 'Historical_10' not in ids,
+        ), {'Historical_10'})
+        prefetcher.submit('tables', lambda: {'Historical_10'})
+        self.assertEqual(prefetcher.get(
+            'tables', lambda: set(),
+            missing=lambda ids: 'Historical_10' not in ids,
+        ), {'Historical_10'})
+        prefetcher.shutdown()
+
+    def test_failed_prefetch_falls_back(self):
+        def fail():
+            raise ValueError()
+
+        prefetcher = Prefetcher()
+        prefetcher.submit('key', fail)
+        self.assertEqual(prefetcher.get('key', lambda: 'live'), 'live')
+        prefetcher.shutdown()
+
+
+class ClientRegistryTest(unittest.TestCase):
+    def test_clients_are_shared(self):
+        registry = ClientRegistry()
+        created = []
+
+        def factory():
+            created.append(object())
+            return created[-1]
+
+        first = registry._get(('bigquery', 'project', 'US'), factory)
+        self.assertIs(registry._get(('bigquery', 'project', 'US'), factory),
+                      first)
+        self.assertIsNot(registry._get(('bigquery', 'other', 'US'), factory),
+                         first)
+        self.assertEqual(len(created), 2)
+
+
+class CheckpointsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def checkpoints(self, fresh=False):
+        return Checkpoints('project', '123', self.dir.name, fresh=fresh)
+
+    def test_resumes_at_first_incomplete_stage(self):
+        checkpoints = self.checkpoints()
+        checkpoints.complete('datasets', {'raw': 'raw'})
+        checkpoints.complete('transfer', {'advertiser': '123'})
+
+        checkpoints = self.checkpoints()
+        self.assertTrue(checkpoints.done('datasets', {'raw': 'raw'}))
+        self.assertTrue(checkpoints.done('transfer', {'advertiser': '123'}))
+        self.assertFalse(checkpoints.done('views', {}))
+
+    def test_changed_inputs_rerun_later_stages(self):
+        checkpoints = self.checkpoints()
+        checkpoints.complete('datasets', {'raw': 'raw'})
+        checkpoints.complete('transfer', {'advertiser': '123'})
+
+        checkpoints = self.checkpoints()
+        self.assertFalse(checkpoints.done('datasets', {'raw': 'other'}))
+        self.assertFalse(checkpoints.done('transfer', {'advertiser': '123'}))
+
+    def test_fresh_run(self):
+        self.checkpoints().complete('datasets', {'raw': 'raw'})
+        self.assertFalse(
+            self.checkpoints(fresh=True).done('datasets', {'raw': 'raw'})
+        )
+
+    def test_failed_view_is_not_checkpointed(self):
+        from google.api_core.exceptions import NotFound
+        from google.cloud import bigquery
+        from bootstrapper import Bootstrap
+        from views import CreateViews
+        from views import DataSets
+
+        datasets = DataSets()
+        datasets.views = bigquery.Dataset('project.views')
+        views = CreateViews.__new__(CreateViews)
+        views.datasets = datasets
+        views.report_view = lambda advertiser: 'SELECT 1'
+        views.client = mock.Mock(
+            get_table=mock.Mock(side_effect=NotFound('no table')),
+            create_table=mock.Mock(side_effect=NotFound('no dataset')),
+        )
+        bootstrap = Bootstrap.__new__(Bootstrap)
+        bootstrap.checkpoints = self.checkpoints()
+        with self.assertRaises(NotFound):
+            async_runner.run(bootstrap.stage(
+                'views', {}, views.view, ViewTypes.REPORT_VIEW,
+                'report_view', '123'
+            ))
+        self.assertFalse(self.checkpoints().done('views', {}))
+
+
+class ApiError(Exception):
+    def __init__(self, code, reason=None):
+        super().__init__(code)
+        self.code = code
+        self.errors = [{'reason': reason}] if reason else []
+
+
+class ApiCallsTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(api_calls.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def flaky(self, *errors):
+        errors = list(errors)
+
+        def fn():
+            if errors:
+                raise errors.pop(0)
+            return 'done'
+        return fn
+
+    def test_classification(self):
+        self.assertTrue(api_calls.is_retryable(ApiError(429)))
+        self.assertTrue(api_calls.is_retryable(
+            ApiError(403, 'rateLimitExceeded'), idempotent=False
+        ))
+        self.assertTrue(api_calls.is_retryable(ApiError(503)))
+        self.assertFalse(api_calls.is_retryable(ApiError(503),
+                                                idempotent=False))
+        self.assertFalse(api_calls.is_retryable(ApiError(404)))
+
+    def test_retries_until_success(self):
+        fn = self.flaky(ApiError(503), ApiError(429))
+        self.assertEqual(api_calls.call('bigquery', fn), 'done')
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def test_does_not_retry_permanent_errors(self):
+        with self.assertRaises(ApiError):
+            api_calls.call('bigquery', self.flaky(ApiError(400)))
+        with self.assertRaises(ApiError):
+            api_calls.call('transfer', self.flaky(ApiError(500)),
+                           idempotent=False)
+        self.sleep.assert_not_called()
+
+    def test_gives_up(self):
+        fn = self.flaky(*[ApiError(503)] * api_calls.MAX_ATTEMPTS)
+        with self.assertRaises(ApiError):
+            api_calls.call('bigquery', fn)
+        self.assertEqual(self.sleep.call_count, api_calls.MAX_ATTEMPTS - 1)
+
+    def test_quota_errors_slow_down_the_bucket(self):
+        bucket = api_calls.TokenBucket(10.0, 1)
+        bucket.throttle()
+        self.assertEqual(bucket.rate, 5.0)
+        for _ in range(20):
+            bucket.recover()
+        self.assertEqual(bucket.rate, 10.0)
+
+    def test_bucket_waits_for_tokens(self):
+        bucket = api_calls.TokenBucket(10.0, 1)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertTrue(self.sleep.called)
+
+
+class FakeJob(object):
+    def __init__(self, polls, result='result'):
+        self.polls = polls
+        self._result = result
+
+    def done(self):
+        self.polls -= 1
+        return self.polls <= 0
+
+    def result(self):
+        return self._result
+
+
+class AsyncRunnerTest(unittest.TestCase):
+    def test_run_job_polls_until_done(self):
+        job = FakeJob(3)
+        with mock.patch.object(async_runner, 'POLL_SECONDS', 0.001):
+            result = async_runner.run(async_runner.run_job(lambda: job))
+        self.assertEqual(result, 'result')
+        self.assertEqual(job.polls, 0)
+
+    def test_gather_limits_concurrency(self):
+        running = []
+        peak = []
+
+        async def task(i):
+            running.append(i)
+            peak.append(len(running))
+            await async_runner.offload(lambda: None)
+            running.remove(i)
+            return i
+
+        result = async_runner.run(
+            async_runner.gather((task(i) for i in range(10)), 3)
+        )
+        self.assertEqual(result, list(range(10)))
+        self.assertEqual(max(peak), 3)
+
+    def test_waits_do_not_hold_threads(self):
+        async def wait():
+            await async_runner.poll(
+                lambda: async_runner.offload(lambda: True)
+            )
+            return True
+
+        # many more concurrent waits than worker threads
+        result = async_runner.run(
+            async_runner.gather((wait() for _ in range(200)), 200),
+            max_workers=2,
+        )
+        self.assertTrue(all(result))
+
+    def test_failed_advertiser_does_not_stop_others(self):
+        from bootstrapper import Bootstrap
+        from exceptions import ReadError
+
+        finished = []
+
+        async def run_stages(bootstrap, settings):
+            bootstrap.s = SettingUtil(settings)
+            advertiser = settings['advertiser_id'].value
+            await asyncio.sleep(0.01 if advertiser == '11' else 0.05)
+            if advertiser == '11':
+                raise ReadError('bad file')
+            finished.append(advertiser)
+
+        all_settings = [{
+            'interactive': mock.Mock(value=False),
+            'gcp_project_name': mock.Mock(value='project'),
+            'advertiser_id': mock.Mock(value=advertiser),
+            'agency_views': mock.Mock(value=False),
+        } for advertiser in ('10', '11', '12')]
+        report = run_report.reset()
+        with mock.patch.object(Bootstrap, 'run_stages', run_stages):
+            failed = async_runner.run(
+                Bootstrap.__new__(Bootstrap).run_all(all_settings)
+            )
+        self.assertEqual(failed, ['11'])
+        self.assertEqual(sorted(finished), ['10', '12'])
+        self.assertEqual(
+            {s.attributes['advertiser']: s.error is None
+             for s in report.spans},
+            {'10': True, '11': False, '12': True}
+        )
+
+
+class RunReportTest(unittest.TestCase):
+    def test_spans_follow_offloaded_calls(self):
+        report = run_report.reset()
+
+        async def stage():
+            with run_report.span('stage'):
+                await async_runner.offload(run_report.add, 'gcs.bytes_up', 10)
+                await async_runner.call('bigquery', lambda: None)
+
+        with run_report.span('bootstrap', advertiser='123'):
+            async_runner.run(stage())
+        root, = report.spans
+        stage_span, = root.children
+        self.assertEqual(stage_span.counters,
+                         {'gcs.bytes_up': 10, 'api_calls.bigquery': 1})
+        self.assertEqual(report.totals()['gcs.bytes_up'], 10)
+
+    def test_write(self):
+        report = run_report.reset()
+        with self.assertRaises(ValueError):
+            with run_report.span('bootstrap'):
+                with run_report.span('load_datasets'):
+                    raise ValueError('failed')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = report.write(os.path.join(tmp, 'report.json'),
+                                os.path.join(tmp, 'trace.json'))
+            with open(path) as fh:
+                data = json.load(fh)
+            with open(os.path.join(tmp, 'trace.json')) as fh:
+                trace = json.load(fh)
+        child = data['spans'][0]['children'][0]
+        self.assertEqual(child['name'], 'load_datasets')
+        self.assertEqual(child['error'], 'ValueError: failed')
+        spans = trace['resourceSpans'][0]['scopeSpans'][0]['spans']
+        self.assertEqual(spans[1]['parentSpanId'], spans[0]['spanId'])
+        self.assertEqual(spans[1]['status']['code'], 2)
+
+
+class CountingReaderTest(unittest.TestCase):
+    def test_streamed_bytes_are_reported(self):
+        from bootstrapper import CountingReader
+
+        content = pd.DataFrame({'clicks': range(1000)}).to_csv(
+            index=False
+        ).encode('utf-8')
+        report = run_report.reset()
+        with run_report.span('bootstrap'):
+            with CountingReader(io.BytesIO(content), 'gcs.bytes_down') as fh:
+                df = pd.read_csv(fh)
+        self.assertEqual(len(df.index), 1000)
+        self.assertEqual(report.totals()['gcs.bytes_down'], len(content))
+
+
+class FakeDecoder(object):
+    class FileDecoder(object):
+        def run(self, seconds):
+            end = time.time() + seconds
+            rows = []
+            while time.time() < end:
+                rows.append(str(len(rows)))
+            return rows
+
+
+class ProfilingTest(unittest.TestCase):
+    def test_decoder_tag(self):
+        self.assertEqual(profiling.decoder_tag([
+            'bootstrapper:Bootstrap.combine_folder',
+            'csv_decoder:Decoder.ZipfileDecoder.run',
+            'csv_decoder:Decoder.FileDecoder.decode_csv',
+        ]), 'FileDecoder')
+        self.assertIsNone(profiling.decoder_tag(['views:CreateViews.run']))
+
+    def test_decoder_tags_cover_decoders(self):
+        subclasses = set()
+        pending = [Decoder.AbstractDecoder]
+        while pending:
+            for subclass in pending.pop().__subclasses__():
+                subclasses.add(subclass.__name__)
+                pending.append(subclass)
+        self.assertEqual(set(profiling.DECODER_TAGS),
+                         subclasses - {'ChooseyDecoder'})
+
+    def test_session_writes_reports(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            session = profiling.Session(tmp, all_threads=False, top=5)
+            session.start()
+            with session.profiled():
+                FakeDecoder.FileDecoder().run(0.2)
+            session.stop()
+            self.assertEqual(sorted(os.listdir(tmp)), [
+                'allocations.txt', 'profile.pstats', 'profile.txt',
+                'stacks.collapsed',
+            ])
+            with open(os.path.join(tmp, 'stacks.collapsed')) as fh:
+                self.assertIn('[FileDecoder];', fh.read())
+
+
+class MemoryBudgetTest(unittest.TestCase):
+    def test_rows_for(self):
+        budget = MemoryBudget(max_memory_mb=10 ** 6)
+        self.assertGreater(budget.rows_for(100), MIN_CHUNK_ROWS)
+        # chunks never grow back within a budget
+        self.assertEqual(budget.rows_for(1), budget.rows_for(100))
+        budget = MemoryBudget(max_memory_mb=1)
+        self.assertEqual(budget.rows_for(100), MIN_CHUNK_ROWS)
+        self.assertGreater(budget.high_water, 0)
+
+    def test_relieve_halves_chunks(self):
+        budget = MemoryBudget(max_memory_mb=1)
+        budget.chunk_rows = 8000
+        self.assertTrue(budget.relieve())
+        self.assertEqual(budget.chunk_rows, 4000)
+        budget = MemoryBudget(max_memory_mb=10 ** 6)
+        self.assertFalse(budget.relieve())
+
+    def test_available_bytes(self):
+        from memory import CGROUP_LIMITS
+        from memory import available_bytes
+
+        system = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+        v2, v1 = CGROUP_LIMITS
+        for limits, expected in (
+            ({v2: '1073741824\n'}, 2 ** 30),
+            ({v2: 'max\n'}, system),
+            ({v1: '536870912\n'}, 2 ** 29),
+            # the cgroup v1 value without a limit
+            ({v1: '9223372036854771712\n'}, system),
+            ({}, system),
+        ):
+            def fake_open(path, *args, **kwargs):
+                if path not in limits:
+                    raise FileNotFoundError(path)
+                return io.StringIO(limits[path])
+
+            with mock.patch('builtins.open', fake_open):
+                self.assertEqual(available_bytes(), expected)
+
+    def test_decode_in_chunks(self):
+        budget = MemoryBudget()
+        budget.chunk_rows = MIN_CHUNK_ROWS
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'in.csv')
+            pd.DataFrame({
+                'date': ['2019-01-02'] * 2500,
+                'clicks': range(2500),
+            }).to_csv(path, index=False)
+            decoder = Decoder('utf-8', path, None, {
+                'date': column('date', 'datetime64'),
+                'clicks': column('clicks', 'int64'),
+            }, dest='out.csv', budget=budget)
+            decoder.dir = tmp
+            Decoder.FileDecoder(decoder, path).decode_csv()
+            df = pd.read_csv(os.path.join(tmp, 'out.csv'))
+        self.assertEqual(len(df.index), 2500)
+        self.assertListEqual(list(df['clicks']), list(range(2500)))
+
+
+class StreamDecoderTest(unittest.TestCase):
+    def test_decode_sources(self):
+        import zipfile
+
+        def source(name, content: bytes):
+            opened = []
+
+            def open_stream():
+                opened.append(name)
+                return io.BytesIO(content)
+            return Source(name, open_stream), opened
+
+        csv = pd.DataFrame({
+            'date': ['2019-01-02'] * 10, 'clicks': range(10),
+        }).to_csv(index=False).encode('utf-8')
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, 'w') as zh:
+            zh.writestr('inner.csv', csv)
+        streamed, streamed_opens = source('history/a.csv', csv)
+        spooled, spooled_opens = source('history/b.zip', archive.getvalue())
+        with tempfile.TemporaryDirectory() as tmp:
+            decoder = Decoder('utf-8', [streamed, spooled], Locale.US, {
+                'date': column('date', 'datetime64'),
+                'clicks': column('clicks', 'int64'),
+            })
+            decoder.dir = tmp
+            Decoder.ChooseyDecoder(decoder, decoder.path).run()
+            df = pd.read_csv(os.path.join(tmp, 'out.csv'))
+        self.assertEqual(len(df.index), 20)
+        # the zip file is opened to check for compression, and to spool it
+        self.assertEqual(len(spooled_opens), 2)
+        self.assertGreater(len(streamed_opens), 1)
+
+
+class CompressionTest(unittest.TestCase):
+    def test_decode_compressed(self):
+        import gzip
+
+        df = pd.DataFrame({'date': ['2019-01-02'] * 10, 'clicks': range(10)})
+        with tempfile.TemporaryDirectory() as tmp:
+            history = os.path.join(tmp, 'history')
+            os.mkdir(history)
+            for name in ('a.csv.gz', 'b.csv.bz2', 'c.csv.xz'):
+                df.to_csv(os.path.join(history, name), index=False)
+            # recognized by content, not by name
+            df.to_csv(os.path.join(history, 'd.export'), index=False,
+                      compression='gzip')
+            streamed = Source('e.csv.gz', lambda: io.BytesIO(gzip.compress(
+                df.to_csv(index=False).encode('utf-8')
+            )))
+            decoder = Decoder('utf-8', [history, streamed], Locale.US, {
+                'date': column('date', 'datetime64'),
+                'clicks': column('clicks', 'int64'),
+            })
+            decoder.dir = tmp
+            Decoder.ChooseyDecoder(decoder, decoder.path).run()
+            result = pd.read_csv(os.path.join(tmp, 'out.csv'))
+        self.assertEqual(len(result.index), 50)
+
+    def test_compress_output(self):
+        budget = MemoryBudget()
+        budget.chunk_rows = MIN_CHUNK_ROWS
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'in.csv')
+            pd.DataFrame({
+                'date': ['2019-01-02'] * 2500,
+                'clicks': range(2500),
+            }).to_csv(path, index=False)
+            decoder = Decoder('utf-8', path, None, {
+                'date': column('date', 'datetime64'),
+                'clicks': column('clicks', 'int64'),
+            }, dest='out.csv.gz', budget=budget, compress=True)
+            decoder.dir = tmp
+            Decoder.FileDecoder(decoder, path).decode_csv()
+            decoder.close_output()
+            out = os.path.join(tmp, 'out.csv.gz')
+            # every chunk is in the first member
+            content = single_gzip_member(out)
+            self.assertLess(os.path.getsize(out), os.path.getsize(path))
+        df = pd.read_csv(io.BytesIO(content))
+        self.assertListEqual(list(df['clicks']), list(range(2500)))
+
+    def test_rollback_output(self):
+        from csv_decoder import GzipOutput
+
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, 'out.csv.gz')
+            with GzipOutput(out) as fh:
+                fh.write('dropped\n')
+                fh.rollback(fh.start)
+                fh.write('kept\n')
+                state = fh.checkpoint()
+                fh.write('dropped\n' * 1000)
+                fh.checkpoint()
+                fh.rollback(state)
+                fh.write('kept\n')
+            self.assertEqual(single_gzip_member(out), b'kept\nkept\n')
+
+
+class ScratchTest(unittest.TestCase):
+    def test_decoders_do_not_share_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            scratch = os.path.join(tmp, 'scratch')
+            os.mkdir(scratch)
+            decoders = []
+            for rows in (10, 20):
+                path = os.path.join(tmp, '{}.csv'.format(rows))
+                pd.DataFrame({
+                    'date': ['2019-01-02'] * rows,
+                    'clicks': range(rows),
+                }).to_csv(path, index=False)
+                decoders.append(Decoder('utf-8', path, Locale.US, {
+                    'date': column('date', 'datetime64'),
+                    'clicks': column('clicks', 'int64'),
+                }, scratch=scratch))
+            with decoders[0] as first:
+                with decoders[1] as second:
+                    outputs = [first.run(), second.run()]
+                    self.assertNotEqual(*outputs)
+                # the second decoder only removed its own output
+                self.assertTrue(os.path.exists(outputs[0]))
+                self.assertFalse(os.path.exists(outputs[1]))
+                self.assertEqual(len(pd.read_csv(outputs[0]).index), 10)
+            self.assertEqual(os.listdir(scratch), [])
+
+    def test_time(self):
+        decoder = Decoder('utf-8', '', Locale.US, {})
+        with mock.patch('csv_decoder.datetime') as dt:
+            dt.now.return_value = datetime(2019, 1, 2, 3, 4, 5, 6)
+            self.assertEqual(decoder.time, '20190102030405000006')
+
+
+class AgencyTest(unittest.TestCase):
+    def setUp(self):
+        from google.cloud import bigquery
+
+        self.dir = tempfile.TemporaryDirectory()
+        self.registry = FakeRegistry(self.dir.name)
+        self.previous = clients.get_registry()
+        clients.set_registry(self.registry)
+        self.client = self.registry.bigquery('project')
+        for dataset in ('raw', 'views'):
+            self.client.create_dataset('project.' + dataset)
+        for advertiser, columns in (
+            # loaded before the fingerprint column existed
+            ('10', ['revenue']),
+            ('11', ['device_segment', FINGERPRINT_COLUMN]),
+        ):
+            self.client.create_table(bigquery.Table(
+                'project.raw.Historical_' + advertiser,
+                schema=[bigquery.SchemaField(c, 'STRING') for c in
+                        ['date'] + list(FINGERPRINT_SOURCE_COLUMNS)
+                        + columns],
+            ))
+
+    def tearDown(self):
+        clients.set_registry(self.previous)
+        self.dir.cleanup()
+
+    def member(self, advertiser, **values):
+        from google.cloud.bigquery import Dataset
+        from bootstrapper import Bootstrap
+        from views import DataSets
+
+        settings = app_settings.AppSettings()
+        settings.build()
+        values = dict({
+            'gcp_project_name': 'project',
+            'agency_id': '1',
+            'advertiser_id': advertiser,
+            'raw_dataset': 'raw',
+            'view_dataset': 'views',
+            'has_historical_data': True,
+            'has_device_segment': False,
+            'device_segment_column_name': 'device_segment',
+            'first_date_conversions': '2019-01-01',
+            'agency_views': True,
+        }, **values)
+        for k, v in values.items():
+            settings[k].value = v
+        member = Bootstrap.__new__(Bootstrap)
+        member.settings = settings
+        member.s = SettingUtil(settings)
+        member.datasets = DataSets()
+        member.datasets.raw = Dataset('project.raw')
+        member.datasets.views = Dataset('project.views')
+        member.checkpoints = Checkpoints('project', advertiser, self.dir.name)
+        member.checkpoints.complete('historical_table', {})
+        return member
+
+    def test_agency_layer_merges_advertisers(self):
+        members = [
+            self.member('10'),
+            self.member('11', has_device_segment=True,
+                        first_date_conversions='2019-06-01'),
+        ]
+        async_runner.run(members[0].build_agency('project', '1', members))
+        table = self.client.get_table('project.raw.AgencyHistorical_1')
+        # every historical column, whichever advertiser created the table
+        names = [f.name for f in table.schema]
+        for name in ('revenue', 'device_segment', 'advertiser_id',
+                     'first_date_conversions'):
+            self.assertIn(name, names)
+        self.assertEqual(table.labels, {'has_device_segment': 'true'})
+        merges = [q for q in self.client.queries
+                  if 'AgencyHistorical_1' in q]
+        self.assertEqual(len(merges), 2)
+        # only the table without fingerprints gets them computed
+        self.assertIn('Historical_10', merges[0])
+        self.assertIn('SHA256', merges[0])
+        self.assertNotIn('SHA256', merges[1])
+        view = self.client.get_table('project.views.AgencyReportView_1')
+        self.assertIn('p_KeywordDeviceStats_*', view.view_query)
+        self.assertIn('Device_Segment', view.view_query)
+        self.assertIn('s.first_date_conversions', view.view_query)
+        mapper = self.client.get_table('project.views.AgencyKeywordMapper_1')
+        self.assertIn('p_Keyword_*', mapper.view_query)
+
+        # merged advertisers are not merged again
+        async_runner.run(members[0].build_agency('project', '1', members))
+        self.assertEqual(
+            len([q for q in self.client.queries
+                 if 'AgencyHistorical_1' in q and 'INSERT' in q]), 2
+        )
+
+    def test_historical_table_without_join_columns(self):
+        from google.cloud import bigquery
+        from exceptions import BootstrapperError
+
+        self.client.delete_table('project.raw.Historical_10')
+        self.client.create_table(bigquery.Table(
+            'project.raw.Historical_10',
+            schema=[bigquery.SchemaField('date', 'STRING')],
+        ))
+        with self.assertRaisesRegex(BootstrapperError, 'Reload'):
+            async_runner.run(self.member('10').load_agency_historical_table(
+                self.client, 'project', '10'
+            ))
+
+    def test_agency_mapper_reads_latest_snapshot(self):
+        import hashlib
+        import sqlite3
+
+        from views import CreateViews
+
+        member = self.member('10')
+        query = CreateViews(
+            member.settings, self.client, 'project', '1', member.datasets
+        ).keyword_mapper('*', wildcard=True)
+        # the pseudo columns of the wildcard tables are fixture columns
+        db = sqlite3.connect(':memory:')
+        db.create_function('CONCAT', -1, lambda *v: ''.join(map(str, v)))
+        db.create_function('SHA256', 1, lambda v: hashlib.sha256(
+            v.encode('utf-8')
+        ).digest())
+        db.create_function('TO_HEX', 1, lambda v: v.hex())
+        columns = {
+            'Keyword': ['keywordText', 'keywordId', 'keywordEngineId',
+                        'campaignId', 'accountId', 'adGroupId',
+                        'keywordMatchType', 'status'],
+            'Campaign': ['campaignId', 'campaign'],
+            'Account': ['accountId', 'account', 'accountType'],
+            'AdGroup': ['adGroupId', 'adGroup'],
+        }
+        keyword = ('e1', 'c1', 'a1', 'g1', 'exact', 'Active')
+        # (_TABLE_SUFFIX, _PARTITIONTIME, agencyId) + columns
+        snapshots = {
+            'Keyword': [
+                ('10', '2019-01-01', '1', 'kw', 'k1') + keyword,
+                # removed before the latest snapshot
+                ('10', '2019-01-01', '1', 'removed', 'k2') + keyword,
+                ('10', '2019-01-02', '1', 'kw', 'k1') + keyword,
+                # another agency's advertiser in the same raw dataset
+                ('20', '2019-01-02', '2', 'other', 'k3') + keyword,
+            ],
+            'Campaign': [
+                ('10', '2019-01-01', '1', 'c1', 'campaign'),
+                ('10', '2019-01-02', '1', 'c1', 'renamed campaign'),
+            ],
+            'Account': [
+                ('10', day, '1', 'a1', 'account', 'engine')
+                for day in ('2019-01-01', '2019-01-02')
+            ],
+            'AdGroup': [
+                ('10', day, '1', 'g1', 'ad group')
+                for day in ('2019-01-01', '2019-01-02')
+            ],
+        }
+        for entity, rows in snapshots.items():
+            db.execute('CREATE TABLE `p_{}_*` ({})'.format(entity, ', '.join(
+                ['_TABLE_SUFFIX', '_PARTITIONTIME', 'agencyId']
+                + columns[entity]
+            )))
+            db.executemany('INSERT INTO `p_{}_*` VALUES ({})'.format(
+                entity, ', '.join('?' * len(rows[0]))
+            ), rows)
+        mapped = db.execute(
+            'SELECT keywordId, campaign, advertiser_id FROM ({})'.format(
+                query.replace('`project`.`raw`.', '')
+            )
+        ).fetchall()
+        self.assertEqual(mapped, [('k1', 'renamed campaign', '10')])
+
+
+class RollupTest(unittest.TestCase):
+    def test_refresh_and_rebuild(self):
+        from google.cloud import bigquery
+        from views import KEYWORD_GRAIN
+
+        with tempfile.TemporaryDirectory() as tmp:
+            views = fake_views(tmp, {
+                'advertiser_id': '10',
+                'has_historical_data': True,
+                'rollup_lookback_days': 30,
+            })
+            client = views.client
+            client.create_table(bigquery.Table('project.raw.Historical_10'))
+
+            def rollup(grain):
+                async_runner.run(views.rollup(
+                    ViewTypes.KEYWORD_WEEKLY, 'WEEK', grain
+                ))
+                return client.queries[-1]
+
+            def built():
+                return client.get_table(
+                    'project.views.KeywordWeekly_10'
+                ).labels['query_hash']
+
+            self.assertNotIn('DELETE', rollup(KEYWORD_GRAIN))
+            first = built()
+            refresh = rollup(KEYWORD_GRAIN)
+            self.assertIn('DELETE', refresh)
+            self.assertIn('INTERVAL 30 DAY', refresh)
+            self.assertEqual(built(), first)
+
+            # a different grain rebuilds the table
+            self.assertNotIn('DELETE',
+                             rollup(KEYWORD_GRAIN + ['Device_Segment']))
+            self.assertNotEqual(built(), first)
+
+            # so does reloading the historical table
+            historical = client.get_table('project.raw.Historical_10')
+            historical._properties['lastModifiedTime'] = str(
+                int((time.time() + 60) * 1000)
+            )
+            self.assertNotIn('DELETE',
+                             rollup(KEYWORD_GRAIN + ['Device_Segment']))
+
+
+class MaterializeTest(unittest.TestCase):
+    def test_rebuilt_when_partitioned_source_changes(self):
+        from google.cloud import bigquery
+        from views import KEYWORD_MAPPER_CLUSTERING
+
+        with tempfile.TemporaryDirectory() as tmp:
+            views = fake_views(tmp, {'advertiser_id': '10'})
+            client = views.client
+            client.create_table(bigquery.Table('project.raw.p_Keyword_10'))
+            keyword = bigquery.Table('project.raw.Keyword_10')
+            keyword.view_query = 'SELECT * FROM p_Keyword_10'
+            client.create_table(keyword)
+            views.keyword_mapper = lambda advertiser: 'SELECT 1'
+
+            def materialize(clustering=KEYWORD_MAPPER_CLUSTERING):
+                before = len(client.queries)
+                async_runner.run(views.materialize(
+                    ViewTypes.KEYWORD_MAPPER, 'keyword_mapper',
+                    ('Keyword',), clustering
+                ))
+                return len(client.queries) > before
+
+            def touch(table_id):
+                # built before the source table was last modified
+                source = client.get_table(table_id)
+                client.get_table(
+                    'project.raw.Keyword_10'
+                )._properties['lastModifiedTime'] = str(
+                    int(source._properties['lastModifiedTime']) - 2000
+                )
+                client.get_table(
+                    'project.views.KeywordMapper_10'
+                )._properties['lastModifiedTime'] = str(
+                    int(source._properties['lastModifiedTime']) - 1000
+                )
+
+            self.assertTrue(materialize())
+            self.assertFalse(materialize())
+            # the view does not change when the transfer loads new data
+            touch('project.raw.p_Keyword_10')
+            self.assertTrue(materialize())
+            self.assertFalse(materialize())
+            # a table cannot be re-clustered in place
+            self.assertTrue(materialize(['keywordId']))
+            self.assertIn('delete_table', client.calls)
+
+
+class FakesTest(unittest.TestCase):
+    def test_bigquery_tables(self):
+        from google.api_core.exceptions import NotFound
+        from google.cloud import bigquery
+
+        with tempfile.TemporaryDirectory() as tmp:
+            client = FakeRegistry(tmp).bigquery('project')
+            client.create_dataset('project.raw')
+            view = bigquery.Table('project.raw.view')
+            view.view_query = 'SELECT 1'
+            client.create_table(view)
+            self.assertEqual(client.get_table('project.raw.view').table_type,
+                             'VIEW')
+            self.assertEqual(
+                [t.table_id for t in client.list_tables('project.raw')],
+                ['view']
+            )
+            client.delete_table('project.raw.view')
+            with self.assertRaises(NotFound):
+                client.get_table('project.raw.view')
+            self.assertEqual(client.calls['create_table'], 1)
+
+    def test_transfer_latency(self):
+        from clients import transfer_states
+
+        client = FakeTransferClient(transfer_latency=60)
+        config = client.create_transfer_config(
+            client.location_path('project', 'US'),
+            {'display_name': 'transfer', 'data_source_id': 'source'},
+        )
+        self.assertEqual(
+            client.list_transfer_configs('projects/project/locations/US'),
+            [config]
+        )
+        [run] = client.list_transfer_runs(config.name)
+        self.assertEqual(run.state, transfer_states().RUNNING)
+
+    def test_offline_run(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            scratch = os.path.join(tmp, 'scratch')
+            os.mkdir(scratch)
+            report = offline_run(tmp, pd.DataFrame({
+                'date': ['2019-01-02'] * 20,
+                'keyword': ['keyword'] * 20,
+                'campaign_name': ['campaign'] * 20,
+                'account_name': ['account'] * 20,
+                'ad_group': ['ad group'] * 20,
+                'match_type': ['exact'] * 20,
+                'conversions': range(20),
+                'revenue': [1.5] * 20,
+            }), ['10', '11'], '--scratch_dir=' + scratch)
+            self.assertEqual(
+                sorted(s['attributes']['advertiser'] for s in report['spans']),
+                ['10', '11']
+            )
+            self.assertFalse(any('error' in s for s in report['spans']))
+            self.assertEqual(report['totals']['rows_decoded'], 40)
+            # small Cloud Shell uploads are loaded without a copy in GCS
+            self.assertGreater(report['totals']['bigquery.bytes_uploaded'], 0)
+            self.assertNotIn('gcs.bytes_up', report['totals'])
+            self.assertEqual(os.listdir(os.path.join(tmp, 'gcp', 'bucket')),
+                             [])
+            # every advertiser's temporary files were removed
+            self.assertEqual(os.listdir(scratch), [])
+
+    def test_offline_compressed_run(self):
+        rows = 2500
+        with tempfile.TemporaryDirectory() as tmp:
+            report = offline_run(tmp, pd.DataFrame({
+                'date': ['2019-01-02'] * rows,
+                'keyword': ['keyword {}'.format(i) for i in range(rows)],
+                'campaign_name': ['campaign'] * rows,
+                'account_name': ['account'] * rows,
+                'ad_group': ['ad group'] * rows,
+                'match_type': ['exact'] * rows,
+                'conversions': range(rows),
+                'revenue': [1.5] * rows,
+            }), ['10'], '--compress_output', '--max_memory_mb=1')
+        # decoded in several chunks, all of them loaded
+        self.assertEqual(report['totals']['rows_decoded'], rows)
+        self.assertEqual(report['totals']['bigquery.output_rows'], rows)
+
+
+class UploadsTest(unittest.TestCase):
+    def test_composite_upload(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = FakeRegistry(os.path.join(tmp, 'gcp')).storage('project')
+            bucket = storage.create_bucket('bucket')
+            path = os.path.join(tmp, 'out.csv')
+            content = os.urandom(1000)
+            with open(path, 'wb') as fh:
+                fh.write(content)
+            # 10 parts are composed in a tree of 3 intermediate objects
+            with mock.patch.object(uploads, 'MAX_COMPOSE_SOURCES', 4):
+                blob = uploads.upload(bucket, 'out.csv', path, 100, 4)
+            self.assertEqual(blob.crc32c, uploads.crc32c(path))
+            with open(blob.path, 'rb') as fh:
+                self.assertEqual(fh.read(), content)
+            self.assertEqual([b.name for b in bucket.list_blobs()],
+                             ['out.csv'])
+            self.assertEqual(storage.calls['blob.upload'], 10)
+            self.assertEqual(storage.calls['blob.compose'], 4)
+
+    def test_small_files_upload_in_one_stream(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = FakeRegistry(os.path.join(tmp, 'gcp')).storage('project')
+            bucket = storage.create_bucket('bucket')
+            path = os.path.join(tmp, 'out.csv')
+            with open(path, 'wb') as fh:
+                fh.write(b'date\n2019-01-01\n')
+            uploads.upload(bucket, 'out.csv', path, 100, 4)
+            self.assertEqual(storage.calls['blob.upload'], 1)
+            self.assertEqual(storage.calls['blob.compose'], 0)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,147 @@
+# /***********************************************************************
+# Copyright 2019 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Note that these code samples being shared are not official Google
+# products and are not formally supported.
+# ************************************************************************/
+
+"""
+Uploads of decoded historical files to GCS.
+
+Files larger than one part are uploaded as parallel composite uploads:
+the file is split into parts that are uploaded concurrently as temporary
+objects, then composed into the destination object and deleted. Every
+part is checked with crc32c by the upload itself, and the composed
+object's crc32c is compared with that of the local file.
+"""
+import base64
+import os
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from typing import TYPE_CHECKING
+
+from absl import logging
+
+import api_calls
+import run_report
+
+if TYPE_CHECKING:
+    from google.cloud.storage import Blob
+    from google.cloud.storage import Bucket
+
+# most source objects a single compose request accepts
+MAX_COMPOSE_SOURCES = 32
+READ_BYTES = 2 ** 20
+PART_PREFIX = 'sa360-bq-parts'
+
+
+def crc32c(path: str) -> str:
+    """The base64 encoded crc32c of a file, as reported by GCS"""
+    import google_crc32c
+
+    checksum = google_crc32c.Checksum()
+    with open(path, 'rb') as fh:
+        for block in iter(lambda: fh.read(READ_BYTES), b''):
+            checksum.update(block)
+    return base64.b64encode(checksum.digest()).decode('ascii')
+
+
+def upload(bucket: 'Bucket', name: str, path: str, part_bytes: int,
+           concurrency: int) -> 'Blob':
+    """
+    Uploads the file at path to bucket as name.
+
+    :param part_bytes: Size of the parts of a composite upload. Files no
+        larger than this, or any file if it is 0, are uploaded in one
+        stream.
+    :param concurrency: Parts uploaded at the same time
+    :return: The uploaded blob
+    """
+    size = os.path.getsize(path)
+    blob = bucket.blob(name)
+    if not part_bytes or size <= part_bytes:
+        api_calls.call('storage', blob.upload_from_filename, path)
+        return blob
+    return composite_upload(bucket, blob, path, size, part_bytes,
+                            concurrency)
+
+
+def composite_upload(bucket: 'Bucket', blob: 'Blob', path: str, size: int,
+                     part_bytes: int, concurrency: int) -> 'Blob':
+    prefix = '{}/{}-{}'.format(PART_PREFIX, blob.name, secrets.token_hex(4))
+    offsets = range(0, size, part_bytes)
+    temporary: List['Blob'] = []
+
+    def upload_part(i: int, offset: int) -> 'Blob':
+        part = bucket.blob('{}/{:05d}'.format(prefix, i))
+        length = min(part_bytes, size - offset)
+
+        def send():
+            # a retry starts the part over
+            with open(path, 'rb') as fh:
+                fh.seek(offset)
+                part.upload_from_file(fh, size=length, checksum='crc32c')
+        api_calls.call('storage', send)
+        run_report.add('gcs.upload_parts')
+        return part
+
+    try:
+        with ThreadPoolExecutor(concurrency,
+                                thread_name_prefix='upload') as executor:
+            futures = [executor.submit(upload_part, i, offset)
+                       for i, offset in enumerate(offsets)]
+        # every part that made it is deleted, even if another one failed
+        parts = []
+        for future in futures:
+            if future.exception() is None:
+                temporary.append(future.result())
+        for future in futures:
+            parts.append(future.result())
+        compose(bucket, blob, parts, prefix, temporary)
+        api_calls.call('storage', blob.reload)
+        expected = crc32c(path)
+        if blob.crc32c != expected:
+            raise IOError('crc32c of gs://{}/{} is {}, expected {}'.format(
+                bucket.name, blob.name, blob.crc32c, expected
+            ))
+        logging.info('Uploaded %s in %d parts', blob.name, len(parts))
+        return blob
+    finally:
+        for part in temporary:
+            try:
+                api_calls.call('storage', part.delete)
+            except Exception as err:
+                logging.warning('Could not delete %s: %s', part.name, err)
+
+
+def compose(bucket: 'Bucket', blob: 'Blob', parts: List['Blob'],
+            prefix: str, temporary: List['Blob']):
+    """Composes parts into blob, in a tree of intermediate objects if
+    there are more than MAX_COMPOSE_SOURCES"""
+    level = 0
+    while len(parts) > MAX_COMPOSE_SOURCES:
+        groups = [parts[i:i + MAX_COMPOSE_SOURCES]
+                  for i in range(0, len(parts), MAX_COMPOSE_SOURCES)]
+        parts = []
+        for i, group in enumerate(groups):
+            intermediate = bucket.blob('{}/compose-{}-{:05d}'.format(
+                prefix, level, i
+            ))
+            api_calls.call('storage', intermediate.compose, group)
+            temporary.append(intermediate)
+            parts.append(intermediate)
+        level += 1
+    api_calls.call('storage', blob.compose, parts)
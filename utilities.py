@@ -16,6 +16,9 @@
 # Note that these code samples being shared are not official Google
 # products and are not formally supported.
 # ************************************************************************/
+import hashlib
+import math
+import numbers
 from enum import Enum
 
 lib_mappings = {
@@ -23,6 +26,11 @@ lib_mappings = {
   'absl': 'absl-py',
   'google.cloud': 'google-cloud',
   'google.cloud.bigquery_datatransfer_v1': 'google-cloud-bigquery-datatransfer',
+  'google.cloud.bigquery_datatransfer': 'google-cloud-bigquery-datatransfer',
+  'google.cloud.bigquery': 'google-cloud-bigquery',
+  'google.cloud.storage': 'google-cloud-storage',
+  'dateutil': 'python-dateutil',
+  'google_crc32c': 'google-crc32c',
 }
 
 class Aggregation(Enum):
@@ -69,6 +77,15 @@ class ViewTypes(Enum):
     HISTORICAL_CONVERSIONS = 'HistoricalConversions'
     REPORT_VIEW = 'ReportView'
     HISTORICAL_REPORT = 'HistoricalConversionReport'
+    REPORT_RANGE = 'ReportRange'
+    KEYWORD_WEEKLY = 'KeywordWeekly'
+    KEYWORD_MONTHLY = 'KeywordMonthly'
+    CAMPAIGN_WEEKLY = 'CampaignWeekly'
+    CAMPAIGN_MONTHLY = 'CampaignMonthly'
+    AGENCY_HISTORICAL = 'AgencyHistorical'
+    AGENCY_KEYWORD_MAPPER = 'AgencyKeywordMapper'
+    AGENCY_HISTORICAL_CONVERSIONS = 'AgencyHistoricalConversions'
+    AGENCY_REPORT_VIEW = 'AgencyReportView'
 
 class ViewGetter(object):
     def __init__(self, advertiser):
@@ -91,3 +108,64 @@ class Locale(Enum):
 
 def get_view_name(view_type: ViewTypes, advertiser: str):
     return view_type.value + '_' + advertiser
+
+
+FINGERPRINT_COLUMN = 'keyword_fingerprint'
+FINGERPRINT_SOURCE_COLUMNS = (
+    'keyword', 'campaign_name', 'account_name', 'ad_group', 'match_type',
+)
+
+
+def has_fingerprint(columns) -> bool:
+    """Whether all columns needed for a keyword fingerprint are available"""
+    return all(c in columns for c in FINGERPRINT_SOURCE_COLUMNS)
+
+
+def fingerprint_value(value):
+    """A join field as BigQuery's CAST(... AS STRING) formats it.
+
+    Whole numbers read by pandas as floats (e.g. a column with gaps) lose
+    their '.0', like a FLOAT64 cast in BigQuery.
+
+    :return: The string, or None if the value is missing
+    """
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return str(value).lower()
+    if isinstance(value, numbers.Real):
+        if math.isnan(value):
+            return None
+        if float(value).is_integer():
+            return str(int(value))
+    return str(value)
+
+
+def join_fingerprint(keyword, campaign, account, ad_group, match_type):
+    """Stable integer key for the historical <-> keyword mapper join.
+
+    Matches the value of {@link join_fingerprint_sql} in BigQuery: the
+    first 60 bits of the SHA-256 of the unit-separated join fields, with
+    the match type lower-cased. Non-string fields are converted with
+    {@link fingerprint_value}.
+
+    :return: A positive INT64 or None if any of the fields is missing.
+    """
+    values = tuple(fingerprint_value(v) for v in (
+        keyword, campaign, account, ad_group, match_type
+    ))
+    if None in values:
+        return None
+    key = '\x1f'.join(values[:-1] + (values[-1].lower(),))
+    return int(hashlib.sha256(key.encode('utf-8')).hexdigest()[:15], 16)
+
+
+def join_fingerprint_sql(keyword, campaign, account, ad_group, match_type):
+    """SQL expression producing the same value as {@link join_fingerprint}"""
+    return (
+        "CAST(CONCAT('0x', SUBSTR(TO_HEX(SHA256(CONCAT("
+        "{0}, '\\x1f', {1}, '\\x1f', {2}, '\\x1f', {3}, '\\x1f', "
+        "LOWER({4})))), 1, 15)) AS INT64)"
+    ).format(*('CAST({} AS STRING)'.format(c) for c in (
+        keyword, campaign, account, ad_group, match_type
+    )))
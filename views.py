@@ -16,7 +16,11 @@
 # Note that these code samples being shared are not official Google
 # products and are not formally supported.
 # ************************************************************************/
+import asyncio
+import hashlib
+import time
 import traceback
+from typing import List
 
 from absl import logging
 from google.api_core.exceptions import NotFound
@@ -24,17 +28,42 @@ from google.cloud import bigquery
 from google.cloud.bigquery import Table
 from termcolor import cprint
 
+import api_calls
 import app_settings
+import async_runner
+import run_report
 from flagmaker.settings import AbstractSettings
 from utilities import Aggregation
+from utilities import FINGERPRINT_COLUMN
 from utilities import SettingUtil
 from utilities import ViewGetter
 from utilities import ViewTypes
 from utilities import aggregate_if
 from utilities import get_view_name
+from utilities import join_fingerprint_sql
+
+
+KEYWORD_MAPPER_SOURCES = ('Keyword', 'Campaign', 'Account', 'AdGroup')
+# historical conversions join the mapper on the fingerprint
+KEYWORD_MAPPER_CLUSTERING = ['keywordFingerprint', 'keywordId']
+KEYWORD_GRAIN = [
+    'keywordId', 'Keyword', 'Campaign', 'Advertiser', 'Engine', 'Account_Type',
+]
+CAMPAIGN_GRAIN = ['Campaign', 'Advertiser', 'Engine', 'Account_Type']
+ROLLUP_METRICS = [
+    'Clicks', 'Impressions', 'Weighted_Pos', 'Cost', 'Revenue', 'Conversions',
+]
+
+
+def iso_date(value) -> str:
+    """A date setting (a datetime once validated) as yyyy-mm-dd"""
+    if hasattr(value, 'strftime'):
+        return value.strftime('%Y-%m-%d')
+    return str(value)
 
 
 class DataSets:
+    """The raw and views datasets of one advertiser's run"""
     raw: bigquery.dataset.Dataset = None
     views: bigquery.dataset.Dataset = None
 
@@ -45,52 +74,264 @@ class CreateViews:
     advertiser: str = None
     settings: AbstractSettings = None
 
-    def __init__(self, config, client, project, advertiser):
+    def __init__(self, config, client, project, advertiser,
+                 datasets: DataSets):
         self.settings: app_settings.AppSettings = config
         self.client = client
         self.project = project
         self.advertiser = advertiser
+        self.datasets = datasets
         self.s = SettingUtil(config)
 
-    def run(self):
+    async def run(self, deploy_views=True):
+        """
+        Creates the views, then refreshes materialized tables and rollups.
+
+        :param deploy_views: If False, views from a previous run are kept
+            and only the materialized tables and rollups are refreshed.
+        """
         report_level = self.s.unwrap('report_level')
         if report_level == 'campaign':
             raise MethodNotCreated('Methods for campaign-only views'
                                    ' not implemented.')
         else:
-            self.view(
-                ViewTypes.KEYWORD_MAPPER,
-                'keyword_mapper'
-            )
-            if self.s.unwrap('has_historical_data'):
-                self.view(
-                    ViewTypes.HISTORICAL_CONVERSIONS,
-                    'historical_conversions'
+            if self.s.unwrap('materialize_keyword_mapper'):
+                await self.materialize(
+                    ViewTypes.KEYWORD_MAPPER,
+                    'keyword_mapper',
+                    KEYWORD_MAPPER_SOURCES,
+                    KEYWORD_MAPPER_CLUSTERING,
                 )
-                self.view(
-                    ViewTypes.HISTORICAL_REPORT,
-                    'historical_report',
+            elif deploy_views:
+                await self.view(
+                    ViewTypes.KEYWORD_MAPPER,
+                    'keyword_mapper'
                 )
-            self.view(
-                ViewTypes.REPORT_VIEW,
-                'report_view',
-            )
+            if deploy_views:
+                if self.s.unwrap('has_historical_data'):
+                    await self.view(
+                        ViewTypes.HISTORICAL_CONVERSIONS,
+                        'historical_conversions'
+                    )
+                    await self.view(
+                        ViewTypes.HISTORICAL_REPORT,
+                        'historical_report',
+                    )
+                await self.view(
+                    ViewTypes.REPORT_VIEW,
+                    'report_view',
+                )
+                await self.table_function(
+                    ViewTypes.REPORT_RANGE,
+                    'report_range',
+                    'start_date DATE, end_date DATE',
+                )
+            if self.s.unwrap('build_rollups'):
+                await self.rollups()
+
+    @run_report.timed('rollups')
+    async def rollups(self):
+        """Weekly and monthly aggregates of ReportView for long-range
+        dashboards, at keyword and campaign grain. The rollups are
+        independent, so they are built concurrently."""
+        rollups = []
+        for view_name, period, grain in (
+            (ViewTypes.KEYWORD_WEEKLY, 'WEEK', KEYWORD_GRAIN),
+            (ViewTypes.KEYWORD_MONTHLY, 'MONTH', KEYWORD_GRAIN),
+            (ViewTypes.CAMPAIGN_WEEKLY, 'WEEK', CAMPAIGN_GRAIN),
+            (ViewTypes.CAMPAIGN_MONTHLY, 'MONTH', CAMPAIGN_GRAIN),
+        ):
+            if self.s.unwrap('has_device_segment'):
+                grain = grain + ['Device_Segment']
+            rollups.append(self.rollup(view_name, period, grain))
+        await asyncio.gather(*rollups)
+
+    @run_report.timed('rollup', 'table_type')
+    async def rollup(self, view_name: ViewTypes, period: str, grain: list):
+        """Creates a rollup table, or refreshes it incrementally.
 
-    def view(self, view_name: ViewTypes, func_name):
+        A refresh replaces every period from the latest stored one, or from
+        rollup_lookback_days ago if that is earlier, reading only that
+        window through ReportRange. The table is rebuilt if its query
+        changed (e.g. the grain) or the historical table was reloaded.
+
+        :param view_name: The view type (used for the table name)
+        :param period: WEEK or MONTH
+        :param grain: The ReportView columns to group by
+        """
         adv = str(self.s.unwrap('advertiser_id'))
+        views = ViewGetter(adv)
+        table_name = get_view_name(view_name, adv)
+        table_ref = self.datasets.views.table(table_name)
+        full_table_name = '{}.{}.{}'.format(
+            self.project, self.datasets.views.dataset_id, table_name
+        )
+        source = '`{}.{}.{}`'.format(
+            self.project,
+            self.datasets.views.dataset_id,
+            views.get(ViewTypes.REPORT_VIEW),
+        )
+        query = self.rollup_query(period, grain, source)
+        query_hash = hashlib.sha256(query.encode('utf-8')).hexdigest()[:16]
+        try:
+            table: Table = await async_runner.call(
+                'bigquery', self.client.get_table, table_ref
+            )
+        except NotFound:
+            table = None
+        if table is not None and not await self.rollup_current(
+                table, query_hash, adv):
+            await async_runner.call('bigquery', self.client.delete_table,
+                                    table_ref, not_found_ok=True)
+            table = None
+        if table is None:
+            job_config = bigquery.QueryJobConfig()
+            job_config.destination = table_ref
+            job_config.write_disposition = (
+                bigquery.WriteDisposition.WRITE_TRUNCATE
+            )
+            job_config.time_partitioning = bigquery.TimePartitioning(
+                type_=(bigquery.TimePartitioningType.MONTH
+                       if period == 'MONTH'
+                       else bigquery.TimePartitioningType.DAY),
+                field='Period',
+            )
+            job_config.clustering_fields = grain[:4]
+            logging.debug(query)
+            await self.query(query, job_config=job_config)
+            table = await async_runner.call('bigquery', self.client.get_table,
+                                            table_ref)
+            table.labels = {
+                'query_hash': query_hash,
+                'built_at': str(int(time.time())),
+            }
+            await async_runner.call('bigquery', self.client.update_table,
+                                    table, ['labels'])
+            cprint('+ created {}'.format(table_name), 'green')
+            return
+        script = '''DECLARE watermark DATE DEFAULT LEAST(
+            (SELECT COALESCE(MAX(Period), DATE '1970-01-01') FROM `{table}`),
+            DATE_TRUNC(
+                DATE_SUB(CURRENT_DATE(), INTERVAL {lookback} DAY), {period}
+            )
+        );
+        DELETE FROM `{table}` WHERE Period >= watermark;
+        INSERT INTO `{table}` ({columns})
+        {query};'''.format(
+            table=full_table_name,
+            lookback=int(self.s.unwrap('rollup_lookback_days')),
+            period='WEEK(MONDAY)' if period == 'WEEK' else period,
+            columns=', '.join(['Period'] + grain + ROLLUP_METRICS),
+            query=self.rollup_query(period, grain, '`{}.{}.{}`({})'.format(
+                self.project,
+                self.datasets.views.dataset_id,
+                views.get(ViewTypes.REPORT_RANGE),
+                'watermark, CURRENT_DATE()',
+            )),
+        )
+        logging.debug(script)
+        await self.query(script)
+        cprint('= refreshed {}'.format(table_name), 'green')
+
+    async def rollup_current(self, table: Table, query_hash: str,
+                             advertiser: str) -> bool:
+        """Whether a rollup can be refreshed incrementally: it was built by
+        the same query, after the historical table was last loaded."""
+        if table.labels.get('query_hash') != query_hash:
+            return False
+        if not self.s.unwrap('has_historical_data'):
+            return True
+        try:
+            historical: Table = await async_runner.call(
+                'bigquery', self.client.get_table, self.datasets.raw.table(
+                    get_view_name(ViewTypes.HISTORICAL, advertiser)
+                )
+            )
+        except NotFound:
+            return True
+        built_at = int(table.labels.get('built_at', 0))
+        return int(historical.modified.timestamp()) <= built_at
+
+    @staticmethod
+    def rollup_query(period: str, grain: list, source: str):
+        return '''SELECT
+            DATE_TRUNC(Date, {period}) Period,
+            {grain},
+            {metrics}
+        FROM {source}
+        GROUP BY Period, {grain}'''.format(
+            period='WEEK(MONDAY)' if period == 'WEEK' else period,
+            grain=', '.join(grain),
+            metrics=',\n            '.join(
+                'SUM({0}) {0}'.format(m) for m in ROLLUP_METRICS
+            ),
+            source=source,
+        )
+
+    async def agency_views(self):
+        """Views across all advertisers of the agency, using wildcard tables.
+
+        Dashboards covering many advertisers can filter on advertiser_id,
+        which prunes the wildcard tables, instead of unioning one
+        ReportView per advertiser.
+
+        The views are built once per run, after every advertiser, from
+        settings merged across the agency (see Bootstrap.build_agency).
+        The wildcards match the transfer's partitioned p_ tables, because
+        wildcard queries fail if any matching object is a view.
+        """
+        agency = str(self.s.unwrap('agency_id'))
+        await self.view(
+            ViewTypes.AGENCY_KEYWORD_MAPPER,
+            'agency_keyword_mapper',
+            name_suffix=agency,
+        )
+        if self.s.unwrap('has_historical_data'):
+            await self.view(
+                ViewTypes.AGENCY_HISTORICAL_CONVERSIONS,
+                'agency_historical_conversions',
+                name_suffix=agency,
+            )
+        await self.view(
+            ViewTypes.AGENCY_REPORT_VIEW,
+            'agency_report_view',
+            name_suffix=agency,
+        )
+
+    def agency_keyword_mapper(self, agency):
+        return self.keyword_mapper('*', wildcard=True)
+
+    def agency_historical_conversions(self, agency):
+        return self.historical_conversions(agency, wildcard=True)
+
+    def agency_report_view(self, agency):
+        return self.report_view(agency, wildcard=True)
+
+    @run_report.timed('view', 'view_type')
+    async def view(self, view_name: ViewTypes, func_name, name_suffix=None):
+        adv = name_suffix or str(self.s.unwrap('advertiser_id'))
         logging.debug(view_name.value)
         adv_view = get_view_name(view_name, adv)
-        view_ref = DataSets.views.table(adv_view)
-        view_query = getattr(
+        view_ref = self.datasets.views.table(adv_view)
+        # query builders may look up table schemas
+        view_query = await async_runner.offload(getattr(
             self,
             func_name if func_name is not None else view_name.value
-        )(adv)
+        ), adv)
         logging.debug(view_query)
         try:
             logging.debug(view_ref)
-            view: Table = self.client.get_table(view_ref)
+            view: Table = await async_runner.call(
+                'bigquery', self.client.get_table, view_ref
+            )
+            if view.table_type != 'VIEW':
+                # previously materialized - replace the table with a view
+                await async_runner.call('bigquery', self.client.delete_table,
+                                        view_ref, not_found_ok=True)
+                raise NotFound('{} is not a view'.format(adv_view))
             view.view_query = view_query
-            self.client.update_table(view, ['view_query'])
+            await async_runner.call('bigquery', self.client.update_table,
+                                    view, ['view_query'])
             cprint('= updated {}'.format(adv_view), 'green')
         except NotFound as err:
             try:
@@ -98,18 +339,163 @@ class CreateViews:
                 view = bigquery.Table(view_ref)
                 logging.info('%s.%s', view.dataset_id, view.table_id)
                 view.view_query = view_query
-                self.client.create_table(view, exists_ok=True)
+                await async_runner.call('bigquery', self.client.create_table,
+                                        view, exists_ok=True)
                 cprint('+ created {}'.format(adv_view), 'green')
             except NotFound as err:
+                # fail the stage, so that it is not checkpointed
                 cprint('Error: {}'.format(str(err)), 'red')
                 logging.info(traceback.format_exc())
+                raise
         self.keyword_mapper(adv)
 
-    def historical_conversions(self, advertiser):
+    async def query(self, query: str, job_config=None):
+        """Runs a query job to completion, retrying it if it fails with a
+        retryable error. Only used for queries that can safely run twice."""
+        return await async_runner.run_job(
+            lambda: self.client.query(query, job_config=job_config)
+        )
+
+    @run_report.timed('table_function', 'view_type')
+    async def table_function(self, view_name: ViewTypes, func_name, arguments):
+        """Creates or replaces a table-valued function.
+
+        :param view_name: The view type (used for the function name)
+        :param func_name: The method name that generates the query
+        :param arguments: The SQL argument list of the function
+        """
+        adv = str(self.s.unwrap('advertiser_id'))
+        function_name = get_view_name(view_name, adv)
+        query = await async_runner.offload(getattr(self, func_name), adv)
+        ddl = (
+            'CREATE OR REPLACE TABLE FUNCTION `{}.{}.{}`({}) AS (\n{}\n)'
+        ).format(
+            self.project,
+            self.datasets.views.dataset_id,
+            function_name,
+            arguments,
+            query,
+        )
+        logging.debug(ddl)
+        await self.query(ddl)
+        cprint('= deployed {}'.format(function_name), 'green')
+
+    @run_report.timed('materialize', 'view_type')
+    async def materialize(self, view_name: ViewTypes, func_name, sources,
+                    clustering_fields):
+        """Stores the result of a view query as a clustered table.
+
+        The table is only rebuilt if one of the raw source tables was
+        modified after the last build, or if the query or clustering
+        changed. The transfer's partitioned p_ tables are checked, because
+        its views are not modified when new data arrives.
+
+        :param view_name: The view type (used for the table name)
+        :param func_name: The method name that generates the query
+        :param sources: Prefixes of the raw tables the query reads from
+        :param clustering_fields: Up to four columns to cluster on
+        """
+        adv = str(self.s.unwrap('advertiser_id'))
+        table_name = get_view_name(view_name, adv)
+        table_ref = self.datasets.views.table(table_name)
+        query = await async_runner.offload(getattr(self, func_name), adv)
+        logging.debug(query)
+        query_hash = hashlib.sha256('{}\n{}'.format(
+            query, ','.join(clustering_fields)
+        ).encode('utf-8')).hexdigest()[:16]
+        try:
+            table: Table = await async_runner.call(
+                'bigquery', self.client.get_table, table_ref
+            )
+        except NotFound:
+            table = None
+        if table is not None and table.table_type == 'TABLE':
+            last_modified = max(t.modified for t in await asyncio.gather(*(
+                self.source_table('{}_{}'.format(source, adv))
+                for source in sources
+            )))
+            if table.labels.get('query_hash') != query_hash:
+                # the clustering of a table cannot be replaced by a query
+                await async_runner.call('bigquery', self.client.delete_table,
+                                        table_ref, not_found_ok=True)
+            elif table.modified >= last_modified:
+                cprint('= {} is up to date'.format(table_name), 'green')
+                return
+        elif table is not None:
+            # previously a logical view - replace it with a table
+            await async_runner.call('bigquery', self.client.delete_table,
+                                    table_ref, not_found_ok=True)
+        job_config = bigquery.QueryJobConfig()
+        job_config.destination = table_ref
+        job_config.write_disposition = (
+            bigquery.WriteDisposition.WRITE_TRUNCATE
+        )
+        job_config.clustering_fields = clustering_fields
+        await self.query(query, job_config=job_config)
+        table = await async_runner.call('bigquery', self.client.get_table,
+                                        table_ref)
+        table.labels = {'query_hash': query_hash}
+        await async_runner.call('bigquery', self.client.update_table, table,
+                                ['labels'])
+        cprint('+ materialized {}'.format(table_name), 'green')
+
+    async def source_table(self, name: str) -> Table:
+        """The transfer's partitioned p_ table behind a raw view, or the
+        raw table itself if there is none"""
+        try:
+            return await async_runner.call(
+                'bigquery', self.client.get_table,
+                self.datasets.raw.table('p_' + name)
+            )
+        except NotFound:
+            return await async_runner.call(
+                'bigquery', self.client.get_table,
+                self.datasets.raw.table(name)
+            )
+
+    def historical_has_fingerprint(self, advertiser) -> bool:
+        """Tables loaded before the fingerprint column existed use the
+        string join instead."""
+        table_name = get_view_name(ViewTypes.HISTORICAL, advertiser)
+        try:
+            table: Table = api_calls.call(
+                'bigquery', self.client.get_table,
+                self.datasets.raw.table(table_name)
+            )
+        except NotFound:
+            return False
+        return any(f.name == FINGERPRINT_COLUMN for f in table.schema)
+
+    def historical_conversions(self, advertiser, wildcard=False):
+        """
+        :param advertiser: The advertiser ID, or the agency ID if wildcard
+        :param wildcard: Read from the combined agency historical table
+        """
         views = ViewGetter(advertiser)
+        if wildcard:
+            historical_table_name = views.get(ViewTypes.AGENCY_HISTORICAL)
+            keyword_mapper = views.get(ViewTypes.AGENCY_KEYWORD_MAPPER)
+            join_condition = (
+                'a.keywordFingerprint=h.{}\n'
+                '            AND a.advertiser_id=h.advertiser_id'
+            ).format(FINGERPRINT_COLUMN)
+        else:
+            historical_table_name = views.get(ViewTypes.HISTORICAL)
+            keyword_mapper = views.get(ViewTypes.KEYWORD_MAPPER)
+            join_condition = (
+                'a.keywordFingerprint=h.{}'.format(FINGERPRINT_COLUMN)
+                if self.historical_has_fingerprint(advertiser)
+                else 'a.keyword=h.keyword\n'
+                     '            AND a.campaign=h.campaign_name\n'
+                     '            AND a.account=h.account_name\n'
+                     '            AND a.adGroup=h.ad_group\n'
+                     '            AND LOWER(a.keywordMatchType) '
+                     '= LOWER(h.match_type)'
+            )
+        advertiser_column = ',\n            h.advertiser_id' if wildcard else ''
 
         sql = """SELECT 
-            h.date,
+            h.date{advertiser_column},
             a.keywordId{deviceSegment},
             a.keywordMatchType MatchType,
             h.ad_group AdGroup,
@@ -122,7 +508,8 @@ class CreateViews:
                 campaign,
                 keywordMatchType,
                 adGroup,
-                account
+                account,
+                keywordFingerprint{mapper_advertiser_column}
             FROM `{project}`.`{views}`.`{keyword_mapper}`
             GROUP BY
                 keywordId,
@@ -130,15 +517,12 @@ class CreateViews:
                 campaign,
                 account,
                 adGroup,
-                keywordMatchType
+                keywordMatchType,
+                keywordFingerprint{mapper_advertiser_column}
           ) a
-            ON a.keyword=h.keyword
-            AND a.campaign=h.campaign_name
-            AND a.account=h.account_name
-            AND a.adGroup=h.ad_group
-            AND LOWER(a.keywordMatchType) = LOWER(h.match_type)
+            ON {join_condition}
           GROUP BY
-            h.date,
+            h.date{advertiser_column},
             a.keywordId, 
             a.keyword, 
             a.keywordMatchType,
@@ -156,8 +540,13 @@ class CreateViews:
               ) if self.s.unwrap('has_device_segment') else '',
               raw=self.s.unwrap('raw_dataset'),
               views=self.s.unwrap('view_dataset'),
-              historical_table_name=views.get(ViewTypes.HISTORICAL),
-              keyword_mapper=views.get(ViewTypes.KEYWORD_MAPPER),
+              historical_table_name=historical_table_name,
+              keyword_mapper=keyword_mapper,
+              join_condition=join_condition,
+              advertiser_column=advertiser_column,
+              mapper_advertiser_column=(
+                  ',\n                advertiser_id' if wildcard else ''
+              ),
               conversions=aggregate_if(
                   Aggregation.SUM,
                   'conversions',
@@ -173,7 +562,12 @@ class CreateViews:
           )
         return sql
 
-    def keyword_mapper(self, advertiser):
+    def keyword_mapper(self, advertiser, wildcard=False):
+        """
+        :param advertiser: The advertiser ID, or '*' if wildcard
+        :param wildcard: Map keywords of all advertisers, adding an
+                         advertiser_id column from the table suffix
+        """
         sql = '''SELECT 
             k.keywordId, 
             k.keywordText keyword,
@@ -181,7 +575,8 @@ class CreateViews:
             c.campaign, 
             a.account,
             g.adGroup,
-            a.accountType
+            a.accountType,
+            {fingerprint} keywordFingerprint{advertiser_column}
             FROM (
                 SELECT keywordText,
                 keywordId,
@@ -189,28 +584,28 @@ class CreateViews:
                 campaignId,
                 accountId,
                 adgroupId,
-                keywordMatchType,
+                keywordMatchType,{table_suffix}
                 RANK() OVER (
                   PARTITION BY keywordText, keywordMatchType, campaignId, 
                       accountId, adGroupId
                     ORDER BY CASE WHEN status='Active' THEN 0 ELSE 1 END,
                     CASE WHEN keywordEngineId IS NOT NULL THEN 0 ELSE 1 END
                   ) rank
-              FROM `{project}`.`{raw_data}`.`Keyword_{advertiser_id}` c
+              FROM {keywords} c
             ) k
             INNER JOIN (
               SELECT campaignId, campaign 
-              FROM `{project}`.`{raw_data}`.`Campaign_{advertiser_id}` 
+              FROM {campaigns} 
               GROUP BY campaignId, campaign
               ) c ON c.campaignId = k.campaignId
             INNER JOIN (
               SELECT accountId, account, accountType 
-              FROM `{project}`.`{raw_data}`.`Account_{advertiser_id}` 
+              FROM {accounts} 
               GROUP BY accountId, account, accountType
               ) a ON a.accountId = k.accountId
             INNER JOIN (
               SELECT adGroupId, adGroup
-              FROM `{project}`.`{raw_data}`.`AdGroup_{advertiser_id}`
+              FROM {ad_groups}
               GROUP BY adGroupId, adGroup
             ) g ON g.adGroupId = k.adGroupId
             WHERE keywordText IS NOT NULL
@@ -222,23 +617,133 @@ class CreateViews:
                 c.campaign, 
                 a.account,
                 a.accountType,
-                g.adGroup'''.format(
-                    project=self.s.unwrap('gcp_project_name'),
-                    raw_data=self.s.unwrap('raw_dataset'),
-                    advertiser_id=advertiser,
+                g.adGroup{advertiser_column}'''.format(
+                    keywords=self.entity_table(
+                        'Keyword', advertiser, wildcard, [
+                            'keywordText', 'keywordId', 'keywordEngineId',
+                            'campaignId', 'accountId', 'adGroupId',
+                            'keywordMatchType', 'status',
+                        ]
+                    ),
+                    campaigns=self.entity_table(
+                        'Campaign', advertiser, wildcard,
+                        ['campaignId', 'campaign']
+                    ),
+                    accounts=self.entity_table(
+                        'Account', advertiser, wildcard,
+                        ['accountId', 'account', 'accountType']
+                    ),
+                    ad_groups=self.entity_table(
+                        'AdGroup', advertiser, wildcard,
+                        ['adGroupId', 'adGroup']
+                    ),
+                    advertiser_column=(
+                        ',\n            k.advertiser_id' if wildcard else ''
+                    ),
+                    table_suffix=(
+                        '\n                advertiser_id,'
+                        if wildcard else ''
+                    ),
+                    fingerprint=join_fingerprint_sql(
+                        'k.keywordText',
+                        'c.campaign',
+                        'a.account',
+                        'g.adGroup',
+                        'k.keywordMatchType',
+                    ),
                 )
         return sql
 
-    def report_view(self, advertiser):
+    def entity_table(self, entity: str, advertiser, wildcard: bool,
+                     columns: List[str]) -> str:
+        """The table of an SA360 entity (Keyword, Campaign, etc.) to select
+        from.
+
+        The transfer adds a snapshot of each entity table to a new daily
+        partition, and its per-advertiser views only show the latest one.
+        Reading all partitions would map renamed entities once per name and
+        keep removed ones, so the wildcard reads the latest snapshot of each
+        of the agency's advertisers only.
+
+        :param advertiser: The advertiser ID, unused if wildcard
+        :param wildcard: A subquery over all advertisers of the agency,
+            adding an advertiser_id column from the table suffix
+        :param columns: The columns of the wildcard subquery
+        """
+        project = self.s.unwrap('gcp_project_name')
+        raw_data = self.s.unwrap('raw_dataset')
+        if not wildcard:
+            return '`{}`.`{}`.`{}_{}`'.format(
+                project, raw_data, entity, advertiser
+            )
+        columns = ', '.join(columns)
+        return '''(
+              SELECT {columns}, advertiser_id
+              FROM (
+                SELECT {columns},
+                  _TABLE_SUFFIX advertiser_id,
+                  _PARTITIONTIME snapshot,
+                  MAX(_PARTITIONTIME) OVER (
+                    PARTITION BY _TABLE_SUFFIX
+                  ) latest
+                FROM `{project}`.`{raw_data}`.`p_{entity}_*`
+                WHERE agencyId = '{agency}'
+              )
+              WHERE snapshot = latest
+            )'''.format(
+            columns=columns, project=project, raw_data=raw_data,
+            entity=entity, agency=self.s.unwrap('agency_id'),
+        )
+
+    def report_view(self, advertiser, wildcard=False, date_range=False):
+        """
+        :param advertiser: The advertiser ID, or the agency ID if wildcard
+        :param wildcard: Report on all advertisers using wildcard tables,
+                         adding an Advertiser_ID column
+        :param date_range: Filter every inner subquery on the start_date
+                           and end_date table function arguments
+        """
         views = ViewGetter(advertiser)
         deviceSegment = (',\n' + 'd.deviceSegment AS Device_Segment'
                 if self.s.unwrap('has_device_segment') else '')
-        historical_conversions = views.get(ViewTypes.HISTORICAL_CONVERSIONS)
         project = self.s.unwrap('gcp_project_name')
         view_data = self.s.unwrap('view_dataset')
         raw_data = self.s.unwrap('raw_dataset')
-        keyword_mapper = views.get(ViewTypes.KEYWORD_MAPPER)
+        if wildcard:
+            historical_conversions = views.get(
+                ViewTypes.AGENCY_HISTORICAL_CONVERSIONS
+            )
+            keyword_mapper = views.get(ViewTypes.AGENCY_KEYWORD_MAPPER)
+            # the transfer's partitioned tables, not its views
+            table_prefix = 'p_'
+            table_suffix = '*'
+            advertiser_id = ',\n            _TABLE_SUFFIX advertiser_id'
+            advertiser_join = 'a.advertiser_id = d.advertiser_id'
+            advertiser_column = ',\n        d.advertiser_id Advertiser_ID'
+            advertiser_group = ',\n            d.advertiser_id'
+            advertiser_inner_group = ',\n            advertiser_id'
+            advertiser_group_by = ', advertiser_id'
+        else:
+            historical_conversions = views.get(
+                ViewTypes.HISTORICAL_CONVERSIONS
+            )
+            keyword_mapper = views.get(ViewTypes.KEYWORD_MAPPER)
+            table_prefix = ''
+            table_suffix = advertiser
+            advertiser_id = ''
+            advertiser_join = '1=1'
+            advertiser_column = ''
+            advertiser_group = ''
+            advertiser_inner_group = ''
+            advertiser_group_by = ''
+        advertisers = self.entity_table(
+            'Advertiser', advertiser, wildcard, ['advertiser']
+        )
         date = self.s.unwrap('first_date_conversions')
+        date_filter = (
+            '\n          WHERE date BETWEEN start_date AND end_date'
+            if date_range else ''
+        )
         maybe_historical_data = 'LEFT JOIN ('
 
         if self.s.unwrap('has_historical_data'):
@@ -248,7 +753,7 @@ class CreateViews:
                 keywordId{deviceSegment},
                 SUM(revenue) revenue,
                 SUM(conversions) conversions
-              FROM `{project}.{view_data}.{historical_conversions}` o
+              FROM `{project}.{view_data}.{historical_conversions}` o{date_filter}
               GROUP BY 
                 date, 
                 keywordId{deviceSegment}
@@ -263,8 +768,27 @@ class CreateViews:
             """
         maybe_historical_data += ') h ON h.keywordId = d.keywordId' \
                                  ' AND h.date = d.date'
+        if not wildcard:
+            conversions_cutoff = (
+                "AND c.date > '{}'".format(iso_date(date)) if date else ''
+            )
+        elif self.s.unwrap('has_historical_data'):
+            # each advertiser's historical rows carry its own cutoff
+            maybe_historical_data += f"""
+        LEFT JOIN (
+          SELECT advertiser_id,
+            ANY_VALUE(first_date_conversions) first_date_conversions
+          FROM `{project}.{raw_data}.{views.get(ViewTypes.AGENCY_HISTORICAL)}`
+          GROUP BY advertiser_id
+        ) s ON s.advertiser_id = d.advertiser_id"""
+            conversions_cutoff = (
+                'AND (s.first_date_conversions IS NULL\n'
+                '              OR c.date > s.first_date_conversions)'
+            )
+        else:
+            conversions_cutoff = ''
         sql = f"""SELECT 
-        d.date Date, 
+        d.date Date{advertiser_column}, 
         m.keywordId,
         m.keyword Keyword{deviceSegment}, 
         m.campaign Campaign,
@@ -283,17 +807,17 @@ class CreateViews:
             SUM(clicks) clicks, 
             SUM(impr) impr, 
             SUM(avgPos*impr) weightedPos,
-            SUM(cost) cost{deviceSegment}
-          FROM `{project}.{raw_data}.KeywordDeviceStats_{advertiser}`
+            SUM(cost) cost{deviceSegment}{advertiser_id}
+          FROM `{project}.{raw_data}.{table_prefix}KeywordDeviceStats_{table_suffix}`{date_filter}
           GROUP BY 
             date, 
-            keywordId{deviceSegment}
+            keywordId{deviceSegment}{advertiser_inner_group}
         ) d
         INNER JOIN (
-            SELECT advertiser 
-            FROM `{project}.{raw_data}.Advertiser_{advertiser}`
-            LIMIT 1
-        ) a ON 1=1
+            SELECT ANY_VALUE(advertiser) advertiser{advertiser_group_by}
+            FROM {advertisers}
+            {'GROUP BY advertiser_id' if wildcard else ''}
+        ) a ON {advertiser_join}
         INNER JOIN `{project}.{view_data}.{keyword_mapper}` m
           ON m.keywordId = d.keywordId
         {maybe_historical_data}
@@ -304,14 +828,14 @@ class CreateViews:
             SUM(dfaRevenue) revenue,
             SUM(dfaTransactions) conversions
           FROM 
-            `{project}.{raw_data}.KeywordFloodlightAndDeviceStats_{advertiser}`
+            `{project}.{raw_data}.{table_prefix}KeywordFloodlightAndDeviceStats_{table_suffix}`{date_filter}
           GROUP BY date, keywordId
         ) c 
             ON c.keywordId=d.keywordId 
             AND c.date=d.date 
-            {"AND c.date > '{date}'" if date else ''}
+            {conversions_cutoff}
         GROUP BY
-            d.date, 
+            d.date{advertiser_group}, 
             m.keywordId, 
             m.keyword, 
             m.campaign,
@@ -320,18 +844,12 @@ class CreateViews:
             m.accountType"""
         return sql
 
+    def report_range(self, advertiser):
+        return self.report_view(advertiser, date_range=True)
+
     def historical_report(self, advertiser):
         views = ViewGetter(advertiser)
-        sql = """WITH conversions AS (
-                    SELECT
-                        SPLIT(
-                            REPEAT(CONCAT(keywordId, ","), 
-                            CAST(FLOOR(conversions) AS INT64)), 
-                            ","
-                        ) keywords
-                    FROM `{project}.{view_data}.{historical_conversions}`
-                )
-                SELECT
+        sql = """SELECT
                     'conversions' as Row_Type,
                     'create' as Action,
                     'active' as Status,
@@ -347,14 +865,9 @@ class CreateViews:
                     c1.AdGroup,
                     c1.revenue/c1.conversions Conversion_Revenue
                 FROM `{project}.{view_data}.{historical_conversions}` c1
-                INNER JOIN (
-                    SELECT keywordId
-                        FROM conversions
-                        CROSS JOIN UNNEST(conversions.keywords) keywordId
-                        WHERE keywordId IS NOT NULL
-                ) keywords 
-                ON keywords.keywordId=c1.keywordId 
-                AND FLOOR(c1.conversions) >= 1
+                CROSS JOIN UNNEST(
+                    GENERATE_ARRAY(1, CAST(FLOOR(c1.conversions) AS INT64))
+                ) conversion_number
                 INNER JOIN (
                     SELECT
                         accountId, advertiserId, agencyId,
@@ -364,13 +877,14 @@ class CreateViews:
                         accountId, advertiserId, agencyId,
                         keywordId, keywordMatchType
                 ) k
-                ON keywords.keywordId=k.keywordId
+                ON c1.keywordId=k.keywordId
                 INNER JOIN (
                     SELECT accountId, accountType, advertiserId, agencyId
                     FROM `{project}.{raw_data}.Account_{advertiser_id}`
                     GROUP BY accountId, accountType, advertiserId, agencyId
                 ) a
                 ON a.accountId=k.accountId
+                WHERE FLOOR(c1.conversions) >= 1
         """.format(
             advertiser_id=advertiser,
             project=self.s.unwrap('gcp_project_name'),